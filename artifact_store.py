@@ -0,0 +1,232 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: los volcados de ejecuciones anteriores no se borran
+    fcntl = None
+
+import numpy as np
+
+from metrics import inc
+
+ARTIFACTS_DIR = "session_artifacts"
+
+# Límites de los datos de sesión que se guardan en memoria y de los que se vuelcan a disco
+ARTIFACT_MEMORY_BYTES = int(os.environ.get("SEGAPP_ARTIFACT_MEMORY_MB", 256)) * 1024 * 1024
+ARTIFACT_DISK_BYTES = int(os.environ.get("SEGAPP_ARTIFACT_DISK_MB", 2048)) * 1024 * 1024
+
+# Archivo que el almacén de cada directorio de volcado mantiene bloqueado mientras vive
+_LOCK_NAME = ".lock"
+
+# Un directorio sin archivo de bloqueo puede ser de un almacén que se está creando; solo se
+# considera abandonado pasado este tiempo (segundos)
+_UNLOCKED_GRACE_SECONDS = 60
+
+
+def _size(value):
+    return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+
+# Almacén del proceso para los datos grandes de las sesiones (imágenes subidas, máscaras,
+# fotogramas, archivos para descargar), de modo que cada sesión solo guarde su handle.
+# Los valores (bytes o arreglos de NumPy, que no deben modificarse) se guardan en memoria
+# hasta memory_bytes en total; por encima, los usados hace más tiempo se vuelcan a disco
+# y se vuelven a cargar al pedirlos. Si el disco supera disk_bytes, se borran los volcados
+# más antiguos y sus handles dejan de ser válidos (get devuelve None). Cada almacén vuelca
+# en su propio subdirectorio de spill_dir, así que varios procesos pueden compartirlo
+class ArtifactStore:
+    def __init__(self, spill_dir=ARTIFACTS_DIR, memory_bytes=ARTIFACT_MEMORY_BYTES, disk_bytes=ARTIFACT_DISK_BYTES):
+        os.makedirs(spill_dir, exist_ok=True)
+        _remove_stale_spills(spill_dir)
+        self.spill_dir = tempfile.mkdtemp(prefix="spill-", dir=spill_dir)
+        # Bloqueado hasta que el proceso termina (el sistema lo libera aunque muera)
+        self._spill_lock = open(os.path.join(self.spill_dir, _LOCK_NAME), 'w')
+        if fcntl is not None:
+            fcntl.flock(self._spill_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.hits = 0
+        self.disk_loads = 0
+        self.evictions = 0
+        self._memory = OrderedDict()  # handle -> valor, del menos al más usado
+        self._memory_size = 0
+        self._disk = OrderedDict()    # handle -> (ruta, tamaño) de las copias en disco
+        self._disk_size = 0
+        self._lock = threading.Lock()
+
+    # Guarda un valor y devuelve su handle
+    def put(self, value):
+        handle = uuid.uuid4().hex
+        with self._lock:
+            self._memory[handle] = value
+            self._memory_size += _size(value)
+            self._evict_memory()
+        return handle
+
+    # Valor del handle (cargándolo de disco si se había volcado), o None si ya no existe
+    def get(self, handle):
+        if handle is None:
+            return None
+        with self._lock:
+            if handle in self._disk:
+                self._disk.move_to_end(handle)
+            if handle in self._memory:
+                self._memory.move_to_end(handle)
+                self.hits += 1
+                return self._memory[handle]
+            if handle not in self._disk:
+                return None
+
+            value = self._load(*self._disk[handle])
+            if value is None:
+                # Alguien borró el volcado: el handle deja de ser válido
+                self._remove_file(*self._disk.pop(handle))
+                return None
+            self.disk_loads += 1
+            inc("segapp_artifact_disk_loads_total")
+            self._memory[handle] = value
+            self._memory_size += _size(value)
+            self._evict_memory()
+            return value
+
+    # Ruta de un archivo nuevo y vacío en el directorio de volcado, para escribir en él
+    # una descarga grande sin reunirla en memoria; después se registra con put_file
+    def new_file(self, suffix=""):
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.spill_dir)
+        os.close(fd)
+        return path
+
+    # Registra un archivo ya escrito con new_file y devuelve su handle. Cuenta para el
+    # límite de disco como un volcado más y se borra con discard, al superarse el límite
+    # o con el directorio de volcado del proceso
+    def put_file(self, path):
+        handle = uuid.uuid4().hex
+        size = os.path.getsize(path)
+        with self._lock:
+            self._disk[handle] = (path, size)
+            self._disk_size += size
+            self._evict_disk()
+        return handle
+
+    # Ruta del archivo de un handle registrado con put_file, o None si ya se borró
+    def file_path(self, handle):
+        with self._lock:
+            entry = self._disk.get(handle)
+            if entry is None:
+                return None
+            self._disk.move_to_end(handle)
+            return entry[0] if os.path.exists(entry[0]) else None
+
+    # Elimina el valor de memoria y de disco
+    def discard(self, handle):
+        with self._lock:
+            value = self._memory.pop(handle, None)
+            if value is not None:
+                self._memory_size -= _size(value)
+            entry = self._disk.pop(handle, None)
+            if entry is not None:
+                self._remove_file(*entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "memory_limit": self.memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_size,
+                "disk_limit": self.disk_bytes,
+                "hits": self.hits,
+                "disk_loads": self.disk_loads,
+                "evictions": self.evictions,
+            }
+
+    # Vuelca a disco los valores usados hace más tiempo hasta respetar el límite de
+    # memoria. Un valor que ya se cargó de disco conserva su copia y no se reescribe
+    def _evict_memory(self):
+        while self._memory_size > self.memory_bytes and self._memory:
+            handle, value = self._memory.popitem(last=False)
+            self._memory_size -= _size(value)
+            self.evictions += 1
+            inc("segapp_artifact_evictions_total")
+            if handle not in self._disk:
+                self._spill(handle, value)
+        self._evict_disk()
+
+    def _spill(self, handle, value):
+        is_array = isinstance(value, np.ndarray)
+        path = os.path.join(self.spill_dir, f"{handle}.npy" if is_array else f"{handle}.bin")
+        if is_array:
+            np.save(path, value, allow_pickle=False)
+        else:
+            with open(path, 'wb') as file:
+                file.write(value)
+        size = os.path.getsize(path)
+        self._disk[handle] = (path, size)
+        self._disk_size += size
+
+    @staticmethod
+    def _load(path, size):
+        try:
+            if path.endswith(".npy"):
+                return np.load(path, allow_pickle=False)
+            with open(path, 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _remove_file(self, path, size):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._disk_size -= size
+
+    # Borra los volcados usados hace más tiempo por encima del límite de disco (los que
+    # siguen en memoria solo pierden su copia)
+    def _evict_disk(self):
+        while self._disk_size > self.disk_bytes and self._disk:
+            handle, entry = self._disk.popitem(last=False)
+            self._remove_file(*entry)
+
+
+# Borra los subdirectorios de volcado cuyo almacén ya no existe (ninguna sesión referencia
+# sus handles): aquellos cuyo archivo de bloqueo se puede bloquear, porque el proceso que
+# lo tenía terminó. No depende del PID, que otro proceso puede reutilizar
+def _remove_stale_spills(spill_dir):
+    if fcntl is None:
+        return
+    for entry in os.scandir(spill_dir):
+        if not entry.is_dir():
+            continue
+        try:
+            lock_file = open(os.path.join(entry.path, _LOCK_NAME))
+        except FileNotFoundError:
+            if time.time() - entry.stat().st_mtime > _UNLOCKED_GRACE_SECONDS:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # Su almacén sigue vivo
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# Almacén del proceso, compartido por la interfaz y la cola de trabajos
+def init_artifact_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ArtifactStore()
+        return _store
@@ -0,0 +1,338 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from mask_storage import compact_mask_path, compute_mask_metrics, save_compact_mask
+from pdf_export import export_patient_to_pdf
+from segmentation import (
+    IMAGE_SIZE,
+    ImageBatchBuffer,
+    calculate_non_black_pixel_percentage,
+    load_image,
+    load_segmentation_model,
+    postprocess_mask,
+    postprocess_masks,
+    stack_images,
+)
+
+DEFAULT_RESOLUTIONS = "640x480,1920x1080,4000x3000"
+DEFAULT_BATCH_SIZES = "1,2,4,8,16,32,64"
+PIPELINE_STAGES = ("decode", "preprocess", "predict", "postprocess", "save", "area", "pdf")
+
+# Métricas en las que un valor mayor es mejor (en las demás, menor es mejor)
+HIGHER_IS_BETTER = ("images_per_second",)
+
+
+# Imagen sintética tipo foto (degradado, ruido y una "herida" elíptica) codificada en JPEG
+def synthetic_jpeg(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([
+        180 + 40 * x / width,
+        140 + 30 * y / height,
+        120 + 20 * (x + y) / (width + height),
+    ], axis=-1)
+    wound = ((x - width / 2) / (width / 4)) ** 2 + ((y - height / 2) / (height / 5)) ** 2 < 1
+    base[wound] = (150, 40, 40)
+    pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def parse_resolutions(text):
+    return [tuple(int(value) for value in item.lower().split("x")) for item in text.split(",") if item]
+
+
+# Percentiles de una lista de duraciones en segundos, en milisegundos
+def latency_summary(samples):
+    samples_ms = np.asarray(samples) * 1000.0
+    return {
+        "mean_ms": float(samples_ms.mean()),
+        "p50_ms": float(np.percentile(samples_ms, 50)),
+        "p90_ms": float(np.percentile(samples_ms, 90)),
+        "p99_ms": float(np.percentile(samples_ms, 99)),
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Latencia por etapa del flujo completo de una imagen, como en la aplicación
+def bench_pipeline(model, width, height, repeats, workdir):
+    data = synthetic_jpeg(width, height)
+    timings = {stage: [] for stage in PIPELINE_STAGES}
+
+    for idx in range(repeats):
+        start = time.perf_counter()
+        image = load_image(BytesIO(data))
+        timings["decode"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        batch = stack_images([image])
+        timings["preprocess"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        prediction = model.predict(batch, verbose=0)[0]
+        timings["predict"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        mask = postprocess_mask(prediction)
+        timings["postprocess"].append(time.perf_counter() - start)
+
+        # Mismos archivos que save_processed_image: PNG, máscara compacta y métricas
+        start = time.perf_counter()
+        mask_path = os.path.join(workdir, f"mask_{width}x{height}_{idx}.png")
+        Image.fromarray(mask).save(mask_path)
+        save_compact_mask(mask, compact_mask_path(mask_path))
+        metrics = compute_mask_metrics(mask)
+        timings["save"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        calculate_non_black_pixel_percentage(mask)
+        timings["area"].append(time.perf_counter() - start)
+
+        patient = {
+            "name": "Paciente de prueba",
+            "age": 40,
+            "sex": "Otro",
+            "dni": "00000000",
+            "segmentations": [mask_path],
+            "metrics": {mask_path: metrics},
+        }
+        start = time.perf_counter()
+        export_patient_to_pdf(patient)
+        timings["pdf"].append(time.perf_counter() - start)
+
+    return {stage: latency_summary(samples) for stage, samples in timings.items()}
+
+
+# Latencia y memoria asignada (pico, en KB) de una función repetida repeats veces.
+# tracemalloc solo ve la memoria de Python y NumPy, no los búferes internos de PIL
+def _measure(function, repeats):
+    function()  # Calentamiento
+    samples = []
+    peaks = []
+    for _ in range(repeats):
+        tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    summary = latency_summary(samples)
+    summary["peak_alloc_kb"] = float(np.median(peaks)) / 1024
+    return summary
+
+
+# Preprocesado y posprocesado de una imagen con la ruta anterior (PIL + float64 + una
+# copia por paso) y con el motor fusionado de búferes preasignados. Sin modelo: la
+# predicción es un arreglo fijo que se copia en el búfer de salida en ambos casos
+def bench_preprocessing(width, height, repeats):
+    image = Image.open(BytesIO(synthetic_jpeg(width, height)))
+    image.load()
+    prediction = np.random.default_rng(0).random((1, IMAGE_SIZE[1], IMAGE_SIZE[0], 1), dtype=np.float32)
+    output = np.empty_like(prediction)
+
+    def legacy():
+        batch = np.expand_dims(np.array(image.convert("RGB").resize(IMAGE_SIZE)) / 255.0, axis=0)
+        np.copyto(output, prediction)
+        mask = np.squeeze((output[0] * 255).astype(np.uint8), axis=-1)
+        return batch, mask
+
+    buffer = ImageBatchBuffer(1)
+
+    def fused():
+        batch = buffer.stack([image])
+        np.copyto(output, prediction)
+        return batch, postprocess_masks(output)[0]
+
+    return {"legacy": _measure(legacy, repeats), "fused": _measure(fused, repeats)}
+
+
+# Decodificación de una foto subida: completa (Image.open + load, como antes) y reducida
+# a lo que necesita la vista previa. La memoria es la de la imagen decodificada, que PIL
+# asigna fuera de tracemalloc
+def bench_decoding(width, height, repeats):
+    data = synthetic_jpeg(width, height)
+
+    def full():
+        image = Image.open(BytesIO(data))
+        image.load()
+        return image
+
+    def reduced():
+        return load_image(BytesIO(data))
+
+    results = {}
+    for path, function in (("full", full), ("reduced", reduced)):
+        results[path] = _measure(function, repeats)
+        image = function()
+        results[path]["peak_alloc_kb"] = image.width * image.height * len(image.getbands()) / 1024
+    return results
+
+
+# Imágenes por segundo de model.predict para cada tamaño de lote
+def bench_throughput(model, batch_sizes, repeats):
+    results = {}
+    rng = np.random.default_rng(0)
+    for batch_size in batch_sizes:
+        batch = rng.random((batch_size, 224, 224, 3), dtype=np.float32)
+        # Todo el lote en una sola llamada (Keras lo trocearía en lotes de 32)
+        model.predict(batch, batch_size=batch_size, verbose=0)  # Calentamiento para este tamaño de lote
+
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model.predict(batch, batch_size=batch_size, verbose=0)
+            samples.append(time.perf_counter() - start)
+
+        summary = latency_summary(samples)
+        summary["images_per_second"] = batch_size / float(np.median(samples))
+        results[str(batch_size)] = summary
+    return results
+
+
+def run(args):
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "backend": args.backend,
+            "model_path": args.model,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeats": args.repeats,
+        },
+    }
+
+    start = time.perf_counter()
+    model = load_segmentation_model(args.backend, args.model, args.url)
+    results["model_load_s"] = time.perf_counter() - start
+
+    # La primera predicción incluye la construcción del grafo
+    start = time.perf_counter()
+    model.predict(np.zeros((1, 224, 224, 3), dtype=np.float32), verbose=0)
+    results["first_predict_s"] = time.perf_counter() - start
+
+    results["decoding"] = {
+        f"{width}x{height}": bench_decoding(width, height, args.repeats)
+        for width, height in parse_resolutions(args.resolutions)
+    }
+    results["preprocessing"] = {
+        f"{width}x{height}": bench_preprocessing(width, height, args.repeats)
+        for width, height in parse_resolutions(args.resolutions)
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results["pipeline"] = {
+            f"{width}x{height}": bench_pipeline(model, width, height, args.repeats, workdir)
+            for width, height in parse_resolutions(args.resolutions)
+        }
+
+    batch_sizes = [int(value) for value in args.batch_sizes.split(",") if value]
+    results["throughput"] = bench_throughput(model, batch_sizes, args.repeats)
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+# Aplana los resultados anidados en claves del tipo "pipeline.640x480.predict.p50_ms"
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if key == "meta":
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+# Compara dos ejecuciones y devuelve las métricas que empeoran más de threshold (%)
+def compare(baseline, current, threshold):
+    base_flat = flatten(baseline)
+    current_flat = flatten(current)
+    regressions = []
+
+    print(f"{'métrica':<52} {'base':>12} {'actual':>12} {'cambio':>9}")
+    for key in sorted(base_flat.keys() & current_flat.keys()):
+        before, after = base_flat[key], current_flat[key]
+        change = (after - before) / before * 100 if before else 0.0
+        worse = -change if key.endswith(HIGHER_IS_BETTER) else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESIÓN"
+            regressions.append(key)
+        print(f"{key:<52} {before:>12.3f} {after:>12.3f} {change:>+8.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del flujo de segmentación (sin Streamlit)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Medir el flujo y guardar los resultados en JSON")
+    run_parser.add_argument("--backend", choices=("keras", "tflite", "remote"), default="keras")
+    run_parser.add_argument("--model", help="Archivo del modelo (por defecto, el del backend)")
+    run_parser.add_argument("--url", default="http://127.0.0.1:8502", help="URL del servidor para el backend remote")
+    run_parser.add_argument("--resolutions", default=DEFAULT_RESOLUTIONS)
+    run_parser.add_argument("--batch-sizes", default=DEFAULT_BATCH_SIZES)
+    run_parser.add_argument("--repeats", type=int, default=20)
+    run_parser.add_argument("--output", default="-", help="Archivo JSON de resultados ('-' para la salida estándar)")
+
+    preprocess_parser = subparsers.add_parser("preprocess", help="Medir solo la decodificación y el preprocesado (sin modelo)")
+    preprocess_parser.add_argument("--resolutions", default=DEFAULT_RESOLUTIONS)
+    preprocess_parser.add_argument("--repeats", type=int, default=20)
+
+    compare_parser = subparsers.add_parser("compare", help="Comparar dos ejecuciones")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="Cambio (%%) a partir del cual se marca una regresión")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run(args)
+        text = json.dumps(results, indent=2)
+        if args.output == "-":
+            print(text)
+        else:
+            with open(args.output, 'w') as file:
+                file.write(text)
+    elif args.command == "preprocess":
+        print(f"{'resolución':<12} {'ruta':<14} {'p50 ms':>9} {'pico KB':>10}")
+        for width, height in parse_resolutions(args.resolutions):
+            rows = [(f"decode {path}", summary) for path, summary in bench_decoding(width, height, args.repeats).items()]
+            rows += bench_preprocessing(width, height, args.repeats).items()
+            for path, summary in rows:
+                print(f"{width}x{height:<7} {path:<14} {summary['p50_ms']:>9.2f} {summary['peak_alloc_kb']:>10.0f}")
+    else:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regresiones por encima del {args.threshold:.0f}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
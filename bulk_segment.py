@@ -0,0 +1,266 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from PIL import Image
+
+from mask_storage import compact_mask_path, compute_mask_metrics, save_compact_mask
+from segmentation import (
+    DEFAULT_BATCH_SIZE,
+    ImageBatchBuffer,
+    load_image,
+    load_segmentation_model,
+    predict_masks,
+    predict_tiled,
+    resize_rgb,
+)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Columnas de la salida CSV/JSONL (una fila por imagen)
+RESULT_FIELDS = (
+    "source",
+    "mask_path",
+    "area_percentage",
+    "pixel_count",
+    "bbox_x",
+    "bbox_y",
+    "bbox_width",
+    "bbox_height",
+    "components",
+    "perimeter",
+    "error",
+)
+
+# Lotes decodificados por adelantado mientras el modelo procesa el actual; en mosaico,
+# con imágenes a resolución completa, solo uno
+PREFETCH_BATCHES = 2
+TILED_PREFETCH_BATCHES = 1
+
+# Máscaras pendientes de escribir en disco antes de esperar al escritor
+MAX_PENDING_WRITES = 64
+
+
+# Recorre directorios (recursivamente) y patrones glob sin construir la lista completa
+def iter_image_paths(inputs):
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            for path in glob.iglob(item, recursive=True):
+                if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                    yield path
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+# Imágenes ya procesadas sin error según un archivo de resultados previo
+def load_manifest(output_path):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, newline='') as file:
+        if output_path.endswith(".jsonl"):
+            rows = (json.loads(line) for line in file if line.strip())
+        else:
+            rows = csv.DictReader(file)
+        for row in rows:
+            if not row.get("error"):
+                done.add(row["source"])
+    return done
+
+
+# Escribe las filas de resultados en CSV o JSONL según la extensión, añadiendo al
+# final del archivo para poder reanudar una ejecución interrumpida
+class ResultWriter:
+    def __init__(self, path):
+        self.jsonl = path.endswith(".jsonl")
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='')
+        if not self.jsonl:
+            self._csv = csv.DictWriter(self._file, fieldnames=RESULT_FIELDS)
+            if is_new:
+                self._csv.writeheader()
+
+    def write(self, row):
+        if self.jsonl:
+            self._file.write(json.dumps(row) + "\n")
+        else:
+            self._csv.writerow(row)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# Nombre de la máscara: nombre de la imagen + hash corto de su ruta, para que dos
+# imágenes con el mismo nombre en carpetas distintas no se sobrescriban
+def mask_filename(source, masks_dir):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.blake2b(os.path.abspath(source).encode(), digest_size=4).hexdigest()
+    return os.path.join(masks_dir, f"{stem}_{digest}_mask.png")
+
+
+# Decodifica una imagen en un hilo de trabajo: la imagen ya redimensionada a la entrada
+# del modelo (uint8) o, en modo mosaico, la imagen a resolución completa
+def decode_image(path, tiled):
+    image = load_image(path, full_resolution=tiled)
+    if tiled:
+        return image.convert("RGB")
+    return resize_rgb(image)
+
+
+# Guarda la máscara (PNG y formato compacto) y calcula sus métricas
+def save_mask(source, mask, masks_dir, compact):
+    row = dict.fromkeys(RESULT_FIELDS)
+    row["source"] = source
+    if masks_dir:
+        mask_path = mask_filename(source, masks_dir)
+        Image.fromarray(mask).save(mask_path)
+        if compact:
+            save_compact_mask(mask, compact_mask_path(mask_path))
+        row["mask_path"] = mask_path
+    row.update(compute_mask_metrics(mask))
+    return row
+
+
+def _error_row(source, error):
+    row = dict.fromkeys(RESULT_FIELDS)
+    row.update(source=source, error=f"{type(error).__name__}: {error}")
+    return row
+
+
+# Segmenta las imágenes en flujo: decodificación en paralelo, inferencia por lotes y
+# escritura asíncrona de máscaras. Solo hay en memoria unos pocos lotes a la vez
+def segment_paths(paths, model, writer, masks_dir=None, batch_size=DEFAULT_BATCH_SIZE,
+                  workers=os.cpu_count() or 1, tiled=False, compact=True, progress=None):
+    processed = 0
+    buffer = ImageBatchBuffer(batch_size)
+    with ThreadPoolExecutor(max_workers=workers) as decode_pool, \
+            ThreadPoolExecutor(max_workers=max(1, workers // 2)) as write_pool:
+        decoding = deque()
+        writes = deque()
+
+        # Escribe en orden los resultados ya terminados y espera al escritor solo si
+        # quedan más de limit máscaras pendientes
+        def drain_writes(limit):
+            nonlocal processed
+            while writes and (writes[0].done() or len(writes) > limit):
+                writer.write(writes.popleft().result())
+                processed += 1
+
+        def run_batch(batch):
+            decoded = []
+            for source, future in batch:
+                try:
+                    decoded.append((source, future.result()))
+                except Exception as e:
+                    writes.append(write_pool.submit(_error_row, source, e))
+
+            # Un lote en el que ninguna imagen se pudo decodificar también anota sus errores
+            if decoded:
+                if tiled:
+                    masks = [predict_tiled(model, image) for _, image in decoded]
+                else:
+                    stacked = buffer.stack(array for _, array in decoded)
+                    masks = predict_masks(model, stacked, batch_size=batch_size)
+                for (source, _), mask in zip(decoded, masks):
+                    writes.append(write_pool.submit(save_mask, source, mask, masks_dir, compact))
+            drain_writes(MAX_PENDING_WRITES)
+            writer.flush()
+            if progress is not None:
+                progress(processed)
+
+        prefetch = TILED_PREFETCH_BATCHES if tiled else PREFETCH_BATCHES
+        for chunk in _chunks(paths, batch_size):
+            decoding.append([(source, decode_pool.submit(decode_image, source, tiled)) for source in chunk])
+            if len(decoding) > prefetch:
+                run_batch(decoding.popleft())
+        while decoding:
+            run_batch(decoding.popleft())
+
+        drain_writes(0)
+        writer.flush()
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segmentar en bloque directorios o patrones de imágenes")
+    parser.add_argument("inputs", nargs="+", help="Directorios (se recorren recursivamente) o patrones glob")
+    parser.add_argument("--output", default="segmentation_results.csv",
+                        help="Resultados por imagen (.csv o .jsonl); también sirve para reanudar")
+    parser.add_argument("--masks-dir",
+                        help="Directorio de las máscaras (por defecto, <output>_masks junto a --output; "
+                             "'' para no guardarlas)")
+    parser.add_argument("--no-compact", action="store_true", help="No guardar la máscara compacta (.bits)")
+    parser.add_argument("--backend", choices=("keras", "tflite", "remote"), default="keras")
+    parser.add_argument("--model", help="Archivo del modelo (por defecto, el del backend)")
+    parser.add_argument("--url", default="http://127.0.0.1:8502", help="URL del servidor para el backend remote")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Hilos de decodificación (y la mitad para escribir máscaras)")
+    parser.add_argument("--tiled", action="store_true", help="Máscaras a resolución completa (mosaico)")
+    parser.add_argument("--no-resume", action="store_true", help="Procesar también las imágenes ya presentes en --output")
+    args = parser.parse_args()
+
+    done = set()
+    if args.no_resume:
+        if os.path.exists(args.output):
+            os.remove(args.output)
+    else:
+        done = load_manifest(args.output)
+        if done:
+            print(f"Reanudando: {len(done)} imágenes ya procesadas", file=sys.stderr)
+
+    # No se usa el directorio segmentations/ de la aplicación: estas máscaras no son de
+    # ningún paciente
+    if args.masks_dir is None:
+        args.masks_dir = f"{os.path.splitext(args.output)[0]}_masks"
+    if args.masks_dir:
+        os.makedirs(args.masks_dir, exist_ok=True)
+
+    model = load_segmentation_model(args.backend, args.model, args.url)
+    paths = (path for path in iter_image_paths(args.inputs) if path not in done)
+
+    start = time.perf_counter()
+
+    def progress(count):
+        elapsed = time.perf_counter() - start
+        print(f"\r{count} imágenes · {count / elapsed:.1f} img/s", end="", file=sys.stderr)
+
+    writer = ResultWriter(args.output)
+    try:
+        count = segment_paths(
+            paths, model, writer,
+            masks_dir=args.masks_dir or None,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            tiled=args.tiled,
+            compact=not args.no_compact,
+            progress=progress,
+        )
+    finally:
+        writer.close()
+    print(f"\n{count} imágenes segmentadas en {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import inc
+
+INFERENCE_CACHE_DIR = "inference_cache"
+
+# Límites de tamaño de cada nivel de la caché
+MEMORY_CACHE_BYTES = int(os.environ.get("SEGAPP_CACHE_MEMORY_MB", 64)) * 1024 * 1024
+DISK_CACHE_BYTES = int(os.environ.get("SEGAPP_CACHE_DISK_MB", 512)) * 1024 * 1024
+
+# Bytes de píxeles por franja al calcular la huella de una imagen
+DIGEST_CHUNK_BYTES = 1024 * 1024
+
+
+# Hash del contenido de un archivo (por ejemplo, el modelo), leído por bloques
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Caché de inferencia en dos niveles (memoria y disco) con expulsión LRU.
+# Cada entrada guarda la máscara y la ruta del PNG ya guardado en segmentations/
+class InferenceCache:
+    def __init__(self, cache_dir=INFERENCE_CACHE_DIR, memory_bytes=MEMORY_CACHE_BYTES, disk_bytes=DISK_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # clave -> (máscara, ruta)
+        self._memory_size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._disk_size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    # Huella de los píxeles decodificados (imagen PIL) y el modo de inferencia, independiente
+    # del modelo. Se calcula por franjas de filas, sin convertir ni copiar la imagen entera:
+    # en modo mosaico es la decodificación a resolución completa
+    @staticmethod
+    def image_digest(image, mode="preview"):
+        width, height = image.size
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{mode}:{image.mode}:{width}x{height}".encode())
+        rows = max(1, DIGEST_CHUNK_BYTES // (width * 4))
+        for top in range(0, height, rows):
+            digest.update(image.crop((0, top, width, min(height, top + rows))).tobytes())
+        return digest.hexdigest()
+
+    # Clave a partir de la huella de la imagen y la versión del modelo que la segmenta
+    @staticmethod
+    def make_key(image_digest, model_hash):
+        return hashlib.blake2b(f"{model_hash}:{image_digest}".encode(), digest_size=16).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    # Devuelve (máscara, ruta) si la imagen ya se segmentó con este modelo, o None
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if os.path.exists(entry[1]):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    inc("segapp_inference_cache_hits_total")
+                    return entry
+                # El PNG original ya no existe: descartar la entrada
+                del self._memory[key]
+                self._memory_size -= entry[0].nbytes
+
+            entry = self._load_from_disk(key)
+            if entry is None:
+                self.misses += 1
+                inc("segapp_inference_cache_misses_total")
+                return None
+
+            self._store_in_memory(key, entry)
+            self.hits += 1
+            inc("segapp_inference_cache_hits_total")
+            return entry
+
+    def put(self, key, mask, path):
+        with self._lock:
+            self._store_in_memory(key, (mask, path))
+            self._store_on_disk(key, mask, path)
+
+    # Vacía la caché en memoria y en disco (al reiniciar la base de datos, sus máscaras
+    # se borran)
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file():
+                    self._remove_from_disk(entry.path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_bytes": self._disk_size,
+            }
+
+    def _store_in_memory(self, key, entry):
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= previous[0].nbytes
+        self._memory[key] = entry
+        self._memory_size += entry[0].nbytes
+
+        # Expulsar las entradas usadas hace más tiempo hasta respetar el límite
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, (evicted_mask, _) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_mask.nbytes
+
+    def _load_from_disk(self, key):
+        disk_path = self._disk_path(key)
+        try:
+            with np.load(disk_path, allow_pickle=False) as data:
+                mask = data["mask"]
+                path = str(data["path"])
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+
+        # Si el PNG original se borró (por ejemplo, al reiniciar la base), la entrada no sirve
+        if not os.path.exists(path):
+            self._remove_from_disk(disk_path)
+            return None
+
+        # Actualizar la fecha de acceso para el orden LRU del disco
+        os.utime(disk_path)
+        return mask, path
+
+    def _store_on_disk(self, key, mask, path):
+        disk_path = self._disk_path(key)
+        if os.path.exists(disk_path):
+            return
+        np.savez_compressed(disk_path, mask=mask, path=np.array(path))
+        self._disk_size += os.path.getsize(disk_path)
+        if self._disk_size > self.disk_bytes:
+            self._evict_disk()
+
+    def _remove_from_disk(self, disk_path):
+        try:
+            size = os.path.getsize(disk_path)
+            os.remove(disk_path)
+        except FileNotFoundError:
+            return
+        self._disk_size -= size
+
+    # Borra los archivos de caché con acceso más antiguo hasta quedar por debajo del límite
+    def _evict_disk(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in entries:
+            if self._disk_size <= self.disk_bytes:
+                break
+            self._remove_from_disk(entry.path)
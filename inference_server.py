@@ -0,0 +1,150 @@
+import io
+import os
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future
+
+import numpy as np
+from flask import Flask, request, Response
+
+import metrics
+from segmentation import IMAGE_SIZE, load_segmentation_model
+
+# Backend y archivo del modelo que sirve este proceso (por defecto, el del backend)
+MODEL_BACKEND = os.environ.get("SEGAPP_BACKEND", "keras")
+MODEL_PATH = os.environ.get("SEGAPP_MODEL_PATH")
+
+# Política de micro-lotes: se ejecuta el modelo cuando se juntan MAX_BATCH_SIZE
+# imágenes o cuando la primera petición lleva MAX_WAIT_MS esperando
+MAX_BATCH_SIZE = int(os.environ.get("SEGAPP_MAX_BATCH_SIZE", 16))
+MAX_WAIT_MS = float(os.environ.get("SEGAPP_MAX_WAIT_MS", 10))
+
+HOST = os.environ.get("SEGAPP_INFERENCE_HOST", "127.0.0.1")
+PORT = int(os.environ.get("SEGAPP_INFERENCE_PORT", 8502))
+
+
+# Serializa un arreglo de NumPy para enviarlo por HTTP
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+# Reconstruye un arreglo de NumPy recibido por HTTP
+def decode_array(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+# Agrupa las peticiones de todas las sesiones en micro-lotes para un único modelo
+class MicroBatcher:
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.images = 0
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Encola un lote (N, 224, 224, 3) y devuelve un Future con sus N predicciones
+    def submit(self, batch):
+        future = Future()
+        self._requests.put((batch, future))
+        return future
+
+    # Espera la primera petición y añade otras hasta llenar el lote o agotar la espera
+    def _collect(self):
+        pending = [self._requests.get()]
+        size = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            size += len(item[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            try:
+                with metrics.timed("server_predict"):
+                    batch = np.concatenate([item[0] for item in pending])
+                    predictions = self.model.predict(batch, batch_size=self.max_batch_size, verbose=0)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.images += len(batch)
+            metrics.inc("segapp_images_segmented_total", len(batch))
+
+            # Devolver a cada petición su porción del lote
+            start = 0
+            for item_batch, future in pending:
+                future.set_result(predictions[start:start + len(item_batch)])
+                start += len(item_batch)
+
+
+# Cliente del servidor con la misma interfaz predict que un modelo de Keras
+class RemoteModel:
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def predict(self, batch, **kwargs):
+        data = encode_array(np.asarray(batch, dtype=np.float32))
+        req = urllib.request.Request(
+            f"{self.url}/predict",
+            data=data,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            return decode_array(response.read())
+
+
+def create_app(model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+    app = Flask(__name__)
+    batcher = MicroBatcher(model, max_batch_size, max_wait_ms)
+
+    @app.route('/predict', methods=['POST'])
+    def predict():
+        batch = decode_array(request.get_data())
+        if batch.ndim != 4 or batch.shape[1:] != (IMAGE_SIZE[1], IMAGE_SIZE[0], 3):
+            return f'Expected a (N, {IMAGE_SIZE[1]}, {IMAGE_SIZE[0]}, 3) array, got {batch.shape}', 400
+        predictions = batcher.submit(batch.astype(np.float32, copy=False)).result()
+        return Response(encode_array(predictions), mimetype='application/octet-stream')
+
+    @app.route('/health')
+    def health():
+        return {
+            'status': 'ok',
+            'batches': batcher.batches,
+            'images': batcher.images,
+            'max_batch_size': batcher.max_batch_size,
+            'max_wait_ms': batcher.max_wait * 1000.0,
+        }
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    return app
+
+
+if __name__ == '__main__':
+    # TensorFlow solo se importa en el proceso que sirve el modelo
+    with metrics.timed("load_model"):
+        model = load_segmentation_model(MODEL_BACKEND, MODEL_PATH)
+    metrics.inc("segapp_model_loads_total")
+    app = create_app(model)
+    app.run(host=HOST, port=PORT, threaded=True)
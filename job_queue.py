@@ -0,0 +1,353 @@
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+from io import BytesIO
+
+import metrics
+from mask_storage import compute_mask_metrics
+from segmentation import (
+    DEFAULT_BATCH_SIZE,
+    ImageBatchBuffer,
+    load_image,
+    predict_masks,
+    predict_tiled,
+    prepare_image,
+)
+from video_segmentation import segment_video
+
+# Trabajos que pueden esperar en la cola; por encima se rechazan (HTTP 429)
+JOB_QUEUE_SIZE = int(os.environ.get("SEGAPP_JOB_QUEUE_SIZE", 256))
+
+# Hilos que vacían la cola y trabajos que agrupa cada uno por llamada al modelo
+JOB_WORKERS = int(os.environ.get("SEGAPP_JOB_WORKERS", 1))
+JOB_BATCH_SIZE = int(os.environ.get("SEGAPP_JOB_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+
+# Hilos aparte para los trabajos largos (mosaico y video), que así no retrasan las vistas
+# previas de las demás sesiones
+JOB_LONG_WORKERS = int(os.environ.get("SEGAPP_JOB_LONG_WORKERS", 1))
+
+# Trabajos terminados que se conservan para consultar su resultado
+JOB_HISTORY = int(os.environ.get("SEGAPP_JOB_HISTORY", 1000))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+# Un trabajo de segmentación: la imagen de entrada, su estado, tiempos y resultado. Con
+# tiled, la máscara se calcula a resolución completa con teselas (ver predict_tiled); con
+# video, la entrada son los bytes de un video y el resultado es la máscara de su mejor
+# fotograma, con el área en cada fotograma segmentado (ver segment_video). Con un almacén
+# de artefactos, la máscara y el fotograma se guardan en él en lugar de en el trabajo
+class SegmentationJob:
+    def __init__(self, image, name=None, tiled=False, video=False, artifacts=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.tiled = tiled
+        self.video = video
+        self.status = "queued"
+        self.progress = 0.0  # Fracción de la imagen ya procesada por el modelo
+        self.created = time.time()
+        self.timings = {}
+        self.metrics = None
+        self.video_stats = None
+        self._mask = None
+        self._frame = None  # Video: copia reducida del fotograma de la máscara
+        self._artifacts = artifacts
+        self.error = None
+        self.batch_size = None
+        self.model_version = None  # Versión del modelo que generó la máscara
+        self._image = image  # Bytes de la imagen o imagen PIL; se libera al procesarla
+        self._submitted = time.perf_counter()
+        self._future = Future()
+
+    # Máscara (y fotograma) del trabajo terminado; None si el almacén ya la descartó
+    @property
+    def mask(self):
+        return self._artifacts.get(self._mask) if self._artifacts is not None else self._mask
+
+    @property
+    def frame(self):
+        return self._artifacts.get(self._frame) if self._artifacts is not None else self._frame
+
+    # Cede el handle del fotograma (en el almacén de la cola) a quien lo va a conservar,
+    # para no copiarlo: el trabajo ya no lo libera al olvidarse
+    def take_frame(self):
+        handle, self._frame = self._frame, None
+        return handle
+
+    @property
+    def done(self):
+        return self._future.done()
+
+    # Espera a que termine; devuelve False si se agota el tiempo
+    def wait(self, timeout=None):
+        done, _ = wait([self._future], timeout=timeout)
+        return bool(done)
+
+    # Espera el resultado y devuelve la máscara (o relanza el error del trabajo)
+    def result(self, timeout=None):
+        return self._future.result(timeout=timeout)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "tiled": self.tiled,
+            "video": self.video,
+            "progress": self.progress,
+            "created": self.created,
+            "timings": self.timings,
+            "batch_size": self.batch_size,
+            "model_version": self.model_version,
+            "metrics": self.metrics,
+            "video_stats": self.video_stats,
+            "error": self.error,
+        }
+
+    def _keep(self, value):
+        if value is None or self._artifacts is None:
+            return value
+        return self._artifacts.put(value)
+
+    # Libera la máscara y el fotograma del almacén al olvidar el trabajo
+    def _release(self):
+        if self._artifacts is not None:
+            for handle in (self._mask, self._frame):
+                if handle is not None:
+                    self._artifacts.discard(handle)
+
+    def _finish(self, mask=None, error=None, frame=None):
+        self.timings["total_ms"] = (time.perf_counter() - self._submitted) * 1000.0
+        self._image = None
+        if error is not None:
+            self.status = "error"
+            self.error = f"{type(error).__name__}: {error}"
+            self._future.set_exception(error)
+        else:
+            try:
+                self.metrics = compute_mask_metrics(mask)
+                self._mask = self._keep(mask)
+                self._frame = self._keep(frame)
+            except Exception as e:
+                # Por ejemplo, si el almacén no puede volcar a disco: falla solo este trabajo
+                self._release()
+                self._mask = self._frame = None
+                self._finish(error=e)
+                return
+            self.status = "done"
+            self.progress = 1.0
+            self._future.set_result(mask)
+
+
+# Cola acotada de trabajos de segmentación que unos hilos de fondo vacían en lotes
+# para el modelo. model_loader devuelve el par (versión, modelo) activo y se consulta en
+# cada lote, de modo que un modelo recargado en caliente se usa a partir del lote
+# siguiente y cada trabajo anota la versión del modelo que realmente lo procesó. Si se
+# indica artifacts (ver ArtifactStore), las máscaras terminadas se guardan en él, con un
+# límite de memoria, en lugar de en cada trabajo del historial. Los trabajos en mosaico y
+# de video esperan en su propia cola, que vacían long_workers hilos de uno en uno
+class JobQueue:
+    def __init__(self, model_loader, max_size=JOB_QUEUE_SIZE, workers=JOB_WORKERS,
+                 batch_size=JOB_BATCH_SIZE, history=JOB_HISTORY, artifacts=None,
+                 long_workers=JOB_LONG_WORKERS):
+        self.model_loader = model_loader
+        self.artifacts = artifacts
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.history = history
+        self._queue = queue.Queue()       # Vistas previas, que se agrupan en lotes
+        self._long_queue = queue.Queue()  # Mosaico y video
+        self._jobs = OrderedDict()  # id -> trabajo, en orden de llegada
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        self._threads += [threading.Thread(target=self._run_long, daemon=True) for _ in range(long_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        return self._queue.qsize() + self._long_queue.qsize()
+
+    # Encola una o varias imágenes (bytes o PIL) de una vez; si no caben todas, no encola
+    # ninguna y lanza QueueFullError
+    def submit_many(self, images, names=None, tiled=False, video=False):
+        names = names or [None] * len(images)
+        jobs = [SegmentationJob(image, name, tiled, video, self.artifacts) for image, name in zip(images, names)]
+        with self._lock:
+            if len(self) + len(jobs) > self.max_size:
+                raise QueueFullError(f"La cola de segmentación está llena ({self.max_size} trabajos)")
+            for job in jobs:
+                self._jobs[job.id] = job
+                (self._long_queue if job.tiled or job.video else self._queue).put(job)
+            self._forget_finished()
+        return jobs
+
+    def submit(self, image, name=None, tiled=False, video=False):
+        return self.submit_many([image], [name], tiled, video)[0]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # Trabajos conservados, los más recientes primero
+    def jobs(self):
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            "queued": len(self),
+            "max_size": self.max_size,
+            "running": statuses.count("running"),
+            "done": statuses.count("done"),
+            "error": statuses.count("error"),
+        }
+
+    # Descarta los trabajos terminados más antiguos por encima de history
+    def _forget_finished(self):
+        excess = len(self._jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.done][:excess]:
+            self._jobs.pop(job_id)._release()
+
+    # Espera el primer trabajo y añade los que ya estén en cola hasta llenar el lote
+    def _collect(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _start(jobs):
+        started = time.perf_counter()
+        for job in jobs:
+            job.status = "running"
+            job.timings["queued_ms"] = (started - job._submitted) * 1000.0
+            metrics.observe("segapp_stage_duration_seconds", started - job._submitted, stage="queue_wait")
+
+    def _run(self):
+        # Cada hilo preprocesa sus lotes en el mismo búfer, sin asignar memoria por imagen
+        buffer = ImageBatchBuffer(self.batch_size)
+        while True:
+            batch = self._collect()
+            self._guarded(batch, self._run_batch, buffer, batch)
+
+    def _run_long(self):
+        while True:
+            job = self._long_queue.get()
+            self._guarded([job], self._run_tiled if job.tiled else self._run_video, job)
+
+    # Marca unos trabajos como en curso y los procesa sin dejar que un error inesperado
+    # termine el hilo (y con él todos los trabajos que quedan en cola): solo fallan los
+    # trabajos aún sin terminar
+    @classmethod
+    def _guarded(cls, jobs, process, *args):
+        try:
+            cls._start(jobs)
+            process(*args)
+        except Exception as e:
+            for job in jobs:
+                if not job.done:
+                    job._finish(error=e)
+
+    # Las imágenes de vista previa se agrupan en una sola llamada al modelo
+    def _run_batch(self, buffer, batch):
+        # Decodificar cada imagen por separado: una imagen dañada solo falla su trabajo
+        ready = []
+        with metrics.timed("preprocess"):
+            for job in batch:
+                start = time.perf_counter()
+                try:
+                    image = job._image
+                    if isinstance(image, (bytes, bytearray)):
+                        image = load_image(BytesIO(image))
+                    prepare_image(image, out=buffer.slot(len(ready)))
+                except Exception as e:
+                    job.timings["decode_ms"] = (time.perf_counter() - start) * 1000.0
+                    job._finish(error=e)
+                    continue
+                job.timings["decode_ms"] = (time.perf_counter() - start) * 1000.0
+                ready.append(job)
+        if not ready:
+            return
+
+        try:
+            version, model = self.model_loader()
+            start = time.perf_counter()
+            with metrics.timed("predict"):
+                masks = predict_masks(model, buffer.buffer[:len(ready)], batch_size=self.batch_size)
+        except Exception as e:
+            for job in ready:
+                job._finish(error=e)
+            return
+        inference_ms = (time.perf_counter() - start) * 1000.0
+        metrics.inc("segapp_images_segmented_total", len(ready))
+
+        for job, mask in zip(ready, masks):
+            job.timings["inference_ms"] = inference_ms
+            job.batch_size = len(ready)
+            job.model_version = version
+            job._finish(mask=mask)
+
+    # Las imágenes en mosaico se procesan de una en una, actualizando el progreso por teselas
+    def _run_tiled(self, job):
+        def progress(done, total):
+            job.progress = done / total
+
+        start = time.perf_counter()
+        try:
+            image = job._image
+            if isinstance(image, (bytes, bytearray)):
+                image = load_image(BytesIO(image), full_resolution=True)
+            job.timings["decode_ms"] = (time.perf_counter() - start) * 1000.0
+            job.model_version, model = self.model_loader()
+            start = time.perf_counter()
+            with metrics.timed("predict_tiled"):
+                mask = predict_tiled(model, image, progress=progress)
+        except Exception as e:
+            job._finish(error=e)
+            return
+        job.timings["inference_ms"] = (time.perf_counter() - start) * 1000.0
+        job.batch_size = 1
+        metrics.inc("segapp_images_segmented_total")
+        job._finish(mask=mask)
+
+    # Los videos se procesan de uno en uno: un hilo decodifica los fotogramas mientras se
+    # segmentan los ya elegidos. cv2 lee el video de un archivo temporal
+    def _run_video(self, job):
+        def progress(done, total):
+            job.progress = done / total
+
+        start = time.perf_counter()
+        path = None
+        try:
+            fd, path = tempfile.mkstemp(suffix=os.path.splitext(job.name or "")[1] or ".mp4")
+            with os.fdopen(fd, 'wb') as file:
+                file.write(job._image)
+            job.model_version, model = self.model_loader()
+            with metrics.timed("predict_video"):
+                result = segment_video(model, path, batch_size=self.batch_size, progress=progress)
+        except Exception as e:
+            job._finish(error=e)
+            return
+        finally:
+            if path is not None:
+                os.remove(path)
+        job.timings["inference_ms"] = (time.perf_counter() - start) * 1000.0
+        job.batch_size = self.batch_size
+        mask, frame = result.pop("mask"), result.pop("frame")
+        job.video_stats = result
+        metrics.inc("segapp_images_segmented_total", len(result["frames"]))
+        job._finish(mask=mask, frame=frame)
@@ -0,0 +1,31 @@
+import numpy as np
+import tensorflow as tf
+
+from segmentation import IMAGE_SIZE, MODEL_PATH
+
+
+# Modelo de Keras con una función de predicción compilada de forma fija. model.predict
+# reconstruye su bucle de inferencia en cada llamada, lo que con lotes pequeños cuesta
+# más que la propia red; la función compilada se traza una sola vez (al calentarla)
+class KerasModel:
+    def __init__(self, model_path=MODEL_PATH):
+        self.model = tf.keras.models.load_model(model_path, compile=False)
+        self._predict = tf.function(
+            self._forward,
+            input_signature=[tf.TensorSpec((None, IMAGE_SIZE[1], IMAGE_SIZE[0], 3), tf.float32)],
+        )
+
+    @tf.autograph.experimental.do_not_convert
+    def _forward(self, batch):
+        return self.model(batch, training=False)
+
+    # Misma interfaz que model.predict: lotes de como máximo batch_size imágenes (por
+    # defecto, todo el lote en una sola llamada; predict_masks ya lo trocea)
+    def predict(self, batch, batch_size=None, **kwargs):
+        batch = np.asarray(batch, dtype=np.float32)
+        if batch_size is None or len(batch) <= batch_size:
+            return self._predict(batch).numpy()
+        return np.concatenate([
+            self._predict(batch[start:start + batch_size]).numpy()
+            for start in range(0, len(batch), batch_size)
+        ])
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from mask_storage import MASK_THRESHOLD, compact_mask_path, load_compact_mask
+from segmentation import IMAGE_SIZE
+
+MASK_STACKS_DIR = "mask_stacks"
+
+# Fecha de la máscara codificada en su nombre (mask_AAAAMMDD_HHMMSS[_ffffff].png)
+_TIMESTAMP_PATTERN = re.compile(r"mask_(\d{8}_\d{6})")
+
+
+# Momento (segundos desde epoch) en que se generó la máscara: el de su nombre o, si no
+# lo lleva, la fecha de modificación del archivo
+def mask_timestamp(path):
+    match = _TIMESTAMP_PATTERN.search(os.path.basename(path))
+    if match:
+        return datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").timestamp()
+    return os.path.getmtime(path)
+
+
+def _mask_exists(path):
+    return os.path.exists(compact_mask_path(path)) or os.path.exists(path)
+
+
+# Máscara binaria (0/1, uint8) al tamaño de la pila. Se lee del formato compacto cuando
+# existe; el PNG solo se decodifica para máscaras anteriores a ese formato
+def load_stack_frame(path, size=IMAGE_SIZE):
+    import cv2  # Solo se importa al añadir máscaras, no al arrancar la aplicación
+
+    compact_path = compact_mask_path(path)
+    if os.path.exists(compact_path):
+        binary = load_compact_mask(compact_path).astype(np.uint8)
+    else:
+        with Image.open(path) as image:
+            binary = (np.asarray(image.convert("L")) > MASK_THRESHOLD).astype(np.uint8)
+
+    # Las máscaras a resolución completa (mosaico) se reducen promediando y umbralizando
+    if binary.shape != (size[1], size[0]):
+        binary = (cv2.resize(binary * 255, size, interpolation=cv2.INTER_AREA) > 127).astype(np.uint8)
+    return binary
+
+
+# Pilas de máscaras por paciente: un archivo binario (T, alto, ancho) uint8 que crece
+# añadiendo al final, leído con np.memmap, y un índice JSON con la ruta y la fecha de
+# cada máscara. Los análisis recorren la pila completa sin decodificar ningún PNG
+class MaskStackStore:
+    def __init__(self, stacks_dir=MASK_STACKS_DIR, size=IMAGE_SIZE):
+        self.stacks_dir = stacks_dir
+        self.size = size
+        self._lock = threading.Lock()
+        os.makedirs(stacks_dir, exist_ok=True)
+
+    def _stack_paths(self, dni):
+        name = hashlib.blake2b(dni.encode(), digest_size=12).hexdigest()
+        base = os.path.join(self.stacks_dir, name)
+        return f"{base}.u8", f"{base}.json"
+
+    def _read_index(self, index_path):
+        try:
+            with open(index_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"paths": [], "timestamps": []}
+
+    # Escribe el índice en un archivo temporal y lo renombra, para no dejarlo a medias
+    def _write_index(self, index_path, index):
+        fd, tmp_path = tempfile.mkstemp(dir=self.stacks_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, index_path)
+
+    def _append(self, dni, image_paths, index):
+        data_path, index_path = self._stack_paths(dni)
+        paths = [path for path in image_paths if _mask_exists(path)]
+        if not paths:
+            return index
+
+        frames = np.stack([load_stack_frame(path, self.size) for path in paths])
+        with open(data_path, 'ab') as file:
+            # Descartar los datos de un añadido anterior que no llegó a registrarse en el índice
+            file.truncate(len(index["paths"]) * frames[0].size)
+            file.write(frames.tobytes())
+
+        index = {
+            "paths": index["paths"] + paths,
+            "timestamps": index["timestamps"] + [mask_timestamp(path) for path in paths],
+        }
+        self._write_index(index_path, index)
+        return index
+
+    # Añade las máscaras al final de la pila del paciente
+    def append(self, dni, image_paths):
+        with self._lock:
+            self._append(dni, image_paths, self._read_index(self._stack_paths(dni)[1]))
+
+    # Borra las pilas de todos los pacientes (al reiniciar la base de datos)
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.stacks_dir):
+                if entry.is_file():
+                    os.remove(entry.path)
+
+    # Pila de las máscaras image_paths (en ese orden) como (máscaras, rutas, fechas), con
+    # las máscaras en un np.memmap de solo lectura (T, alto, ancho). Si la pila guardada no
+    # corresponde a esas máscaras (pacientes anteriores a las pilas, base de datos
+    # reiniciada...), se completa o se reconstruye
+    def load(self, dni, image_paths):
+        with self._lock:
+            data_path, index_path = self._stack_paths(dni)
+            index = self._read_index(index_path)
+            stored = set(index["paths"])
+            wanted = [path for path in image_paths if path in stored or _mask_exists(path)]
+
+            if index["paths"] != wanted[:len(index["paths"])]:
+                index = {"paths": [], "timestamps": []}
+            if len(index["paths"]) < len(wanted):
+                index = self._append(dni, wanted[len(index["paths"]):], index)
+
+        count = len(index["paths"])
+        shape = (count, self.size[1], self.size[0])
+        if count == 0:
+            return np.zeros(shape, dtype=np.uint8), [], np.zeros(0)
+        masks = np.memmap(data_path, dtype=np.uint8, mode='r', shape=shape)
+        return masks, index["paths"], np.asarray(index["timestamps"])
+
+
+# Porcentaje de la imagen ocupado por la herida en cada máscara de la pila
+def area_series(masks):
+    flat = masks.reshape(len(masks), -1)
+    return np.count_nonzero(flat, axis=1) / max(flat.shape[1], 1) * 100
+
+
+# Cambios entre cada visita y la siguiente, en porcentaje de la imagen: tejido que
+# cicatrizó (herida antes, no después) y tejido nuevo de herida (al revés)
+def visit_changes(masks):
+    flat = masks.reshape(len(masks), -1)
+    previous, current = flat[:-1], flat[1:]
+    pixels = max(flat.shape[1], 1)
+    healed = np.count_nonzero(previous > current, axis=1) / pixels * 100
+    new = np.count_nonzero(current > previous, axis=1) / pixels * 100
+    return healed, new
+
+
+# Imagen RGB de los cambios entre dos visitas: verde lo que cicatrizó, rojo el tejido
+# nuevo de herida y gris la herida que sigue abierta
+def change_map(before, after):
+    image = np.zeros(before.shape + (3,), dtype=np.uint8)
+    image[(before > 0) & (after > 0)] = (150, 150, 150)
+    image[before > after] = (46, 204, 113)
+    image[after > before] = (231, 76, 60)
+    return image
+
+
+# Ritmo de cicatrización: pendiente (puntos porcentuales de área por día, negativa si
+# la herida se cierra) del ajuste lineal del área frente al tiempo
+def healing_rate(timestamps, areas):
+    days = (np.asarray(timestamps, dtype=np.float64) - timestamps[0]) / 86400.0
+    if len(areas) < 2 or np.ptp(days) == 0:
+        return None
+    return float(np.polyfit(days, areas, 1)[0])
+
+
+# Días hasta el cierre de la herida extrapolando el ritmo de cicatrización
+def days_to_closure(rate, current_area):
+    if rate is None or rate >= 0:
+        return None
+    return current_area / -rate
@@ -0,0 +1,75 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# Umbral para binarizar el mapa de probabilidad (uint8, 0-255): un píxel es herida si
+# supera el umbral, el mismo criterio que calculate_non_black_pixel_percentage
+MASK_THRESHOLD = 0
+
+# Extensión y cabecera del formato compacto: magia, alto y ancho, seguidos de los
+# bits de la máscara binaria empaquetados con np.packbits y comprimidos con zlib
+COMPACT_MASK_EXTENSION = ".bits"
+COMPACT_MASK_MAGIC = b"SGM1"
+_HEADER = struct.Struct("<4sII")
+
+
+# Ruta del archivo compacto que acompaña al PNG de una máscara
+def compact_mask_path(png_path):
+    return os.path.splitext(png_path)[0] + COMPACT_MASK_EXTENSION
+
+
+# Guarda la máscara binarizada en formato compacto y devuelve la ruta
+def save_compact_mask(mask, path, threshold=MASK_THRESHOLD):
+    binary = mask > threshold
+    height, width = binary.shape
+    payload = zlib.compress(np.packbits(binary).tobytes(), 9)
+    with open(path, 'wb') as file:
+        file.write(_HEADER.pack(COMPACT_MASK_MAGIC, height, width))
+        file.write(payload)
+    return path
+
+
+# Lee una máscara compacta como arreglo booleano (alto, ancho)
+def load_compact_mask(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, height, width = _HEADER.unpack_from(data)
+    if magic != COMPACT_MASK_MAGIC:
+        raise ValueError(f"{path} no es una máscara compacta")
+    bits = np.frombuffer(zlib.decompress(data[_HEADER.size:]), dtype=np.uint8)
+    return np.unpackbits(bits, count=height * width).reshape(height, width).astype(bool)
+
+
+# Métricas de la máscara binarizada: área, número de píxeles, caja envolvente
+# (x, y, ancho, alto), componentes conexas y perímetro en píxeles
+def compute_mask_metrics(mask, threshold=MASK_THRESHOLD):
+    import cv2  # Solo se importa al calcular métricas, no al arrancar la aplicación
+
+    binary = (mask > threshold).astype(np.uint8)
+    pixel_count = int(binary.sum())
+
+    metrics = {
+        "area_percentage": pixel_count / binary.size * 100,
+        "pixel_count": pixel_count,
+        "bbox_x": None,
+        "bbox_y": None,
+        "bbox_width": None,
+        "bbox_height": None,
+        "components": 0,
+        "perimeter": 0.0,
+    }
+    if pixel_count == 0:
+        return metrics
+
+    x, y, width, height = cv2.boundingRect(binary)
+    metrics.update(bbox_x=x, bbox_y=y, bbox_width=width, bbox_height=height)
+
+    component_count, _ = cv2.connectedComponents(binary, connectivity=8)
+    metrics["components"] = component_count - 1  # Sin contar el fondo
+
+    # Incluye los bordes de los huecos interiores de la herida
+    contours, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    metrics["perimeter"] = float(sum(cv2.arcLength(contour, True) for contour in contours))
+    return metrics
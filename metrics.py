@@ -0,0 +1,138 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Tipo de contenido del formato de texto de Prometheus
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Límites (en segundos) de los intervalos de los histogramas de tiempos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Métricas conocidas: nombre -> (tipo, descripción)
+METRICS = {
+    "segapp_stage_duration_seconds": ("histogram", "Duración de cada etapa del flujo de segmentación"),
+    "segapp_errors_total": ("counter", "Excepciones producidas en cada etapa"),
+    "segapp_images_segmented_total": ("counter", "Imágenes que han pasado por el modelo"),
+    "segapp_inference_cache_hits_total": ("counter", "Imágenes servidas desde la caché de inferencia"),
+    "segapp_inference_cache_misses_total": ("counter", "Imágenes que no estaban en la caché de inferencia"),
+    "segapp_model_loads_total": ("counter", "Modelos cargados en este proceso"),
+    "segapp_pdf_reports_total": ("counter", "Informes PDF generados"),
+    "segapp_artifact_evictions_total": ("counter", "Datos de sesión expulsados de memoria (volcados a disco)"),
+    "segapp_artifact_disk_loads_total": ("counter", "Datos de sesión recargados desde disco"),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+# Contadores e histogramas del proceso, seguros entre hilos (todas las sesiones de
+# Streamlit comparten el mismo registro)
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}    # (nombre, etiquetas) -> valor
+        self._histograms = {}  # (nombre, etiquetas) -> [conteos por intervalo, suma, total]
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                histogram[0][idx] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    # Mide la duración de una etapa (como bloque with o como decorador) y cuenta sus errores
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("segapp_errors_total", stage=stage)
+            raise
+        finally:
+            self.observe("segapp_stage_duration_seconds", time.perf_counter() - start, stage=stage)
+
+    # Resumen por etapa para mostrarlo en la aplicación: {etapa: {count, total_s, errors}}
+    def stage_summary(self):
+        with self._lock:
+            summary = {}
+            for (name, label_key), (_, total, count) in self._histograms.items():
+                if name == "segapp_stage_duration_seconds":
+                    stage = dict(label_key)["stage"]
+                    summary[stage] = {"count": count, "total_s": total, "errors": 0}
+            for (name, label_key), value in self._counters.items():
+                if name == "segapp_errors_total":
+                    stage = dict(label_key)["stage"]
+                    summary.setdefault(stage, {"count": 0, "total_s": 0.0, "errors": 0})["errors"] = value
+            return summary
+
+    def counters(self):
+        with self._lock:
+            return {name: value for (name, label_key), value in self._counters.items() if not label_key}
+
+    # Todas las métricas en formato de texto de Prometheus
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(counts), total, count)) for key, (counts, total, count) in self._histograms.items()
+            )
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                metric_type, description = METRICS.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, label_key), value in counters:
+            describe(name)
+            lines.append(f"{name}{_format_labels(label_key)} {value}")
+
+        for (name, label_key), (counts, total, count) in histograms:
+            describe(name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(label_key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(label_key, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(label_key)} {total}")
+            lines.append(f"{name}_count{_format_labels(label_key)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Registro único del proceso
+REGISTRY = MetricsRegistry()
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timed = REGISTRY.timed
+render = REGISTRY.render
@@ -0,0 +1,269 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from inference_cache import file_hash
+from segmentation import IMAGE_SIZE, MODEL_PATH, load_segmentation_model
+
+MODELS_DIR = os.environ.get("SEGAPP_MODELS_DIR", "models")
+
+# Extensión de archivo de cada backend local
+BACKEND_EXTENSIONS = {"keras": ".h5", "tflite": ".tflite"}
+
+# Cada cuánto (segundos) se comprueba si otro proceso cambió la versión activa
+RELOAD_CHECK_INTERVAL = float(os.environ.get("SEGAPP_MODEL_RELOAD_CHECK_S", 2))
+
+
+class BackendMismatchError(Exception):
+    pass
+
+
+def backend_for_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    for backend, backend_extension in BACKEND_EXTENSIONS.items():
+        if extension == backend_extension:
+            return backend
+    raise ValueError(f"Extensión de modelo desconocida: {path}")
+
+
+# Archivo del modelo con el que se inicializa el registro de cada backend
+def default_model_path(backend):
+    if backend == "tflite":
+        from tflite_backend import TFLITE_MODEL_PATH
+
+        return TFLITE_MODEL_PATH
+    return MODEL_PATH
+
+
+# Registro de modelos direccionado por contenido: cada versión se guarda una sola vez
+# como models/<hash><extensión>, y registry.json anota sus datos y la versión activa
+# de cada backend. Un mismo archivo subido dos veces no ocupa espacio adicional
+class ModelRegistry:
+    def __init__(self, models_dir=MODELS_DIR):
+        self.models_dir = models_dir
+        self.index_path = os.path.join(models_dir, "registry.json")
+        self._lock = threading.Lock()
+        os.makedirs(models_dir, exist_ok=True)
+
+    def _read(self):
+        try:
+            with open(self.index_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"versions": {}, "active": {}}
+
+    # Escribe el índice en un archivo temporal y lo renombra, para que otros procesos
+    # nunca lean un índice a medio escribir
+    def _write(self, index):
+        fd, tmp_path = tempfile.mkstemp(dir=self.models_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    # Datos de una versión registrada; KeyError si no existe
+    def entry(self, version):
+        return self._read()["versions"][version]
+
+    def model_path(self, version):
+        entry = self.entry(version)
+        return os.path.join(self.models_dir, f"{version}{entry['extension']}")
+
+    # Añade un archivo de modelo y devuelve su versión (hash del contenido). Se enlaza
+    # en lugar de copiarse cuando el sistema de archivos lo permite
+    def register(self, source_path, name=None):
+        extension = os.path.splitext(source_path)[1].lower()
+        backend = backend_for_path(source_path)
+        version = file_hash(source_path)
+        target_path = os.path.join(self.models_dir, f"{version}{extension}")
+
+        with self._lock:
+            if not os.path.exists(target_path):
+                tmp_path = f"{target_path}.{threading.get_ident()}.tmp"
+                try:
+                    os.link(source_path, tmp_path)
+                except OSError:
+                    shutil.copyfile(source_path, tmp_path)
+                os.replace(tmp_path, target_path)
+
+            index = self._read()
+            if version not in index["versions"]:
+                index["versions"][version] = {
+                    "name": name or os.path.basename(source_path),
+                    "backend": backend,
+                    "extension": extension,
+                    "size": os.path.getsize(target_path),
+                    "registered": time.time(),
+                }
+                self._write(index)
+        return version
+
+    def activate(self, version):
+        with self._lock:
+            index = self._read()
+            entry = index["versions"].get(version)
+            if entry is None:
+                raise KeyError(f"Versión de modelo desconocida: {version}")
+            index["active"][entry["backend"]] = version
+            self._write(index)
+
+    def active_version(self, backend):
+        return self._read()["active"].get(backend)
+
+    # Anota la última versión de un backend que se cargó bien, a la que se vuelve al
+    # arrancar si la activa no carga
+    def mark_loaded(self, version):
+        with self._lock:
+            index = self._read()
+            backend = index["versions"][version]["backend"]
+            loaded = index.setdefault("loaded", {})
+            if loaded.get(backend) != version:
+                loaded[backend] = version
+                self._write(index)
+
+    def loaded_version(self, backend):
+        return self._read().get("loaded", {}).get(backend)
+
+    # Versiones registradas, las más recientes primero
+    def versions(self):
+        index = self._read()
+        entries = [dict(entry, version=version, active=index["active"].get(entry["backend"]) == version)
+                   for version, entry in index["versions"].items()]
+        return sorted(entries, key=lambda entry: entry["registered"], reverse=True)
+
+    # Si el backend no tiene versión activa, registra y activa el modelo por defecto
+    def ensure_active(self, backend, default_path):
+        version = self.active_version(backend)
+        if version is None:
+            version = self.register(default_path)
+            self.activate(version)
+        return version
+
+    def index_mtime(self):
+        try:
+            return os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+
+# Modelo activo de un backend con recarga en caliente: cuando cambia la versión activa
+# del registro, la nueva se carga y se calienta con una predicción de prueba en un hilo
+# de fondo, y solo entonces sustituye a la anterior. Las peticiones en curso conservan
+# su referencia al modelo anterior, así que ninguna se interrumpe. Una versión solo se
+# marca como activa en el registro después de cargarse (ver activate); si aun así la
+# activa no carga al arrancar, se vuelve a la última que cargó bien
+class ModelManager:
+    def __init__(self, registry, backend, default_path=None):
+        self.registry = registry
+        self.backend = backend
+        self.loading = None  # Versión que se está cargando en segundo plano
+        self.last_error = None  # Último fallo al cargar una versión en segundo plano
+        self._lock = threading.Lock()
+        self._checked = time.monotonic()
+        self._index_mtime = registry.index_mtime()
+
+        version = registry.ensure_active(backend, default_path or default_model_path(backend))
+        try:
+            model = self._load(version)
+        except Exception:
+            fallback = registry.loaded_version(backend)
+            if fallback is None or fallback == version:
+                raise
+            version, model = fallback, self._load(fallback)
+            registry.activate(version)
+            self._index_mtime = registry.index_mtime()
+        self._current = (version, model)
+
+    # (versión, modelo) activos, leídos juntos para que la versión registrada con cada
+    # máscara sea la del modelo que la generó
+    def current(self):
+        self._check_for_update()
+        return self._current
+
+    @property
+    def model(self):
+        return self.current()[1]
+
+    @property
+    def version(self):
+        return self.current()[0]
+
+    def _load(self, version):
+        with metrics.timed("load_model"):
+            model = load_segmentation_model(self.backend, self.registry.model_path(version))
+            # Calentamiento: la primera predicción construye el grafo
+            model.predict(np.zeros((1, IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32), verbose=0)
+        metrics.inc("segapp_model_loads_total")
+        self.registry.mark_loaded(version)
+        return model
+
+    # Detecta cambios de la versión activa hechos desde otro proceso (por ejemplo,
+    # uploader.py) sin leer el índice en cada petición
+    def _check_for_update(self):
+        now = time.monotonic()
+        if now - self._checked < RELOAD_CHECK_INTERVAL:
+            return
+        self._checked = now
+        mtime = self.registry.index_mtime()
+        if mtime == self._index_mtime:
+            return
+        self._index_mtime = mtime
+        self.reload()
+
+    # Carga en segundo plano la versión activa del registro si no es la actual
+    def reload(self):
+        version = self.registry.active_version(self.backend)
+        with self._lock:
+            if version is None or version == self._current[0] or version == self.loading:
+                return None
+            self.loading = version
+        thread = threading.Thread(target=self._swap, args=(version,), daemon=True)
+        thread.start()
+        return thread
+
+    # Carga y calienta una versión registrada en segundo plano y, solo si lo consigue, la
+    # marca como activa en el registro (los demás procesos la recogen entonces). Lanza
+    # KeyError si la versión no existe y BackendMismatchError si es de otro backend; si
+    # no carga, el error queda en last_error
+    def activate(self, version):
+        backend = self.registry.entry(version)["backend"]
+        if backend != self.backend:
+            raise BackendMismatchError(f"La versión {version} es un modelo {backend}, no {self.backend}")
+        with self._lock:
+            if version == self._current[0] or version == self.loading:
+                return None
+            self.loading = version
+        thread = threading.Thread(target=self._swap, args=(version, True), daemon=True)
+        thread.start()
+        return thread
+
+    def _swap(self, version, activate=False):
+        try:
+            model = self._load(version)
+        except Exception as e:
+            # Si la versión nueva no carga, se sigue sirviendo la anterior y el error se
+            # anota para consultarlo (por ejemplo, en GET /api/models)
+            with self._lock:
+                if self.loading == version:
+                    self.loading = None
+                self.last_error = {"version": version, "error": f"{type(e).__name__}: {e}"}
+            return
+
+        with self._lock:
+            if activate:
+                # Si mientras tanto se pidió otra versión, esta ya no se activa
+                if self.loading != version:
+                    return
+                self.registry.activate(version)
+                self._index_mtime = self.registry.index_mtime()
+            if self.loading == version:
+                self.loading = None
+            self.last_error = None
+            # Si mientras tanto se activó otra versión, esta ya no se usa
+            if self.registry.active_version(self.backend) == version:
+                self._current = (version, model)
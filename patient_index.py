@@ -0,0 +1,142 @@
+import bisect
+import threading
+import unicodedata
+
+
+# Normaliza un texto para la búsqueda: minúsculas y sin tildes
+def normalize(text):
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+# Índice en memoria de pacientes: búsqueda O(1) por DNI y por prefijo o subcadena
+# en nombre y DNI, actualizado de forma incremental
+class PatientIndex:
+    def __init__(self, patients=()):
+        self._lock = threading.Lock()
+        self._reset()
+
+        # Carga inicial en bloque: un solo ordenamiento y una sola concatenación
+        texts = []
+        offset = 0
+        for patient in patients:
+            dni = patient['dni']
+            if dni in self._patients:
+                continue
+            self._patients[dni] = patient
+            self._order.append(dni)
+            self._prefix_keys.extend((key, dni) for key in self._keys(patient))
+            text = self._entry_text(patient)
+            texts.append(text)
+            self._text_starts.append(offset)
+            offset += len(text)
+        self._prefix_keys.sort()
+        self._text = "".join(texts)
+        self._text_length = offset
+
+    def _reset(self):
+        self._patients = {}      # DNI -> paciente
+        self._order = []         # DNIs en orden de inserción
+        self._prefix_keys = []   # Lista ordenada de (clave, DNI) con el DNI y cada palabra del nombre
+        self._pending_keys = []  # Claves añadidas que aún no se han ordenado en _prefix_keys
+        self._text = ""          # "dni nombre\n" de todos los pacientes, para buscar subcadenas
+        self._text_starts = []   # Posición de cada paciente dentro de _text
+        self._pending_text = []  # Textos añadidos que aún no se han unido a _text
+        self._text_length = 0    # Longitud de _text con los textos pendientes
+
+    def __len__(self):
+        return len(self._order)
+
+    # Claves de búsqueda por prefijo: el DNI y cada palabra del nombre
+    @staticmethod
+    def _keys(patient):
+        return [normalize(patient['dni'])] + normalize(patient['name']).split()
+
+    @staticmethod
+    def _entry_text(patient):
+        return f"{normalize(patient['dni'])} {normalize(patient['name'])}\n"
+
+    def _add(self, patient):
+        dni = patient['dni']
+        self._patients[dni] = patient
+        self._order.append(dni)
+
+        # Las claves y el texto se incorporan en la siguiente búsqueda, no en cada alta
+        self._pending_keys.extend((key, dni) for key in self._keys(patient))
+        text = self._entry_text(patient)
+        self._text_starts.append(self._text_length)
+        self._pending_text.append(text)
+        self._text_length += len(text)
+
+    # _prefix_keys con las claves pendientes ya ordenadas: el ordenamiento aprovecha que
+    # ambas partes ya vienen ordenadas, así que cuesta O(N) por búsqueda, no por alta
+    def _search_keys(self):
+        if self._pending_keys:
+            self._pending_keys.sort()
+            self._prefix_keys.extend(self._pending_keys)
+            self._prefix_keys.sort()
+            self._pending_keys = []
+        return self._prefix_keys
+
+    # _text con los textos pendientes ya unidos (una sola concatenación por búsqueda)
+    def _search_text(self):
+        if self._pending_text:
+            self._text = "".join([self._text] + self._pending_text)
+            self._pending_text = []
+        return self._text
+
+    # Añade un paciente nuevo; devuelve False si el DNI ya estaba indexado
+    def add(self, patient):
+        with self._lock:
+            if patient['dni'] in self._patients:
+                return False
+            self._add(patient)
+            return True
+
+    def get(self, dni):
+        with self._lock:
+            return self._patients.get(dni)
+
+    # Registra una segmentación nueva (y sus métricas, si las hay) en el paciente indexado
+    def add_segmentation(self, dni, image_path, metrics=None):
+        with self._lock:
+            patient = self._patients.get(dni)
+            if patient is None:
+                return False
+            patient.setdefault('segmentations', []).append(image_path)
+            if metrics is not None:
+                patient.setdefault('metrics', {})[image_path] = metrics
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def _prefix_matches(self, query):
+        keys = self._search_keys()
+        start = bisect.bisect_left(keys, (query,))
+        end = bisect.bisect_left(keys, (query + "\uffff",), start)
+        return [dni for _, dni in keys[start:end]]
+
+    def _substring_matches(self, query):
+        matches = []
+        text = self._search_text()
+        position = text.find(query)
+        while position != -1:
+            entry = bisect.bisect_right(self._text_starts, position) - 1
+            matches.append(self._order[entry])
+            # Continuar desde el paciente siguiente para no repetir coincidencias
+            next_start = self._text_starts[entry + 1] if entry + 1 < len(self._text_starts) else len(text)
+            position = text.find(query, next_start)
+        return matches
+
+    # Devuelve una página de resultados y el total: primero las coincidencias por
+    # prefijo (en orden alfabético) y luego las demás coincidencias por subcadena
+    def search(self, query, offset=0, limit=20):
+        query = normalize(query).strip()
+        with self._lock:
+            if not query:
+                dnis = self._order
+            else:
+                dnis = list(dict.fromkeys(self._prefix_matches(query) + self._substring_matches(query)))
+            return [self._patients[dni] for dni in dnis[offset:offset + limit]], len(dnis)
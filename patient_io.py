@@ -0,0 +1,295 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from patients_db import METRIC_COLUMNS, PATIENTS_DB_PATH, PatientStore
+
+# Valores de sexo admitidos (los del formulario de registro)
+SEX_OPTIONS = ("Masculino", "Femenino", "Otro")
+
+# Pacientes insertados por transacción en la importación
+IMPORT_BATCH_SIZE = int(os.environ.get("SEGAPP_IMPORT_BATCH_SIZE", 1000))
+
+# Reintentos de un lote que choca con los DNI insertados a la vez por otro proceso
+IMPORT_RETRIES = 3
+
+PATIENT_FIELDS = ("dni", "name", "age", "sex")
+
+# Columnas de la exportación CSV: una fila por segmentación, repitiendo los datos del
+# paciente (una sola fila con la segmentación vacía si no tiene ninguna)
+EXPORT_FIELDS = PATIENT_FIELDS + ("image_path", "compact_path", "model_version") + METRIC_COLUMNS
+
+REJECT_FIELDS = ("line", "dni", "reason")
+
+
+# Registros de un archivo de pacientes como (línea, registro), leídos en flujo: CSV con
+# cabecera (ver EXPORT_FIELDS; las filas seguidas del mismo DNI con image_path son las
+# segmentaciones de un mismo paciente) o JSONL con un paciente por línea en el formato
+# de get_patient. Un .json (el formato del antiguo patients_data.json) se carga entero
+def iter_patient_records(file, fmt):
+    if fmt == "csv":
+        yield from _iter_csv_records(file)
+    elif fmt == "jsonl":
+        for line_number, line in enumerate(file, start=1):
+            if line.strip():
+                yield line_number, _parse_json_line(line)
+    elif fmt == "json":
+        for position, record in enumerate(json.load(file), start=1):
+            yield position, record
+    else:
+        raise ValueError(f"Formato no soportado: {fmt}")
+
+
+def _parse_json_line(line):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return ValueError(f"JSON no válido: {e}")
+
+
+def _iter_csv_records(file):
+    record, record_line = None, None
+    # La línea 1 es la cabecera
+    for line_number, row in enumerate(csv.DictReader(file), start=2):
+        dni = (row.get("dni") or "").strip()
+        if record is not None and dni and dni == record.get("dni") and row.get("image_path"):
+            _add_segmentation_row(record, row)
+            continue
+        if record is not None:
+            yield record_line, record
+        record, record_line = {field: row.get(field) for field in PATIENT_FIELDS}, line_number
+        record["dni"] = dni
+        if row.get("image_path"):
+            _add_segmentation_row(record, row)
+    if record is not None:
+        yield record_line, record
+
+
+def _add_segmentation_row(record, row):
+    path = row["image_path"]
+    record.setdefault("segmentations", []).append(path)
+    if row.get("area_percentage"):
+        metrics = {column: row.get(column) for column in METRIC_COLUMNS}
+        metrics["compact_path"] = row.get("compact_path") or None
+        metrics["model_version"] = row.get("model_version") or None
+        record.setdefault("metrics", {})[path] = metrics
+
+
+# Normaliza un registro importado al formato de PatientStore; lanza ValueError con el
+# motivo del rechazo si no es válido
+def validate_patient(record):
+    if isinstance(record, Exception):
+        raise ValueError(str(record))
+    if not isinstance(record, dict):
+        raise ValueError("El registro no es un objeto")
+
+    dni = str(record.get("dni") or "").strip()
+    name = str(record.get("name") or "").strip()
+    if not dni:
+        raise ValueError("Falta el DNI")
+    if not name:
+        raise ValueError("Falta el nombre")
+
+    try:
+        age = int(str(record.get("age")).strip())
+    except ValueError:
+        raise ValueError(f"Edad no válida: {record.get('age')!r}")
+    if not 0 <= age <= 150:
+        raise ValueError(f"Edad fuera de rango: {age}")
+
+    sex = str(record.get("sex") or "").strip().capitalize()
+    if sex not in SEX_OPTIONS:
+        raise ValueError(f"Sexo no válido: {record.get('sex')!r}")
+
+    segmentations = record.get("segmentations") or []
+    if not isinstance(segmentations, list) or not all(isinstance(path, str) for path in segmentations):
+        raise ValueError("Las segmentaciones deben ser una lista de rutas")
+    metrics = record.get("metrics") or {}
+    try:
+        metrics = {
+            path: dict(values, **{column: _metric_value(values[column]) for column in METRIC_COLUMNS})
+            for path, values in metrics.items() if path in segmentations
+        }
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError("Métricas de segmentación no válidas")
+
+    return {
+        "dni": dni,
+        "name": name,
+        "age": age,
+        "sex": sex,
+        "segmentations": segmentations,
+        "metrics": metrics,
+    }
+
+
+# Valor numérico de una métrica; las vacías (el recuadro de una máscara sin herida, que
+# el CSV exporta como "") se importan como None
+def _metric_value(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+# Inserta un lote y devuelve los DNI ya registrados. Si otro proceso registra alguno de
+# estos DNI entre la comprobación y la inserción, el lote se deshace entero y se reintenta
+# con los DNI actualizados; si vuelve a ocurrir, se insertan de uno en uno
+def _add_batch(store, patients, retries=IMPORT_RETRIES):
+    for _ in range(retries):
+        try:
+            return store.add_patients(patients)
+        except sqlite3.IntegrityError:
+            continue
+    existing = set()
+    for patient in patients:
+        try:
+            existing |= store.add_patients([patient])
+        except sqlite3.IntegrityError:
+            existing.add(patient["dni"])
+    return existing
+
+
+# Importa en flujo los registros (línea, registro) de iter_patient_records: valida cada
+# uno, descarta los DNI repetidos en el archivo o ya registrados e inserta el resto en
+# transacciones de batch_size pacientes. Los rechazos se pasan a reject(línea, dni,
+# motivo) y progress(leídos) se llama tras cada lote. Devuelve los totales
+def import_patients(store, records, batch_size=IMPORT_BATCH_SIZE, reject=None, progress=None):
+    summary = {"read": 0, "imported": 0, "rejected": 0}
+    # Solo se guardan los DNI vistos en el archivo, no los registros
+    seen = set()
+    batch = []
+
+    def rejected(line, dni, reason):
+        summary["rejected"] += 1
+        if reject is not None:
+            reject(line, dni, reason)
+
+    def flush():
+        existing = _add_batch(store, [patient for _, patient in batch])
+        for line, patient in batch:
+            if patient["dni"] in existing:
+                rejected(line, patient["dni"], "DNI ya registrado")
+        summary["imported"] += len(batch) - len(existing)
+        batch.clear()
+        if progress is not None:
+            progress(summary["read"])
+
+    for line, record in records:
+        summary["read"] += 1
+        try:
+            patient = validate_patient(record)
+        except ValueError as e:
+            dni = record.get("dni") if isinstance(record, dict) else None
+            rejected(line, dni, str(e))
+            continue
+        if patient["dni"] in seen:
+            rejected(line, patient["dni"], "DNI repetido en el archivo")
+            continue
+        seen.add(patient["dni"])
+        batch.append((line, patient))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return summary
+
+
+# Escribe los pacientes en flujo en CSV (ver EXPORT_FIELDS) o JSONL (un paciente por
+# línea, con sus segmentaciones y métricas); devuelve el número de pacientes escritos
+def export_patients(patients, file, fmt):
+    count = 0
+    if fmt == "jsonl":
+        for patient in patients:
+            file.write(json.dumps(patient, ensure_ascii=False) + "\n")
+            count += 1
+    elif fmt == "csv":
+        writer = csv.DictWriter(file, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for patient in patients:
+            row = {field: patient[field] for field in PATIENT_FIELDS}
+            if not patient["segmentations"]:
+                writer.writerow(row)
+            for path in patient["segmentations"]:
+                metrics = patient["metrics"].get(path) or {}
+                writer.writerow(dict(row, image_path=path, **metrics))
+            count += 1
+    else:
+        raise ValueError(f"Formato no soportado: {fmt}")
+    return count
+
+
+# Formato según la extensión del archivo (csv, jsonl o json)
+def file_format(path):
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension not in ("csv", "jsonl", "json"):
+        raise ValueError(f"Extensión no soportada: {path} (usa .csv, .jsonl o .json)")
+    return extension
+
+
+# Abre un archivo subido (bytes) como texto para leerlo en flujo
+def open_text(binary_file):
+    return io.TextIOWrapper(binary_file, encoding="utf-8-sig", newline="")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importar y exportar pacientes en bloque")
+    parser.add_argument("--db", default=PATIENTS_DB_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Importar pacientes desde CSV, JSONL o JSON")
+    import_parser.add_argument("inputs", nargs="+", help="Archivos .csv, .jsonl o .json")
+    import_parser.add_argument("--rejects", default="rejected_patients.csv",
+                               help="CSV con las filas rechazadas y el motivo ('' para no guardarlo)")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+
+    export_parser = subparsers.add_parser("export", help="Exportar pacientes y segmentaciones a CSV o JSONL")
+    export_parser.add_argument("output", help="Archivo .csv o .jsonl ('-' para JSONL por la salida estándar)")
+    args = parser.parse_args()
+
+    store = PatientStore(args.db)
+    if args.command == "export":
+        if args.output == "-":
+            count = export_patients(store.iter_patients(), sys.stdout, "jsonl")
+        else:
+            with open(args.output, 'w', newline='', encoding="utf-8") as file:
+                count = export_patients(store.iter_patients(), file, file_format(args.output))
+        print(f"{count} pacientes exportados", file=sys.stderr)
+        store.close()
+        return
+
+    rejects_file = open(args.rejects, 'w', newline='', encoding="utf-8") if args.rejects else None
+    try:
+        reject = None
+        if rejects_file is not None:
+            rejects_writer = csv.writer(rejects_file)
+            rejects_writer.writerow(("file",) + REJECT_FIELDS)
+
+        start = time.perf_counter()
+
+        def progress(count):
+            elapsed = time.perf_counter() - start
+            print(f"\r{count} filas · {count / elapsed:.0f} filas/s", end="", file=sys.stderr)
+
+        for path in args.inputs:
+            if rejects_file is not None:
+                def reject(line, dni, reason, path=path):
+                    rejects_writer.writerow((path, line, dni, reason))
+
+            with open(path, newline='', encoding="utf-8-sig") as file:
+                summary = import_patients(store, iter_patient_records(file, file_format(path)),
+                                          batch_size=args.batch_size, reject=reject, progress=progress)
+            print(f"\n{path}: {summary['imported']} importados, {summary['rejected']} rechazados "
+                  f"de {summary['read']}", file=sys.stderr)
+    finally:
+        if rejects_file is not None:
+            rejects_file.close()
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
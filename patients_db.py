@@ -0,0 +1,373 @@
+import json
+import os
+import sqlite3
+import threading
+
+from metrics import timed
+
+PATIENTS_DB_PATH = "patients.db"
+JSON_DATABASE_PATH = "patients_data.json"
+
+# Sincronización de SQLite: con FULL, cada escritura confirmada es un único añadido al
+# registro WAL seguido de fsync, así que sobrevive también a un corte de corriente
+DB_SYNCHRONOUS = os.environ.get("SEGAPP_DB_SYNCHRONOUS", "FULL")
+
+# Tamaño del registro WAL a partir del cual un hilo de fondo lo vuelca en la base de
+# datos y lo trunca (0 para dejar el volcado automático de SQLite en cada escritura)
+WAL_CHECKPOINT_BYTES = int(os.environ.get("SEGAPP_WAL_CHECKPOINT_BYTES", 4 * 1024 * 1024))
+
+# Cada cuánto (segundos) comprueba el hilo de fondo el tamaño del WAL
+WAL_CHECK_INTERVAL = float(os.environ.get("SEGAPP_WAL_CHECK_INTERVAL_S", 5))
+
+# Espera máxima (milisegundos) de una operación a que otro proceso libere la base de datos
+BUSY_TIMEOUT_MS = 5000
+
+# Versión del esquema guardada en PRAGMA user_version
+SCHEMA_VERSION = 3
+
+# DNI por consulta al comprobar los ya registrados: las versiones de SQLite anteriores a
+# la 3.32 no admiten más de 999 parámetros por sentencia
+_DNI_LOOKUP_CHUNK = 500
+
+# Métricas precalculadas de cada máscara (ver mask_storage.compute_mask_metrics)
+METRIC_COLUMNS = (
+    "area_percentage",
+    "pixel_count",
+    "bbox_x",
+    "bbox_y",
+    "bbox_width",
+    "bbox_height",
+    "components",
+    "perimeter",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients
+    (id INTEGER PRIMARY KEY,
+     dni TEXT,
+     name TEXT,
+     age INTEGER,
+     sex TEXT);
+CREATE TABLE IF NOT EXISTS segmentations
+    (id INTEGER PRIMARY KEY,
+     patient_id INTEGER,
+     image_path TEXT,
+     FOREIGN KEY(patient_id) REFERENCES patients(id));
+CREATE INDEX IF NOT EXISTS idx_segmentations_patient_id ON segmentations(patient_id);
+CREATE TABLE IF NOT EXISTS mask_metrics
+    (image_path TEXT PRIMARY KEY,
+     compact_path TEXT,
+     area_percentage REAL,
+     pixel_count INTEGER,
+     bbox_x INTEGER,
+     bbox_y INTEGER,
+     bbox_width INTEGER,
+     bbox_height INTEGER,
+     components INTEGER,
+     perimeter REAL,
+     model_version TEXT);
+"""
+
+
+# Almacén de pacientes sobre SQLite: cada operación lee o escribe solo las filas afectadas.
+# Las escrituras se añaden al registro WAL (que SQLite reproduce al abrir la base de datos
+# tras una caída) y un hilo de fondo lo compacta en la base de datos al superar
+# checkpoint_bytes, en lugar de hacerlo SQLite dentro de la escritura que lo llena
+class PatientStore:
+    def __init__(self, path=PATIENTS_DB_PATH, checkpoint_bytes=WAL_CHECKPOINT_BYTES):
+        self.path = path
+        self.checkpoint_bytes = checkpoint_bytes
+        # Una conexión compartida por todas las sesiones, protegida por un lock
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            if checkpoint_bytes:
+                self._conn.execute("PRAGMA wal_autocheckpoint=0")
+            self._upgrade_schema()
+
+        self._stop = threading.Event()
+        self._checkpoint_thread = None
+        if checkpoint_bytes:
+            self._checkpoint_thread = threading.Thread(target=self._checkpoint_loop, daemon=True)
+            self._checkpoint_thread.start()
+
+    def wal_size(self):
+        try:
+            return os.path.getsize(f"{self.path}-wal")
+        except FileNotFoundError:
+            return 0
+
+    # Vuelca el WAL en la base de datos y lo trunca. Devuelve False si no pudo completarse
+    # porque otro proceso seguía leyendo del WAL (se reintenta en la siguiente comprobación).
+    # Usa la conexión compartida: desde otra conexión, truncar el WAL cambiaría data_version
+    # y el índice de pacientes se reconstruiría sin necesidad. No espera a los lectores
+    # (busy_timeout=0), porque mientras tanto el lock bloquearía al resto de sesiones
+    def checkpoint(self):
+        with self._lock, timed("db_checkpoint"):
+            self._conn.execute("PRAGMA busy_timeout=0")
+            try:
+                busy, _, _ = self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            finally:
+                self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return not busy
+
+    def _checkpoint_loop(self):
+        while not self._stop.wait(WAL_CHECK_INTERVAL):
+            if self.wal_size() >= self.checkpoint_bytes:
+                try:
+                    self.checkpoint()
+                except sqlite3.Error:
+                    pass  # Ya contado en segapp_errors_total; se reintenta en la siguiente comprobación
+
+    def close(self):
+        self._stop.set()
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+        with self._lock:
+            self._conn.close()
+
+    def _upgrade_schema(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        # Crea las tablas e índices que falten (la versión 2 añade mask_metrics)
+        self._conn.executescript(SCHEMA)
+
+        # La versión 3 guarda la versión del modelo que generó cada máscara
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(mask_metrics)")}
+        if "model_version" not in columns:
+            self._conn.execute("ALTER TABLE mask_metrics ADD COLUMN model_version TEXT")
+
+        if version < 1:
+            with self._conn:
+                # Unificar DNIs duplicados antes de crear el índice único: se conserva la
+                # fila más antigua y se le reasignan las segmentaciones de las demás
+                self._conn.execute(
+                    """
+                    UPDATE segmentations SET patient_id = (
+                        SELECT MIN(keep.id) FROM patients AS keep
+                        WHERE keep.dni = (SELECT dni FROM patients WHERE id = segmentations.patient_id)
+                    )
+                    """
+                )
+                self._conn.execute(
+                    "DELETE FROM patients WHERE id NOT IN (SELECT MIN(id) FROM patients GROUP BY dni)"
+                )
+                self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_patients_dni ON patients(dni)")
+
+        self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    # Migración única desde patients_data.json; devuelve el número de pacientes importados
+    @timed("db_migrate")
+    def migrate_from_json(self, json_path=JSON_DATABASE_PATH):
+        if not os.path.exists(json_path):
+            return 0
+
+        with open(json_path, 'r') as file:
+            patients = json.load(file)
+
+        imported = 0
+        with self._lock, self._conn:
+            for patient in patients:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO patients (dni, name, age, sex) VALUES (?, ?, ?, ?)",
+                    (patient['dni'], patient['name'], patient['age'], patient['sex']),
+                )
+                if cursor.rowcount == 0:
+                    continue
+                self._conn.executemany(
+                    "INSERT INTO segmentations (patient_id, image_path) VALUES (?, ?)",
+                    [(cursor.lastrowid, path) for path in patient.get('segmentations', [])],
+                )
+                imported += 1
+
+        # Renombrar el JSON para que la migración no vuelva a ejecutarse
+        os.replace(json_path, json_path + ".migrated")
+        return imported
+
+    # Devuelve el paciente con ese DNI (mismo formato que el antiguo JSON) o None.
+    # Las métricas precalculadas de cada máscara van en patient['metrics'][ruta]
+    @timed("db_get_patient")
+    def get_patient(self, dni):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, dni, name, age, sex FROM patients WHERE dni = ?", (dni,)
+            ).fetchone()
+            if row is None:
+                return None
+            segmentations = self._conn.execute(
+                f"""
+                SELECT s.image_path, {_METRIC_SELECT}
+                FROM segmentations AS s LEFT JOIN mask_metrics AS m ON m.image_path = s.image_path
+                WHERE s.patient_id = ? ORDER BY s.id
+                """,
+                (row['id'],),
+            ).fetchall()
+
+        patient = _patient_from_row(row)
+        for seg in segmentations:
+            _append_segmentation(patient, seg)
+        return patient
+
+    # Recorre todos los pacientes con sus segmentaciones en una sola consulta. Las filas se
+    # leen a medida que se consumen, desde una conexión de solo lectura propia (en modo WAL
+    # lee una instantánea sin bloquear las escrituras), así que ni se carga la tabla entera
+    # en memoria ni se retiene el lock compartido mientras dura el recorrido
+    def iter_patients(self):
+        conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(
+                f"""
+                SELECT p.id, p.dni, p.name, p.age, p.sex, s.image_path, {_METRIC_SELECT}
+                FROM patients AS p
+                LEFT JOIN segmentations AS s ON s.patient_id = p.id
+                LEFT JOIN mask_metrics AS m ON m.image_path = s.image_path
+                ORDER BY p.id, s.id
+                """
+            )
+
+            patient = None
+            for row in rows:
+                if patient is None or patient_id != row['id']:
+                    if patient is not None:
+                        yield patient
+                    patient_id = row['id']
+                    patient = _patient_from_row(row)
+                if row['image_path'] is not None:
+                    _append_segmentation(patient, row)
+            if patient is not None:
+                yield patient
+        finally:
+            conn.close()
+
+    # Inserta un lote de pacientes (mismo formato que get_patient, con sus segmentaciones
+    # y métricas opcionales) en una sola transacción. Los DNI ya registrados se comprueban
+    # contra el índice único (en consultas de como máximo _DNI_LOOKUP_CHUNK DNI) y no se
+    # insertan; los devuelve
+    @timed("db_add_patients")
+    def add_patients(self, patients):
+        if not patients:
+            return set()
+        dnis = [patient['dni'] for patient in patients]
+        with self._lock, self._conn:
+            existing = set()
+            for start in range(0, len(dnis), _DNI_LOOKUP_CHUNK):
+                chunk = dnis[start:start + _DNI_LOOKUP_CHUNK]
+                existing.update(row[0] for row in self._conn.execute(
+                    f"SELECT dni FROM patients WHERE dni IN ({', '.join('?' * len(chunk))})", chunk
+                ))
+            new = [patient for patient in patients if patient['dni'] not in existing]
+            self._conn.executemany(
+                "INSERT INTO patients (dni, name, age, sex) VALUES (?, ?, ?, ?)",
+                [(patient['dni'], patient['name'], patient['age'], patient['sex']) for patient in new],
+            )
+            self._conn.executemany(
+                "INSERT INTO segmentations (patient_id, image_path) SELECT id, ? FROM patients WHERE dni = ?",
+                [(path, patient['dni']) for patient in new for path in patient.get('segmentations', [])],
+            )
+            columns = ("image_path", "compact_path", "model_version") + METRIC_COLUMNS
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO mask_metrics ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [
+                    (path, metrics.get("compact_path"), metrics.get("model_version"))
+                    + tuple(metrics[column] for column in METRIC_COLUMNS)
+                    for patient in new for path, metrics in patient.get('metrics', {}).items()
+                ],
+            )
+        return existing
+
+    # Inserta un paciente nuevo; devuelve False si el DNI ya existe
+    @timed("db_add_patient")
+    def add_patient(self, name, age, sex, dni):
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT INTO patients (dni, name, age, sex) VALUES (?, ?, ?, ?)",
+                    (dni, name, age, sex),
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    # Asigna una segmentación al paciente; devuelve False si no existe el DNI
+    @timed("db_add_segmentation")
+    def add_segmentation(self, dni, image_path):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO segmentations (patient_id, image_path) SELECT id, ? FROM patients WHERE dni = ?",
+                (image_path, dni),
+            )
+        return cursor.rowcount > 0
+
+    # Guarda las métricas de una máscara al guardarla, antes de asignarla a un paciente,
+    # junto con la versión del modelo (hash del registro) que la generó
+    @timed("db_save_mask_metrics")
+    def save_mask_metrics(self, image_path, metrics, compact_path=None, model_version=None):
+        columns = ("image_path", "compact_path", "model_version") + METRIC_COLUMNS
+        values = (image_path, compact_path, model_version) + tuple(metrics[column] for column in METRIC_COLUMNS)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO mask_metrics ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                values,
+            )
+
+    # Métricas de una máscara guardada, o None si no se calcularon
+    def get_mask_metrics(self, image_path):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {_METRIC_SELECT} FROM mask_metrics AS m WHERE m.image_path = ?", (image_path,)
+            ).fetchone()
+        return _metrics_from_row(row) if row is not None else None
+
+    # Versión de los datos: cambia cuando otra conexión (otro proceso) confirma cambios,
+    # no con las escrituras hechas a través de este almacén
+    def data_version(self):
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def count_patients(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    # Borra todos los pacientes y sus segmentaciones
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM segmentations")
+            self._conn.execute("DELETE FROM mask_metrics")
+            self._conn.execute("DELETE FROM patients")
+
+
+_METRIC_SELECT = ", ".join(f"m.{column}" for column in ("compact_path", "model_version") + METRIC_COLUMNS)
+
+
+def _patient_from_row(row):
+    return {
+        "name": row['name'],
+        "age": row['age'],
+        "sex": row['sex'],
+        "dni": row['dni'],
+        "segmentations": [],
+        "metrics": {},
+    }
+
+
+def _metrics_from_row(row):
+    if row['area_percentage'] is None:
+        return None
+    metrics = {column: row[column] for column in METRIC_COLUMNS}
+    metrics["compact_path"] = row['compact_path']
+    metrics["model_version"] = row['model_version']
+    return metrics
+
+
+def _append_segmentation(patient, row):
+    patient['segmentations'].append(row['image_path'])
+    metrics = _metrics_from_row(row)
+    if metrics is not None:
+        patient['metrics'][row['image_path']] = metrics
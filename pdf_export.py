@@ -0,0 +1,111 @@
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+# Procesos que generan informes en paralelo en la exportación masiva
+PDF_EXPORT_WORKERS = int(os.environ.get("SEGAPP_PDF_WORKERS", os.cpu_count() or 1))
+
+# Alto que ocupa cada segmentación en la página: etiqueta + imagen + margen
+_SEGMENTATION_HEIGHT = 240
+
+
+# Genera el PDF del paciente en memoria y devuelve sus bytes
+def export_patient_to_pdf(patient):
+    # ReportLab se importa con el primer informe, no al arrancar la aplicación
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+
+    # Información del paciente
+    c.drawString(100, 750, f"Nombre: {patient['name']}")
+    c.drawString(100, 730, f"Edad: {patient['age']}")
+    c.drawString(100, 710, f"Sexo: {patient['sex']}")
+    c.drawString(100, 690, f"DNI: {patient['dni']}")
+
+    # Espacio para las segmentaciones
+    y_position = 650
+    for idx, seg_path in enumerate(patient.get("segmentations", [])):
+        # Pasar a una página nueva si la segmentación no cabe en la actual
+        if y_position - _SEGMENTATION_HEIGHT < 50:
+            c.showPage()
+            y_position = 750
+
+        # Las métricas precalculadas evitan recalcular el área a partir de la imagen
+        metrics = patient.get("metrics", {}).get(seg_path)
+        label = f"Segmentación {idx + 1}:"
+        if metrics is not None:
+            label += f" área {metrics['area_percentage']:.2f}%, {metrics['components']} región(es)"
+        c.drawString(100, y_position, label)
+        y_position -= 20
+
+        # Insertar la imagen segmentada directamente desde su archivo, sin copias temporales
+        try:
+            c.drawImage(ImageReader(seg_path), 100, y_position - 200, width=200, height=200)
+        except OSError:
+            c.drawString(100, y_position - 20, f"Imagen no disponible: {seg_path}")
+        y_position -= 220
+
+    c.save()
+    return buffer.getvalue()
+
+
+# Nombre del informe dentro del ZIP
+def report_filename(patient):
+    name = re.sub(r"[^\w.-]+", "_", patient['name']).strip("_")
+    return f"{patient['dni']}_{name}.pdf"
+
+
+# Genera los informes de varios pacientes en procesos paralelos y los escribe en un
+# único ZIP a medida que terminan. Solo se mantienen en vuelo unos pocos informes
+# por proceso, de modo que la memoria no crece con el número de pacientes. Los procesos
+# se arrancan con spawn: un fork de la aplicación copiaría los locks de sus hilos (modelo,
+# cola de trabajos, servidor) y podría bloquearse
+def export_patients_to_zip(patients, output, workers=PDF_EXPORT_WORKERS):
+    count = 0
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+        for patient in patients:
+            pending.append((report_filename(patient), executor.submit(export_patient_to_pdf, patient)))
+            if len(pending) >= workers * 2:
+                filename, future = pending.popleft()
+                archive.writestr(filename, future.result())
+                count += 1
+        for filename, future in pending:
+            archive.writestr(filename, future.result())
+            count += 1
+    return count
+
+
+def main():
+    from patient_index import PatientIndex
+    from patients_db import PATIENTS_DB_PATH, PatientStore
+
+    parser = argparse.ArgumentParser(description="Exportar informes PDF de pacientes a un ZIP")
+    parser.add_argument("output", help="Archivo ZIP de salida ('-' para la salida estándar)")
+    parser.add_argument("--query", default="", help="Exportar solo los pacientes que coincidan (DNI o nombre)")
+    parser.add_argument("--db", default=PATIENTS_DB_PATH)
+    parser.add_argument("--workers", type=int, default=PDF_EXPORT_WORKERS)
+    args = parser.parse_args()
+
+    patients = PatientStore(args.db).iter_patients()
+    if args.query:
+        index = PatientIndex(patients)
+        patients, _ = index.search(args.query, limit=len(index))
+
+    output = sys.stdout.buffer if args.output == "-" else args.output
+    count = export_patients_to_zip(patients, output, workers=args.workers)
+    print(f"{count} informes exportados", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
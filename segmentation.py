@@ -0,0 +1,278 @@
+import math
+import os
+import threading
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Archivo del modelo SegNet entrenado (Keras)
+MODEL_PATH = "SegNet_trained.h5"
+
+# Tamaño de entrada del modelo SegNet (ancho, alto)
+IMAGE_SIZE = (224, 224)
+
+# Máximo de píxeles que se decodifican de una imagen subida; las imágenes mayores se
+# decodifican a escala reducida (JPEG) o se rechazan
+MAX_DECODE_PIXELS = int(os.environ.get("SEGAPP_MAX_DECODE_PIXELS", 40_000_000))
+
+# Número de imágenes por llamada a model.predict en el modo por lotes
+DEFAULT_BATCH_SIZE = 8
+
+# Píxeles de solapamiento entre teselas vecinas en el modo en mosaico
+DEFAULT_TILE_OVERLAP = 32
+
+# Máximo de teselas por llamada a model.predict, para acotar la memoria usada
+DEFAULT_MAX_TILES_PER_BATCH = 16
+
+
+# Carga el modelo del backend indicado: "keras", "tflite" o "remote" (servidor de
+# inferencia en url). Todos ofrecen la misma interfaz predict, y cada backend solo
+# se importa cuando se usa
+def load_segmentation_model(backend="keras", model_path=None, url=None):
+    if backend == "remote":
+        from inference_server import RemoteModel
+
+        return RemoteModel(url)
+    if backend == "tflite":
+        from tflite_backend import TFLITE_MODEL_PATH, TFLiteModel
+
+        return TFLiteModel(model_path or TFLITE_MODEL_PATH)
+    if backend == "keras":
+        from keras_backend import KerasModel
+
+        return KerasModel(model_path or MODEL_PATH)
+    raise ValueError(f"Backend desconocido: {backend}")
+
+
+# Factor de normalización de los píxeles uint8 a [0, 1]
+_SCALE = np.float32(1 / 255.0)
+
+# Modos en los que PIL puede reducir una imagen por un factor entero (Image.reduce)
+_REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "RGBa", "CMYK", "YCbCr", "I", "F")
+
+# Búferes uint8 de redimensionado, uno por hilo (las sesiones y la cola trabajan en paralelo)
+_local = threading.local()
+
+
+# Convierte una imagen PIL o un arreglo de cualquier modo (L, LA, P, RGBA, CMYK, 16 bits,
+# flotante, con o sin canal) en un arreglo RGB uint8 de forma (alto, ancho, 3)
+def to_rgb_array(image):
+    if isinstance(image, Image.Image):
+        if image.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+            image = np.asarray(image)
+        else:
+            return np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+
+    pixels = np.asarray(image)
+    if pixels.dtype != np.uint8:
+        if np.issubdtype(pixels.dtype, np.floating):
+            scale = 255.0 if pixels.size and pixels.max() <= 1.0 else 1.0
+            pixels = np.clip(pixels * scale, 0, 255).astype(np.uint8)
+        else:
+            # Enteros de más de 8 bits (por ejemplo, PNG de 16 bits): quedarse con los 8 altos
+            bits = 16 if pixels.max(initial=0) > 255 else 8
+            pixels = (pixels >> (bits - 8)).astype(np.uint8)
+
+    if pixels.ndim == 2:
+        pixels = pixels[..., np.newaxis]
+    channels = pixels.shape[-1]
+    if channels == 1 or channels == 2:  # Gris, con o sin alfa
+        return np.repeat(pixels[..., :1], 3, axis=-1)
+    return pixels[..., :3]  # Sin el canal alfa
+
+
+# Abre una imagen (ruta o archivo) decodificando solo la resolución necesaria: para la
+# vista previa, los JPEG se decodifican directamente a 1/2, 1/4 u 1/8 de su tamaño sin
+# bajar de la entrada del modelo; con
+# full_resolution (modo mosaico), a tamaño completo salvo que supere max_pixels. La
+# imagen devuelta ya está girada según su orientación EXIF
+def load_image(source, full_resolution=False, max_pixels=MAX_DECODE_PIXELS):
+    image = Image.open(source)
+    width, height = image.size
+    if full_resolution:
+        # Menor escala de decodificación JPEG que deja la imagen por debajo del límite
+        scale = next((scale for scale in (1, 2, 4, 8) if (width // scale) * (height // scale) <= max_pixels), None)
+        if scale is None:
+            raise ValueError(f"Imagen demasiado grande: {width}x{height} píxeles")
+        requested = (math.ceil(width / scale), math.ceil(height / scale))
+    else:
+        requested = IMAGE_SIZE  # Ningún lado por debajo de la entrada del modelo
+    image.draft(None, requested)  # Solo tiene efecto en JPEG
+
+    # Los demás formatos no admiten decodificación reducida
+    if image.size[0] * image.size[1] > max_pixels:
+        raise ValueError(f"Imagen demasiado grande: {width}x{height} píxeles")
+    image.load()
+    # Girar sobre la propia imagen, sin una copia completa
+    ImageOps.exif_transpose(image, in_place=True)
+    return image
+
+
+# Redimensiona a la entrada del modelo en un arreglo RGB uint8 (224, 224, 3). Si se
+# indica out, se escribe ahí sin asignar memoria nueva
+def resize_rgb(image, out=None):
+    import cv2  # Solo se importa al preprocesar, no al arrancar la aplicación
+
+    # Reducir primero por un factor entero dentro de PIL (promedio por bloques), para no
+    # copiar a NumPy una imagen grande completa solo para redimensionarla
+    if isinstance(image, Image.Image):
+        factor = min(image.width // IMAGE_SIZE[0], image.height // IMAGE_SIZE[1]) // 2
+        if factor > 1:
+            if image.mode in ("1", "P", "PA"):
+                image = image.convert("RGBA" if image.mode == "PA" else "RGB")
+            if image.mode in _REDUCIBLE_MODES:
+                image = image.reduce(factor)
+
+    pixels = to_rgb_array(image)
+    if pixels.shape[:2] == (IMAGE_SIZE[1], IMAGE_SIZE[0]):
+        if out is None:
+            return np.ascontiguousarray(pixels)
+        np.copyto(out, pixels)
+        return out
+    if out is None:
+        out = np.empty((IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.uint8)
+    # INTER_AREA promedia los píxeles al reducir, sin el aliasing de la interpolación bilineal
+    cv2.resize(np.ascontiguousarray(pixels), IMAGE_SIZE, dst=out, interpolation=cv2.INTER_AREA)
+    return out
+
+
+# Convierte una imagen en el arreglo float32 normalizado que espera el modelo: conversión
+# a RGB, redimensionado y normalización escritos directamente en out (o en un arreglo nuevo)
+def prepare_image(image, out=None):
+    scratch = getattr(_local, "scratch", None)
+    if scratch is None:
+        scratch = _local.scratch = np.empty((IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.uint8)
+    if out is None:
+        out = np.empty((IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+    np.multiply(resize_rgb(image, out=scratch), _SCALE, out=out)
+    return out
+
+
+# Búfer float32 (capacidad, 224, 224, 3) preasignado y reutilizado entre lotes: cada
+# imagen se preprocesa directamente en su posición, sin arreglos intermedios
+class ImageBatchBuffer:
+    def __init__(self, capacity=DEFAULT_BATCH_SIZE):
+        self.buffer = np.empty((capacity, IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+
+    def slot(self, idx):
+        if idx >= len(self.buffer):
+            # Crecer (solo ocurre si llega un lote mayor que la capacidad)
+            grown = np.empty((max(idx + 1, 2 * len(self.buffer)),) + self.buffer.shape[1:], dtype=np.float32)
+            grown[:len(self.buffer)] = self.buffer
+            self.buffer = grown
+        return self.buffer[idx]
+
+    # Preprocesa las imágenes en el búfer y devuelve la vista (N, 224, 224, 3), válida
+    # hasta la siguiente llamada
+    def stack(self, images):
+        count = 0
+        for image in images:
+            prepare_image(image, out=self.slot(count))
+            count += 1
+        return self.buffer[:count]
+
+
+# Apila varias imágenes en un único tensor float32 nuevo de forma (N, 224, 224, 3)
+def stack_images(images):
+    return ImageBatchBuffer(max(len(images), 1)).stack(images)
+
+
+# Convierte las predicciones del modelo (N, alto, ancho[, 1]) en máscaras uint8 en escala
+# de grises, escalando en el propio arreglo de predicciones cuando es posible
+def postprocess_masks(predictions):
+    predictions = np.asarray(predictions)
+    if predictions.ndim == 4 and predictions.shape[-1] == 1:
+        predictions = predictions[..., 0]
+    if predictions.flags.writeable and predictions.dtype == np.float32:
+        scaled = np.multiply(predictions, np.float32(255), out=predictions)
+    else:
+        scaled = np.multiply(predictions, np.float32(255), dtype=np.float32)
+    masks = np.empty(scaled.shape, dtype=np.uint8)
+    np.copyto(masks, scaled, casting="unsafe")  # Trunca como astype(np.uint8)
+    return masks
+
+
+# Convierte una predicción del modelo en una máscara uint8 en escala de grises
+def postprocess_mask(prediction):
+    return postprocess_masks(np.asarray(prediction)[np.newaxis])[0]
+
+
+# Ejecuta el modelo sobre un lote apilado en llamadas de como máximo batch_size imágenes
+def predict_masks(model, batch, batch_size=DEFAULT_BATCH_SIZE):
+    masks = []
+    for start in range(0, len(batch), batch_size):
+        predictions = model.predict(batch[start:start + batch_size], verbose=0)
+        masks.extend(postprocess_masks(predictions))
+    return masks
+
+
+# Posiciones iniciales de las teselas a lo largo de un eje; la última se alinea con el borde
+def _tile_starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+# Pesos que decaen hacia los bordes de la tesela para mezclar suavemente los solapamientos
+def _blend_window(tile_height, tile_width, overlap):
+    def ramp(length):
+        weights = np.ones(length, dtype=np.float32)
+        if overlap > 0:
+            edge = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+            weights[:overlap] = edge
+            weights[-overlap:] = edge[::-1]
+        return weights
+
+    return np.outer(ramp(tile_height), ramp(tile_width))
+
+
+# Segmenta la imagen a resolución completa con teselas solapadas de 224x224. Si se indica
+# progress, se llama con (teselas procesadas, total) tras cada llamada al modelo
+def predict_tiled(model, image, overlap=DEFAULT_TILE_OVERLAP, max_tiles_per_batch=DEFAULT_MAX_TILES_PER_BATCH,
+                  progress=None):
+    tile_width, tile_height = IMAGE_SIZE
+    pixels = to_rgb_array(image)
+    height, width = pixels.shape[:2]
+
+    # Las imágenes más pequeñas que una tesela se completan replicando el borde
+    if height < tile_height or width < tile_width:
+        pad_height = max(tile_height - height, 0)
+        pad_width = max(tile_width - width, 0)
+        pixels = np.pad(pixels, ((0, pad_height), (0, pad_width), (0, 0)), mode="edge")
+
+    padded_height, padded_width = pixels.shape[:2]
+    positions = [
+        (y, x)
+        for y in _tile_starts(padded_height, tile_height, tile_height - overlap)
+        for x in _tile_starts(padded_width, tile_width, tile_width - overlap)
+    ]
+
+    window = _blend_window(tile_height, tile_width, overlap)
+    probabilities = np.zeros((padded_height, padded_width), dtype=np.float32)
+    weights = np.zeros((padded_height, padded_width), dtype=np.float32)
+
+    # Un único búfer de teselas reutilizado en cada llamada al modelo
+    tiles = np.empty((min(max_tiles_per_batch, len(positions)), tile_height, tile_width, 3), dtype=np.float32)
+    for start in range(0, len(positions), max_tiles_per_batch):
+        chunk = positions[start:start + max_tiles_per_batch]
+        for idx, (y, x) in enumerate(chunk):
+            np.multiply(pixels[y:y + tile_height, x:x + tile_width], np.float32(1 / 255.0), out=tiles[idx])
+
+        predictions = model.predict(tiles[:len(chunk)], verbose=0)
+        for (y, x), prediction in zip(chunk, predictions):
+            probabilities[y:y + tile_height, x:x + tile_width] += prediction[..., 0] * window
+            weights[y:y + tile_height, x:x + tile_width] += window
+        if progress is not None:
+            progress(start + len(chunk), len(positions))
+
+    probabilities /= weights
+    return postprocess_mask(probabilities[:height, :width])
+
+
+# Calcula el porcentaje de píxeles no negros en la imagen procesada
+def calculate_non_black_pixel_percentage(mask):
+    non_black_pixels = np.sum(mask > 0)
+    total_pixels = mask.size
+    return (non_black_pixels / total_pixels) * 100
@@ -1,17 +1,55 @@
 import streamlit as st
-import tensorflow as tf
 from PIL import Image
-import cv2
 import numpy as np
+import csv
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import json
+import uuid
+from io import BytesIO, StringIO
+from artifact_store import init_artifact_store
+from inference_cache import InferenceCache
+from job_queue import QueueFullError
+import metrics
+from mask_stacks import MaskStackStore, area_series, change_map, days_to_closure, healing_rate, visit_changes
+from mask_storage import compact_mask_path, compute_mask_metrics, save_compact_mask
+from patient_index import PatientIndex
+from patient_io import REJECT_FIELDS, export_patients, file_format, import_patients, iter_patient_records, open_text
+from pdf_export import export_patient_to_pdf, export_patients_to_zip
+from patients_db import PatientStore
+from thumbnails import ThumbnailCache
+from user_store import UserStore
+from segmentation import (
+    calculate_non_black_pixel_percentage,
+    load_image,
+    load_segmentation_model,
+)
+from video_segmentation import VIDEO_EXTENSIONS
 
 # Rutas de archivos
 DATABASE_PATH = "patients_data.json"
+PATIENTS_DB_PATH = "patients.db"
 USERS_DB_PATH = "users_db.json"
 SEGMENTATION_DIR = "segmentations"
 
+# Guardar junto a cada PNG la máscara binaria en formato compacto (.bits)
+COMPACT_MASKS = os.environ.get("SEGAPP_COMPACT_MASKS", "1") == "1"
+
+# Pacientes por página en los resultados de búsqueda
+SEARCH_PAGE_SIZE = 10
+
+# Informes PDF que se mantienen cacheados en memoria
+PDF_CACHE_ENTRIES = 256
+
+# Miniaturas que se cargan cada vez en la galería de un paciente
+GALLERY_PAGE_SIZE = 6
+
+# Segmentaciones que se recuerdan por sesión; por encima se olvidan las terminadas más antiguas
+SESSION_SEGMENTATIONS = 50
+
+# Puerto local donde se sirve uploader.py: métricas Prometheus y API de segmentación (0 para desactivarlo)
+METRICS_PORT = int(os.environ.get("SEGAPP_METRICS_PORT", 8503))
+
 # Crear el directorio de segmentaciones si no existe
 if not os.path.exists(SEGMENTATION_DIR):
     os.makedirs(SEGMENTATION_DIR)
@@ -165,8 +203,8 @@ def reset_database_page():
     if st.button("Confirmar"):
         if password == "0000":
             # Borrar datos de pacientes
-            st.session_state.patients = []
-            save_patients_data()
+            get_patient_store().clear()
+            get_patient_index().clear()
             
             # Borrar archivos de segmentación
             for file in os.listdir(SEGMENTATION_DIR):
@@ -174,6 +212,11 @@ def reset_database_page():
                 if os.path.isfile(file_path):
                     os.remove(file_path)
 
+            # Y todo lo que se calculó a partir de ellos
+            get_mask_stacks().clear()
+            get_inference_cache().clear()
+            get_thumbnail_cache().clear()
+
             st.success("Base de datos de pacientes y segmentaciones reiniciada correctamente.")
         else:
             st.error("Contraseña incorrecta. Intenta de nuevo.")
@@ -182,45 +225,205 @@ def reset_database_page():
     if st.button("Atrás"):
         set_page("panel")
 
+# Página de importación y exportación de pacientes en bloque (ver patient_io.py)
+def admin_pacientes_page():
+    header()
+    st.markdown(
+        "<h1 style='color: #333; margin-top: 20px;'>Importar / exportar pacientes</h1>",
+        unsafe_allow_html=True
+    )
 
-# Función para cargar datos de pacientes desde el archivo JSON
-def load_patients_data():
-    if os.path.exists(DATABASE_PATH):
-        with open(DATABASE_PATH, 'r') as file:
-            st.session_state.patients = json.load(file)
-    else:
-        st.session_state.patients = []  # Inicializar lista vacía si no existe el archivo
-
-# Función para guardar datos de pacientes en el archivo JSON
-def save_patients_data():
-    with open(DATABASE_PATH, 'w') as file:
-        json.dump(st.session_state.patients, file, indent=4)
-
-# Función para cargar usuarios desde el archivo JSON
-def load_users_data():
-    if os.path.exists(USERS_DB_PATH):
-        with open(USERS_DB_PATH, 'r') as file:
-            st.session_state.users = json.load(file)
+    st.subheader("Importar")
+    st.caption("CSV con columnas dni, name, age y sex, o JSONL/JSON con un paciente por registro. "
+               "Los DNI ya registrados o repetidos en el archivo se rechazan.")
+    uploaded = st.file_uploader("Archivo de pacientes", type=["csv", "jsonl", "json"], key="import_file")
+    if uploaded is not None and st.button("Importar", key="import_button"):
+        rejects = StringIO()
+        rejects_writer = csv.writer(rejects)
+        rejects_writer.writerow(REJECT_FIELDS)
+        progress_text = st.empty()
+
+        def progress(count):
+            progress_text.text(f"{count} filas procesadas…")
+
+        with st.spinner("Importando pacientes…"), metrics.timed("import_patients"):
+            summary = import_patients(
+                get_patient_store(),
+                iter_patient_records(open_text(uploaded), file_format(uploaded.name)),
+                reject=lambda line, dni, reason: rejects_writer.writerow((line, dni, reason)),
+                progress=progress,
+            )
+        # Las escrituras de este proceso no cambian data_version: reconstruir el índice
+        load_patient_index.clear()
+        st.session_state.import_summary = summary
+        get_artifact_store().discard(st.session_state.get("import_rejects"))
+        st.session_state.import_rejects = get_artifact_store().put(rejects.getvalue().encode())
+
+    summary = st.session_state.get("import_summary")
+    if summary is not None:
+        st.success(f"{summary['imported']} pacientes importados de {summary['read']} filas.")
+        rejects = get_artifact_store().get(st.session_state.get("import_rejects"))
+        if summary["rejected"]:
+            st.warning(f"{summary['rejected']} filas rechazadas.")
+        if summary["rejected"] and rejects is not None:
+            st.download_button("Descargar filas rechazadas", data=rejects,
+                               file_name="rejected_patients.csv", mime="text/csv")
+
+    st.subheader("Exportar")
+    fmt = st.radio("Formato", ["csv", "jsonl"], horizontal=True, key="export_format")
+    if st.button("Preparar exportación", key="export_button"):
+        # Se escribe en flujo a un archivo temporal, sin reunir los pacientes en memoria
+        # (en el directorio de volcado del almacén de artefactos, que lo borra con él)
+        path = get_artifact_store().new_file(f".{fmt}")
+        with st.spinner("Exportando pacientes…"), metrics.timed("export_patients"):
+            with open(path, 'w', newline='', encoding="utf-8") as file:
+                count = export_patients(get_patient_store().iter_patients(), file, fmt)
+        get_artifact_store().discard(st.session_state.get("patient_export"))
+        st.session_state.patient_export = get_artifact_store().put_file(path)
+        st.session_state.export_count = count
+        st.session_state.export_file_format = fmt
+
+    file_download_button(f"Descargar {st.session_state.get('export_count')} pacientes",
+                         st.session_state.get("patient_export"),
+                         file_name=f"patients.{st.session_state.get('export_file_format')}")
+
+    if st.button("Atrás", key="back_from_admin_button"):
+        set_page("panel")
+
+
+# Servidor local de uploader.py (/metrics y /api/segmentations) en un hilo de este proceso
+@st.cache_resource
+def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    from uploader import serve_in_background
+    try:
+        return serve_in_background("127.0.0.1", METRICS_PORT)
+    except OSError:
+        # Puerto ocupado, por ejemplo por otra instancia de la aplicación
+        return None
+
+# Página de administración con los tiempos por etapa y los contadores del proceso
+def metricas_page():
+    header()
+    st.markdown(
+        "<h1 style='font-size: 2em; color: #10579e; margin-top: 30px;'>Métricas de rendimiento</h1>",
+        unsafe_allow_html=True
+    )
+
+    summary = metrics.REGISTRY.stage_summary()
+    if summary:
+        st.subheader("Tiempo por etapa")
+        st.table([
+            {
+                "Etapa": stage,
+                "Llamadas": values["count"],
+                "Media (ms)": f"{values['total_s'] / values['count'] * 1000:.1f}" if values["count"] else "-",
+                "Total (s)": f"{values['total_s']:.2f}",
+                "Errores": values["errors"],
+            }
+            for stage, values in sorted(summary.items())
+        ])
     else:
-        st.session_state.users = {}  # Inicializar diccionario vacío si no existe el archivo
+        st.info("Todavía no se ha registrado ninguna operación.")
+
+    counters = metrics.REGISTRY.counters()
+    if counters:
+        st.subheader("Contadores")
+        st.table([{"Métrica": name, "Valor": value} for name, value in sorted(counters.items())])
+
+    # Memoria de los datos de sesión (imágenes subidas, máscaras, fotogramas, descargas)
+    artifacts = get_artifact_store().stats()
+    st.subheader("Datos de sesión")
+    col_memory, col_disk, col_loads = st.columns(3)
+    col_memory.metric(
+        "En memoria",
+        f"{artifacts['memory_bytes'] / 2**20:.1f} / {artifacts['memory_limit'] / 2**20:.0f} MB",
+        help=f"{artifacts['memory_entries']} elementos",
+    )
+    col_disk.metric(
+        "Volcados a disco",
+        f"{artifacts['disk_bytes'] / 2**20:.1f} / {artifacts['disk_limit'] / 2**20:.0f} MB",
+        help=f"{artifacts['disk_entries']} elementos",
+    )
+    col_loads.metric("Recargas desde disco", artifacts["disk_loads"], help=f"{artifacts['evictions']} expulsiones de memoria")
 
-# Función para guardar usuarios en el archivo JSON
-def save_users_data():
-    with open(USERS_DB_PATH, 'w') as file:
-        json.dump(st.session_state.users, file, indent=4)
+    if not INFERENCE_SERVER_URL and start_model_warmup().done():
+        manager = get_model_manager()
+        caption = f"Modelo activo: {manager.version[:12]} ({manager.backend})"
+        if manager.loading:
+            caption += f" · cargando {manager.loading[:12]}"
+        st.caption(caption)
 
-# Inicializar session_state
-if 'users' not in st.session_state:
-    load_users_data()  # Cargar los datos de usuario desde el archivo al inicio
+    if start_metrics_server() is not None:
+        st.caption(f"Formato Prometheus en http://127.0.0.1:{METRICS_PORT}/metrics")
 
+    if st.button("Atrás", key="back_from_metrics_button"):
+        set_page("panel")
+
+
+# Almacén de pacientes en SQLite compartido por todas las sesiones
+@st.cache_resource
+def get_patient_store():
+    store = PatientStore(PATIENTS_DB_PATH)
+    store.migrate_from_json(DATABASE_PATH)  # Migración única desde el antiguo archivo JSON
+    return store
+
+# Índice en memoria de pacientes compartido por las páginas de búsqueda, registro y
+# asignación. Las escrituras de esta aplicación lo actualizan directamente; si otro
+# proceso modifica la base de datos (otra instancia, una importación), se reconstruye
+def get_patient_index():
+    return load_patient_index(get_patient_store().data_version())
+
+@st.cache_resource(max_entries=1)
+def load_patient_index(data_version):
+    with metrics.timed("load_patients"):
+        return PatientIndex(get_patient_store().iter_patients())
+
+# Caché de miniaturas de segmentaciones compartida por todas las sesiones
+@st.cache_resource
+def get_thumbnail_cache():
+    return ThumbnailCache()
+
+# PDF del paciente, cacheado hasta que se le asigne una segmentación nueva
+# (el argumento _patient no forma parte de la clave de la caché)
+@st.cache_data(max_entries=PDF_CACHE_ENTRIES, show_spinner=False)
+def get_patient_pdf(dni, segmentations, _patient):
+    with metrics.timed("pdf"):
+        pdf_data = export_patient_to_pdf(_patient)
+    metrics.inc("segapp_pdf_reports_total")
+    return pdf_data
+
+# Pilas de máscaras por paciente para la evolución de la herida, compartidas por las sesiones
+@st.cache_resource
+def get_mask_stacks():
+    return MaskStackStore()
+
+# Registra una segmentación en la base de datos, en el índice de pacientes y en la pila
+# de máscaras del paciente
+def add_segmentation_to_patient(dni, filename):
+    store = get_patient_store()
+    # Crear el índice antes de escribir: si se construyera después, ya leería la fila
+    # nueva de la base de datos y la segmentación quedaría duplicada
+    index = get_patient_index()
+    if not store.add_segmentation(dni, filename):
+        return False
+    index.add_segmentation(dni, filename, store.get_mask_metrics(filename))
+    get_mask_stacks().append(dni, [filename])
+    return True
+
+# Usuarios compartidos por todas las sesiones: cada sesión consulta la misma copia en
+# memoria, y las altas se escriben de una en una sin perder las de otras sesiones
+@st.cache_resource
+def get_user_store():
+    return UserStore(USERS_DB_PATH)
+
+# Inicializar session_state
 if 'page' not in st.session_state:
     st.session_state.page = 'home'
 
-if 'processed_image' not in st.session_state:
-    st.session_state.processed_image = None
-
-if 'patients' not in st.session_state:
-    load_patients_data()  # Cargar los datos de pacientes desde el archivo al inicio
+if 'segmentation_jobs' not in st.session_state:
+    st.session_state.segmentation_jobs = []
 
 
 # Define las diferentes páginas de la aplicación
@@ -292,9 +495,10 @@ def login_page():
     password = st.text_input("Contraseña", type="password", key="login_password")
 
     if st.button("Iniciar sesión"):
-        if username in st.session_state.users and st.session_state.users[username] == password:
+        if get_user_store().check_password(username, password):
             st.session_state.logged_in = True
             st.session_state.username = username
+            start_model_warmup()
             set_page("panel")
             st.success("Inicio de sesión exitoso.")
         else:
@@ -314,9 +518,7 @@ def register_page():
 
     if st.button("Registrarse"):
         if new_password == confirm_password:
-            if new_username not in st.session_state.users:
-                st.session_state.users[new_username] = new_password
-                save_users_data()  # Guardar en archivo JSON
+            if get_user_store().add(new_username, new_password):
                 st.success("Registro exitoso. Ahora puedes iniciar sesión.")
             else:
                 st.error("El nombre de usuario ya existe. Por favor elige otro.")
@@ -350,6 +552,12 @@ def panel_page():
     if st.button("Iniciar la segmentación", key="iniciar_segmentacion_button"):
         set_page('iniciar_segmentacion')
 
+    if st.button("Métricas de rendimiento", key="metricas_button"):
+        set_page('metricas')
+
+    if st.button("Importar / exportar pacientes", key="admin_pacientes_button"):
+        set_page('admin_pacientes')
+
     if st.button("Reiniciar Base de Datos de Pacientes", key="reset_database_button"):
         set_page('reset_database')
 
@@ -359,32 +567,17 @@ def panel_page():
         st.session_state.username = None  # Limpiar el nombre de usuario de la sesión
     st.markdown("</div>", unsafe_allow_html=True)
 
-from io import BytesIO
-from fpdf import FPDF
-
-# Función para generar un PDF del paciente
-def export_patient_to_pdf(patient):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    pdf.cell(200, 10, txt="Información del Paciente", ln=True, align='C')
-    pdf.cell(200, 10, txt=f"Nombre: {patient['name']}", ln=True)
-    pdf.cell(200, 10, txt=f"Edad: {patient['age']}", ln=True)
-    pdf.cell(200, 10, txt=f"Sexo: {patient['sex']}", ln=True)
-    pdf.cell(200, 10, txt=f"DNI: {patient['dni']}", ln=True)
-
-    # Agregar imágenes segmentadas al PDF
-    if patient.get('segmentations'):
-        for idx, seg_path in enumerate(patient['segmentations'], start=1):
-            pdf.cell(200, 10, txt=f"Segmentación {idx}", ln=True)
-            pdf.image(seg_path, w=100)  # Ajusta el tamaño de la imagen según sea necesario
-
-    # Guardar el PDF en un objeto BytesIO
-    pdf_output = BytesIO()
-    pdf.output(pdf_output, 'F')
-    pdf_output.seek(0)
-    return pdf_output
+# Botón para descargar un archivo del almacén de artefactos (ver put_file). El archivo
+# se lee solo al pulsarlo, no en cada recarga de la página
+def file_download_button(label, handle, file_name, mime=None):
+    path = get_artifact_store().file_path(handle)
+    if path is None:
+        return
+    st.download_button(label, data=lambda: read_file(path), file_name=file_name, mime=mime)
 
+def read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
 
 # Función principal para buscar paciente y exportar datos
 def buscar_paciente():
@@ -399,33 +592,74 @@ def buscar_paciente():
         unsafe_allow_html=True
     )
     
-    search_dni = st.text_input("Buscar paciente por DNI", key="search_dni")
-    
-    found = False  # Inicializar found antes de su uso
-
-    if st.button("Buscar", key="buscar_button"):
-        for patient in st.session_state.patients:
-            if patient['dni'] == search_dni:
-                st.write(f"**Nombre:** {patient['name']}")
-                st.write(f"**Edad:** {patient['age']}")
-                st.write(f"**Sexo:** {patient['sex']}")
-                st.write(f"**DNI:** {search_dni}")
-                
-                st.subheader("Imágenes segmentadas")
-                if patient.get('segmentations'):
-                    for seg_path in patient['segmentations']:
-                        st.image(seg_path, caption=f"Segmentación para {search_dni}", width=250)
-                else:
-                    st.info("No hay imágenes segmentadas para este paciente.")
-                found = True
-                break
-        if not found:
+    search_query = st.text_input("Buscar paciente por DNI o nombre", key="search_dni")
+
+    # Volver a la primera página de resultados cuando cambia la búsqueda
+    if st.session_state.get("search_last_query") != search_query:
+        st.session_state.search_last_query = search_query
+        st.session_state.search_page = 0
+
+    page = st.session_state.get("search_page", 0)
+    results, total = get_patient_index().search(
+        search_query, offset=page * SEARCH_PAGE_SIZE, limit=SEARCH_PAGE_SIZE
+    )
+
+    patient = None
+    if total == 0:
+        if search_query:
             st.error("Paciente no encontrado. Verifica el DNI.")
+    else:
+        page_count = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+        st.caption(f"{total} pacientes encontrados · página {page + 1} de {page_count}")
+        patient = st.radio(
+            "Resultados",
+            results,
+            format_func=lambda result: f"{result['dni']} · {result['name']}",
+            key="search_result",
+        )
+
+        # Botones de paginación
+        col_prev, col_next, col_export = st.columns(3)
+        with col_prev:
+            st.button("Anterior", key="search_prev_button", disabled=page == 0,
+                      on_click=lambda: st.session_state.update(search_page=page - 1))
+        with col_next:
+            st.button("Siguiente", key="search_next_button", disabled=page + 1 >= page_count,
+                      on_click=lambda: st.session_state.update(search_page=page + 1))
+        with col_export:
+            # Exportación masiva de todos los resultados de la búsqueda a un ZIP de PDFs
+            if st.button(f"Exportar {total} informes (ZIP)", key="bulk_export_button"):
+                all_results, _ = get_patient_index().search(search_query, limit=total)
+                # El ZIP se escribe a un archivo del almacén de artefactos a medida que se
+                # generan los informes
+                path = get_artifact_store().new_file(".zip")
+                with st.spinner(f"Generando {total} informes..."), metrics.timed("pdf_bulk_export"):
+                    with open(path, 'wb') as file:
+                        count = export_patients_to_zip(all_results, file)
+                metrics.inc("segapp_pdf_reports_total", count)
+                get_artifact_store().discard(st.session_state.get("bulk_export"))
+                st.session_state.bulk_export = get_artifact_store().put_file(path)
+
+    file_download_button("Descargar ZIP de informes", st.session_state.get("bulk_export"),
+                         file_name="informes_pacientes.zip", mime="application/zip")
+
+    if patient is not None:
+        st.write(f"**Nombre:** {patient['name']}")
+        st.write(f"**Edad:** {patient['age']}")
+        st.write(f"**Sexo:** {patient['sex']}")
+        st.write(f"**DNI:** {patient['dni']}")
+
+        st.subheader("Imágenes segmentadas")
+        if patient.get('segmentations'):
+            galeria_segmentaciones(patient)
+        else:
+            st.info("No hay imágenes segmentadas para este paciente.")
+
+        if len(patient.get('segmentations', [])) > 1:
+            evolucion_herida(patient)
 
-    # Verificar si se encontró al paciente antes de mostrar los botones de exportación
-    if found:
         # Botón para exportar la información a PDF
-        pdf_data = export_patient_to_pdf(patient)
+        pdf_data = get_patient_pdf(patient['dni'], tuple(patient['segmentations']), patient)
         st.download_button("Descargar PDF", data=pdf_data, file_name=f"{patient['name']}_info.pdf", mime="application/pdf")
 
     # Botón "Atrás" para volver a la página del panel
@@ -434,6 +668,92 @@ def buscar_paciente():
 
 
 
+# Galería de segmentaciones del paciente: miniaturas cacheadas, las más recientes primero,
+# cargadas por páginas de GALLERY_PAGE_SIZE imágenes
+def galeria_segmentaciones(patient):
+    gallery_key = f"gallery_count_{patient['dni']}"
+    visible = st.session_state.get(gallery_key, GALLERY_PAGE_SIZE)
+    segmentations = patient['segmentations'][::-1]
+    thumbnails = get_thumbnail_cache()
+
+    columns = st.columns(3)
+    for idx, seg_path in enumerate(segmentations[:visible]):
+        with columns[idx % len(columns)]:
+            try:
+                st.image(thumbnails.get(seg_path), caption=f"Segmentación para {patient['dni']}", width=250)
+            except FileNotFoundError:
+                st.warning(f"No se encontró la imagen {seg_path}.")
+                continue
+            # Métricas precalculadas al guardar la máscara, sin decodificar la imagen
+            mask_metrics = patient.get('metrics', {}).get(seg_path)
+            if mask_metrics is not None:
+                caption = (
+                    f"Área: {mask_metrics['area_percentage']:.2f}% · "
+                    f"{mask_metrics['components']} región(es) · perímetro {mask_metrics['perimeter']:.0f} px"
+                )
+                # Versión del modelo que generó la máscara
+                if mask_metrics.get('model_version'):
+                    caption += f" · modelo {mask_metrics['model_version'][:8]}"
+                st.caption(caption)
+
+    if visible < len(segmentations):
+        st.button(
+            f"Mostrar más ({len(segmentations) - visible} restantes)",
+            key=f"gallery_more_{patient['dni']}",
+            on_click=lambda: st.session_state.update({gallery_key: visible + GALLERY_PAGE_SIZE}),
+        )
+
+
+# Evolución de la herida entre visitas: curva de área, cambios de visita a visita y
+# ritmo de cicatrización, calculados sobre la pila de máscaras del paciente
+def evolucion_herida(patient):
+    st.subheader("Evolución de la herida")
+    masks, _, timestamps = get_mask_stacks().load(patient['dni'], patient['segmentations'])
+    if len(masks) < 2:
+        st.info("Hacen falta al menos dos segmentaciones para ver la evolución.")
+        return
+
+    # Visitas en orden cronológico (la pila sigue el orden de asignación)
+    order = np.argsort(timestamps, kind="stable")
+    if np.any(order != np.arange(len(order))):
+        masks, timestamps = masks[order], timestamps[order]
+
+    areas = area_series(masks)
+    healed, new = visit_changes(masks)
+    dates = [datetime.fromtimestamp(timestamp) for timestamp in timestamps]
+    st.line_chart({"Fecha": dates, "Área de la herida (%)": areas}, x="Fecha", y="Área de la herida (%)")
+
+    rate = healing_rate(timestamps, areas)
+    closure = days_to_closure(rate, areas[-1])
+    col_rate, col_closure = st.columns(2)
+    col_rate.metric("Ritmo de cicatrización", "—" if rate is None else f"{rate:+.2f} % / día")
+    col_closure.metric("Cierre estimado", "—" if closure is None else f"{closure:.0f} días")
+
+    st.table([
+        {
+            "Visita": date.strftime("%d/%m/%Y %H:%M"),
+            "Área (%)": f"{area:.2f}",
+            "Cicatrizado (%)": f"{healed[idx - 1]:.2f}" if idx else "",
+            "Tejido nuevo (%)": f"{new[idx - 1]:.2f}" if idx else "",
+        }
+        for idx, (date, area) in enumerate(zip(dates, areas))
+    ])
+
+    # Mapa de cambios entre dos visitas consecutivas
+    visit = st.select_slider(
+        "Cambios hasta la visita",
+        options=range(1, len(masks)),
+        value=len(masks) - 1,
+        format_func=lambda idx: dates[idx].strftime("%d/%m/%Y %H:%M"),
+        key=f"evolution_visit_{patient['dni']}",
+    )
+    st.image(
+        change_map(masks[visit - 1], masks[visit]),
+        caption="Verde: cicatrizado · Rojo: tejido nuevo · Gris: herida abierta",
+        width=300,
+    )
+
+
 # Página para registrar un nuevo paciente
 def registrar_paciente():
     header()
@@ -452,41 +772,277 @@ def registrar_paciente():
     p_id = st.text_input("Número de DNI", key="patient_dni")
     
     if st.button("Guardar perfil", key="save_profile_button"):
-        if any(patient['dni'] == p_id for patient in st.session_state.patients):
+        index = get_patient_index()
+        # El índice en memoria descarta duplicados sin consultar la base de datos, y el
+        # índice único sobre el DNI los rechaza también en la propia inserción
+        if index.get(p_id) is not None or not get_patient_store().add_patient(p_name, p_age, p_sex, p_id):
             st.error("El DNI ya existe. Usa otro DNI.")
         else:
-            new_patient = {"name": p_name, "age": p_age, "sex": p_sex, "dni": p_id, "segmentations": []}
-            st.session_state.patients.append(new_patient)
+            index.add({"name": p_name, "age": p_age, "sex": p_sex, "dni": p_id, "segmentations": [], "metrics": {}})
             st.success(f"Perfil de {p_name} guardado correctamente.")
 
     if st.button("Atrás", key="back_to_panel_button"):
         set_page('panel')
     st.markdown("</div>", unsafe_allow_html=True)
 
-# Cargar el modelo SegNet
+# URL del servidor de inferencia compartido (vacío para cargar el modelo en este proceso)
+INFERENCE_SERVER_URL = os.environ.get("SEGAPP_INFERENCE_URL", "")
+
+# Backend local del modelo: "keras" (SegNet_trained.h5) o "tflite" (modelo cuantizado)
+MODEL_BACKEND = os.environ.get("SEGAPP_BACKEND", "keras")
+
+# Con un servidor de inferencia, las predicciones se agrupan con las de otras sesiones
 @st.cache_resource
-def load_model():
-    model = tf.keras.models.load_model("SegNet_trained.h5")
-    return model
-
-# Procesar la imagen con el modelo de segmentación
-def process_image_with_model(image, model):
-    # Redimensionar la imagen a la entrada del modelo (por ejemplo, 224x224)
-    image = image.resize((224, 224))
-    image_array = np.array(image) / 255.0  # Normalizar
-    image_array = np.expand_dims(image_array, axis=0)  # Agregar dimensión de batch
-
-    # Realizar la predicción
-    predicted_mask = model.predict(image_array)[0]  # Obtén la máscara sin la dimensión de batch
-
-    # Asegurarse de que la máscara segmentada esté en formato uint8 y en escala de grises
-    predicted_mask = (predicted_mask * 255).astype(np.uint8)
-    
-    # Si la máscara tiene un solo canal de color, asegurarse de que esté en el formato correcto
-    if predicted_mask.ndim == 3 and predicted_mask.shape[-1] == 1:
-        predicted_mask = np.squeeze(predicted_mask, axis=-1)
-    
-    return predicted_mask
+def get_remote_model():
+    metrics.inc("segapp_model_loads_total")
+    return load_segmentation_model("remote", url=INFERENCE_SERVER_URL)
+
+# Versión activa del registro de modelos, con recarga en caliente; es la misma que usa
+# la API de uploader.py, donde se suben y activan versiones nuevas
+@st.cache_resource
+def get_model_manager():
+    from uploader import init_model_manager
+    return init_model_manager()
+
+# (versión, modelo) SegNet en uso, leídos juntos: cada llamada devuelve los de la versión
+# activa en ese momento, de modo que la versión anotada es la del modelo que se usó
+def current_model():
+    if INFERENCE_SERVER_URL:
+        return get_model_hash(), get_remote_model()
+    return get_model_manager().current()
+
+# Versión (hash del contenido) del modelo en uso, para buscar en la caché de inferencia
+# antes de encolar (la máscara se guarda con la versión que anota su trabajo)
+def get_model_hash():
+    if INFERENCE_SERVER_URL:
+        return f"remote:{INFERENCE_SERVER_URL}"
+    return get_model_manager().version
+
+# Carga y calienta el modelo en un hilo de fondo. Se lanza al iniciar sesión, de modo
+# que ni las primeras páginas ni el primer "Procesar imagen" esperan a TensorFlow
+@st.cache_resource
+def start_model_warmup():
+    from uploader import init_model_manager
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-warmup")
+    future = executor.submit(lambda: None if INFERENCE_SERVER_URL else init_model_manager())
+    executor.shutdown(wait=False)
+    return future
+
+# Estado de la carga del modelo en la página de segmentación
+def model_status():
+    warmup = start_model_warmup()
+    if not warmup.done():
+        model_loading_status()
+    elif warmup.exception() is not None:
+        st.error(f"No se pudo cargar el modelo: {warmup.exception()}")
+    elif not INFERENCE_SERVER_URL:
+        st.caption(f"Modelo listo (versión {get_model_hash()[:12]})")
+
+# Se refresca cada segundo mientras el modelo carga y recarga la página al terminar
+@st.fragment(run_every=1.0)
+def model_loading_status():
+    if start_model_warmup().done():
+        st.rerun()
+    st.info("Cargando el modelo en segundo plano. Puedes ir cargando las imágenes.")
+
+# Cola de trabajos de segmentación compartida por todas las sesiones y por la API
+# HTTP de uploader.py (servida en METRICS_PORT), con el mismo modelo
+@st.cache_resource
+def get_job_queue():
+    from uploader import init_job_queue
+    return init_job_queue(current_model)
+
+# Caché de máscaras por contenido de imagen, compartida por todas las sesiones
+@st.cache_resource
+def get_inference_cache():
+    return InferenceCache()
+
+# Datos grandes de las sesiones (imágenes subidas, fotogramas, archivos para descargar):
+# un único almacén del proceso con límite de memoria, compartido con la cola de trabajos
+def get_artifact_store():
+    return init_artifact_store()
+
+# Encola la segmentación de las imágenes y la registra en la sesión sin esperar al
+# modelo. Las ya segmentadas con el mismo modelo se toman de la caché; mientras el
+# modelo carga aún no se conoce su versión y la caché no se consulta
+def submit_segmentations(images, names, tiled=False, video=False):
+    cache = get_inference_cache()
+    warmup = start_model_warmup()
+    # Los videos no pasan por la caché de inferencia (guarda máscaras de imágenes)
+    model_hash = get_model_hash() if not video and warmup.done() and warmup.exception() is None else None
+
+    entries = []
+    pending = []
+    for image, name in zip(images, names):
+        digest = None if video else cache.image_digest(image, "tiled" if tiled else "preview")
+        key = cache.make_key(digest, model_hash) if model_hash and digest else None
+        entry = {
+            "id": uuid.uuid4().hex,
+            "job": None,
+            "name": name,
+            "tiled": tiled,
+            "video": video,
+            "video_stats": None,
+            "frame": None,
+            "digest": digest,
+            "key": key,
+            "status": "queued",
+            "progress": 0.0,
+            "filename": None,
+            "area": None,
+            "error": None,
+            "created": datetime.now().strftime("%H:%M:%S"),
+        }
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            mask, filename = cached
+            entry.update(status="done", progress=1.0, filename=filename, area=calculate_non_black_pixel_percentage(mask))
+        else:
+            pending.append((entry, image))
+        entries.append(entry)
+
+    # Si la cola está llena no se registra ninguna (QueueFullError llega a la página)
+    jobs = get_job_queue().submit_many(
+        [image for _, image in pending], [entry["name"] for entry, _ in pending], tiled=tiled, video=video
+    )
+    for (entry, _), job in zip(pending, jobs):
+        entry["job"] = job.id
+
+    segmentations = st.session_state.segmentation_jobs
+    segmentations[:0] = reversed(entries)  # Las más recientes primero
+    for idx in range(len(segmentations) - 1, -1, -1):
+        if len(segmentations) <= SESSION_SEGMENTATIONS:
+            break
+        if segmentations[idx]["status"] in ("done", "error"):
+            get_artifact_store().discard(segmentations.pop(idx)["frame"])
+    return entries
+
+# Recoge los trabajos terminados de la sesión: guarda cada máscara (PNG, métricas y
+# miniatura) una sola vez y la añade a la caché. Las terminadas cuya máscara ya no existe
+# (por ejemplo, tras reiniciar la base de datos) pasan a error. Devuelve True si alguna
+# cambió
+def collect_segmentations():
+    queue = get_job_queue()
+    changed = False
+    for entry in st.session_state.segmentation_jobs:
+        if entry["status"] == "done" and not os.path.exists(entry["filename"]):
+            entry.update(status="error", error="La máscara ya no existe")
+            changed = True
+            continue
+        if entry["status"] in ("done", "error"):
+            continue
+        job = queue.get(entry["job"])
+        if job is None:
+            entry.update(status="error", error="El trabajo ya no está en la cola")
+        elif not job.done:
+            entry.update(status=job.status, progress=job.progress)
+            continue
+        elif job.error is not None:
+            entry.update(status="error", error=job.error)
+        elif (mask := job.mask) is None or (job.video and job.frame is None):
+            entry.update(status="error", error="El resultado ya no está disponible")
+        else:
+            # La máscara se guarda en la caché con la versión del modelo que la generó,
+            # aunque entre el envío y el resultado se haya activado otra
+            key = get_inference_cache().make_key(entry["digest"], job.model_version) if entry["digest"] else None
+            # Una misma imagen enviada dos veces en la sesión se guarda una sola vez
+            filename = next((
+                other["filename"] for other in st.session_state.segmentation_jobs
+                if key is not None and other["key"] == key and other["filename"] and os.path.exists(other["filename"])
+            ), None)
+            if filename is None:
+                filename = save_processed_image(mask, job.model_version)
+                if key is not None:
+                    get_inference_cache().put(key, mask, filename)
+            entry.update(status="done", progress=1.0, filename=filename, key=key,
+                         area=calculate_non_black_pixel_percentage(mask),
+                         video_stats=job.video_stats, frame=job.take_frame() if job.video else None)
+        changed = True
+    return changed
+
+def pending_segmentations():
+    return [entry for entry in st.session_state.segmentation_jobs if entry["status"] in ("queued", "running")]
+
+def finished_segmentations():
+    return [entry for entry in st.session_state.segmentation_jobs if entry["status"] == "done"]
+
+# Progreso de las segmentaciones en curso; se refresca cada segundo y recarga la página
+# cuando alguna termina
+@st.fragment(run_every=1.0)
+def segmentation_progress():
+    if collect_segmentations():
+        st.rerun()
+    for entry in pending_segmentations():
+        state = "en cola" if entry["status"] == "queued" else "segmentando"
+        st.progress(entry["progress"], text=f"{entry['name']}: {state}")
+
+def segmentation_label(entry):
+    mode = " · mosaico" if entry["tiled"] else " · video" if entry.get("video") else ""
+    return f"{entry['created']} · {entry['name']}{mode} · {entry['area']:.2f}%"
+
+# Selector entre las segmentaciones terminadas de la sesión; la elegida se recuerda
+# al cambiar de página
+def select_segmentation(label, key):
+    finished = {entry["id"]: entry for entry in finished_segmentations()}
+    if not finished:
+        return None
+    ids = list(finished)
+    current = st.session_state.get("selected_segmentation")
+    selected = st.selectbox(
+        label,
+        ids,
+        index=ids.index(current) if current in ids else 0,
+        format_func=lambda entry_id: segmentation_label(finished[entry_id]),
+        key=key,
+    )
+    st.session_state.selected_segmentation = selected
+    return finished[selected]
+
+# Segmentaciones terminadas de la sesión (de cualquier modo) y las que fallaron
+def segmentation_results():
+    for entry in st.session_state.segmentation_jobs:
+        if entry["status"] == "error":
+            st.caption(f"❌ {entry['name']}: {entry['error']}")
+
+    finished = finished_segmentations()
+    if not finished:
+        return
+    st.subheader("Resultados")
+    thumbnails = get_thumbnail_cache()
+    columns = st.columns(4)
+    for idx, entry in enumerate(finished):
+        with columns[idx % len(columns)]:
+            st.image(thumbnails.get(entry["filename"]), caption=segmentation_label(entry), width=150)
+
+    # Elegir una de las máscaras terminadas para asignarla a un paciente
+    select_segmentation("Máscara a asignar", key="results_selected_segmentation")
+    if st.button("Asignar segmentación a paciente"):
+        set_page("asignar_segmentacion")  # Cambiar a la página de asignación
+
+# Imagen subida en la sesión: se guarda en el almacén de artefactos y la sesión solo
+# conserva su handle, así que sigue disponible al volver a la página aunque el selector
+# de archivos esté vacío. Devuelve un archivo en memoria con su nombre, o None
+def remembered_upload(uploaded):
+    artifacts = get_artifact_store()
+    upload = st.session_state.get("upload")
+    if uploaded is not None and (upload is None or upload["file_id"] != uploaded.file_id):
+        if upload is not None:
+            artifacts.discard(upload["handle"])
+        upload = st.session_state.upload = {
+            "file_id": uploaded.file_id,
+            "name": uploaded.name,
+            "handle": artifacts.put(uploaded.getvalue()),
+        }
+    if upload is None:
+        return None
+
+    data = artifacts.get(upload["handle"])
+    if data is None:  # Descartada por el límite de disco del almacén
+        del st.session_state.upload
+        return None
+    image_file = BytesIO(data)
+    image_file.name = upload["name"]
+    return image_file
 
 def iniciar_segmentacion():
     header()  # Mostrar el encabezado en la página
@@ -499,125 +1055,173 @@ def iniciar_segmentacion():
         """,
         unsafe_allow_html=True
     )
-    
-    image_file = st.file_uploader("Cargar imagen", type=["jpg", "jpeg", "png"], key="upload_image")
+
+    model_status()
+
+    # Las segmentaciones terminadas se recogen antes de mostrar ninguna, para que la
+    # página no use máscaras que ya no existen; las que siguen en curso se muestran abajo
+    # sin bloquear la página, y las terminadas se conservan aunque se cambie de página
+    collect_segmentations()
+
+    mode = st.radio("Modo de segmentación", ["Imagen individual", "Lote de imágenes", "Video"], horizontal=True, key="segmentation_mode")
+
+    if mode == "Lote de imágenes":
+        segmentacion_por_lotes()
+        image_file = None
+    elif mode == "Video":
+        segmentacion_de_video()
+        image_file = None
+    else:
+        image_file = remembered_upload(st.file_uploader("Cargar imagen", type=["jpg", "jpeg", "png"], key="upload_image"))
+
+    if image_file is not None:
+        # Para mostrarla y para la vista previa basta una decodificación reducida
+        try:
+            with metrics.timed("decode"):
+                image = load_image(image_file)
+        except (ValueError, OSError) as e:
+            st.error(f"No se pudo abrir la imagen: {e}")
+            get_artifact_store().discard(st.session_state.pop("upload")["handle"])
+            image_file = None
 
     if image_file is not None:
-        # Guardar la imagen cargada en session_state
-        st.session_state.image_file = image_file
-        image = Image.open(image_file)
-        
         # Mostrar la imagen cargada en la columna izquierda
         col1, col2 = st.columns(2)
         with col1:
             st.image(image, caption='Imagen cargada correctamente', use_column_width=False, width=300)
 
-        # Cargar el modelo una sola vez
-        model = load_model()
+        resolution = st.radio(
+            "Resolución de la máscara",
+            ["Vista previa rápida (224x224)", "Resolución completa (mosaico)"],
+            horizontal=True,
+            key="segmentation_resolution",
+        )
 
-        # Botón para procesar la imagen
+        # Botón para procesar la imagen: se encola y la página sigue respondiendo mientras
+        # el modelo trabaja (una imagen ya segmentada con este modelo se toma de la caché)
         if st.button('Procesar imagen', key="process_image_button"):
-            # Procesar la imagen con el modelo SegNet
-            processed_image = process_image_with_model(image, model)
-            st.session_state.processed_image = processed_image  # Guardar la imagen procesada en session_state
-            
-            # Guardar el archivo de la máscara segmentada
-            filename = save_processed_image(processed_image)
-            st.session_state.processed_image_filename = filename  # Guardar la ruta en session_state
-            
-            # Mostrar la imagen procesada (segmentada) en la columna derecha
+            tiled = resolution == "Resolución completa (mosaico)"
+            try:
+                if tiled:
+                    # El modo mosaico es el único que decodifica la imagen a resolución completa
+                    image_file.seek(0)
+                    with metrics.timed("decode"):
+                        image = load_image(image_file, full_resolution=True)
+                submit_segmentations([image], [image_file.name], tiled=tiled)
+            except QueueFullError:
+                st.error("Hay demasiadas imágenes en cola. Inténtalo de nuevo en unos segundos.")
+            except (ValueError, OSError) as e:
+                st.error(f"No se pudo abrir la imagen: {e}")
+
+        # Mostrar la última máscara de esta imagen en la columna derecha
+        latest = next((entry for entry in st.session_state.segmentation_jobs if entry["name"] == image_file.name), None)
+        if latest is not None and latest["status"] == "done":
             with col2:
-                st.image(processed_image, caption='Máscara segmentada', use_column_width=False, width=300)
+                st.image(latest["filename"], caption='Máscara segmentada', use_column_width=False, width=300)
+            st.write(f"**Porcentaje de área de la herida:** {latest['area']:.2f}%")
 
-            # Calcular el porcentaje del área de la herida
-            wound_area_percentage = calculate_non_black_pixel_percentage(processed_image)
-            st.write(f"**Porcentaje de área de la herida:** {wound_area_percentage:.2f}%")
+        if st.button("Quitar imagen", key="forget_upload_button"):
+            get_artifact_store().discard(st.session_state.pop("upload")["handle"])
+            st.rerun()
 
-    # Botón para asignar segmentación solo si existe una imagen procesada
-    if "processed_image" in st.session_state and st.session_state.processed_image is not None:
-        if st.button("Asignar segmentación a paciente"):
-            set_page("asignar_segmentacion")  # Cambiar a la página de asignación
+    if pending_segmentations():
+        segmentation_progress()
+    segmentation_results()
+
+    # Contadores de la caché de inferencia
+    cache_stats = get_inference_cache().stats()
+    st.caption(f"Caché de inferencia: {cache_stats['hits']} aciertos, {cache_stats['misses']} fallos")
 
     # Botón "Atrás" para volver a la página del panel
     if st.button("Atrás"):
         set_page("panel")
 
+# Modo video: se segmentan unos pocos fotogramas nítidos y distintos entre sí (ver
+# segment_video); se conserva la máscara del más nítido y el área en cada fotograma
+def segmentacion_de_video():
+    video_file = st.file_uploader("Cargar video", type=list(VIDEO_EXTENSIONS), key="upload_video")
+    if video_file is None:
+        return
+    st.video(video_file)
 
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-import tempfile
-
-def export_patient_to_pdf(patient):
-    # Crear un archivo temporal
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        c = canvas.Canvas(tmp_file.name, pagesize=letter)
-        
-        # Información del paciente
-        c.drawString(100, 750, f"Nombre: {patient['name']}")
-        c.drawString(100, 730, f"Edad: {patient['age']}")
-        c.drawString(100, 710, f"Sexo: {patient['sex']}")
-        c.drawString(100, 690, f"DNI: {patient['dni']}")
-        
-        # Espacio para las segmentaciones
-        y_position = 650
-        for idx, seg_path in enumerate(patient.get("segmentations", [])):
-            c.drawString(100, y_position, f"Segmentación {idx + 1}:")
-            y_position -= 20
-            
-            # Insertar la imagen segmentada
-            image = Image.open(seg_path)
-            image_path = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-            image.save(image_path.name)
-            c.drawImage(image_path.name, 100, y_position - 200, width=200, height=200)
-            y_position -= 220
-            
-            # Limitar el número de imágenes por página
-            if y_position < 100:
-                c.showPage()  # Nueva página
-                y_position = 750
-
-        c.save()
-        
-        # Leer el archivo PDF generado
-        tmp_file.seek(0)
-        pdf_data = tmp_file.read()
-    
-    return pdf_data
-
+    if st.button("Procesar video", key="process_video_button"):
+        try:
+            submit_segmentations([video_file.getvalue()], [video_file.name], video=True)
+        except QueueFullError:
+            st.error("Hay demasiadas imágenes en cola. Inténtalo de nuevo en unos segundos.")
 
-# Función de asignación de segmentación con verificación de máscara segmentada en session_state
+    latest = next((entry for entry in st.session_state.segmentation_jobs
+                   if entry.get("video") and entry["name"] == video_file.name), None)
+    if latest is None or latest["status"] != "done":
+        return
+    stats = latest["video_stats"]
+    best = next(frame for frame in stats["frames"] if frame["index"] == stats["best_index"])
+    when = f" ({best['time']:.1f} s)" if best["time"] is not None else ""
+
+    col1, col2 = st.columns(2)
+    with col1:
+        frame = get_artifact_store().get(latest["frame"])
+        if frame is not None:
+            st.image(frame, caption=f"Fotograma más nítido: {best['index']}{when}", width=300)
+    with col2:
+        st.image(latest["filename"], caption='Máscara segmentada', use_column_width=False, width=300)
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Área en el fotograma elegido", f"{latest['area']:.2f}%")
+    col2.metric("Área media", f"{stats['area_mean']:.2f}%", help=f"Desviación típica {stats['area_std']:.2f}")
+    col3.metric("Rango de área", f"{stats['area_min']:.2f}–{stats['area_max']:.2f}%")
+    st.caption(f"{len(stats['frames'])} fotogramas segmentados de {stats['total_frames']} "
+               f"(evaluando uno de cada {stats['stride']})")
+
+    x_label = "Tiempo (s)" if stats["fps"] else "Fotograma"
+    x_values = [frame["time"] if stats["fps"] else frame["index"] for frame in stats["frames"]]
+    st.line_chart({x_label: x_values, "Área (%)": [frame["area"] for frame in stats["frames"]]}, x=x_label, y="Área (%)")
+
+# Modo por lotes: varias imágenes encoladas de una vez; la cola las agrupa en pocas
+# llamadas a model.predict
+def segmentacion_por_lotes():
+    image_files = st.file_uploader("Cargar imágenes", type=["jpg", "jpeg", "png"], accept_multiple_files=True, key="upload_images")
+
+    if image_files and st.button("Procesar lote", key="process_batch_button"):
+        try:
+            with metrics.timed("decode"):
+                images = [load_image(image_file) for image_file in image_files]
+            submit_segmentations(images, [image_file.name for image_file in image_files])
+        except QueueFullError:
+            st.error("Hay demasiadas imágenes en cola. Inténtalo de nuevo en unos segundos.")
+        except (ValueError, OSError) as e:
+            st.error(f"No se pudo abrir la imagen: {e}")
+
+
+# Asignación a un paciente de cualquiera de las segmentaciones terminadas en la sesión
 def asignar_segmentacion_page():
     header()
     st.subheader("Asignar segmentación a un paciente")
-    
-    # Verificar que existe una imagen procesada guardada en session_state
-    if "processed_image_filename" not in st.session_state:
+
+    # Verificar que hay alguna segmentación terminada (las que acaban de terminar se
+    # recogen aquí aunque no se haya vuelto a la página de segmentación)
+    collect_segmentations()
+    entry = select_segmentation("Segmentación", key="assign_selected_segmentation")
+    if entry is None:
         st.warning("No hay una segmentación disponible para asignar. Vuelve a segmentar una imagen.")
+        if pending_segmentations():
+            segmentation_progress()
         if st.button("Atrás"):
             set_page("iniciar_segmentacion")
         return
 
-    # Mostrar la imagen segmentada actual para confirmación
-    st.image(st.session_state.processed_image, caption='Máscara segmentada lista para asignar', use_column_width=False, width=300)
+    # Mostrar la imagen segmentada elegida para confirmación
+    st.image(entry["filename"], caption='Máscara segmentada lista para asignar', use_column_width=False, width=300)
 
     # Solicitar el DNI del paciente
     dni_input = st.text_input("Ingrese el DNI del paciente", key="dni_for_segmentation")
 
     # Botón para asignar la segmentación
     if st.button("Asignar"):
-        # Buscar el paciente en la lista y asignar la segmentación
-        found = False
-        for patient in st.session_state.patients:
-            if patient['dni'] == dni_input:
-                # Asignar la ruta de la imagen procesada al perfil del paciente
-                if "segmentations" not in patient:
-                    patient["segmentations"] = []
-                patient["segmentations"].append(st.session_state.processed_image_filename)
-                st.success("Segmentación asignada correctamente al paciente.")
-                found = True
-                save_patients_data()  # Guardar cambios en la base de datos
-                break
-        if not found:
+        # Asignar la ruta de la máscara al perfil del paciente (una sola fila nueva)
+        if add_segmentation_to_patient(dni_input, entry["filename"]):
+            st.success("Segmentación asignada correctamente al paciente.")
+        else:
             st.error("Paciente no encontrado. Verifica el DNI.")
 
     # Botón "Atrás" para volver a `iniciar_segmentacion`
@@ -625,49 +1229,33 @@ def asignar_segmentacion_page():
         set_page("iniciar_segmentacion")
 
 
-# Calcula el porcentaje de píxeles no negros en la imagen procesada
-def calculate_non_black_pixel_percentage(mask):
-    non_black_pixels = np.sum(mask > 0)
-    total_pixels = mask.size
-    return (non_black_pixels / total_pixels) * 100
-
-def process_image(image):
-    try:
-        image = np.array(image)
-        image = cv2.resize(image, (224, 224))
-        image = image / 255.0
-        image = np.expand_dims(image, axis=0)
-        mask = np.zeros_like(image[0], dtype=np.uint8)
-        return (mask * 255).astype(np.uint8)
-    except Exception as e:
-        st.write(f"Error al procesar la imagen: {e}")
-        return None
-
 # Guarda la imagen segmentada y devuelve la ruta del archivo
-def save_processed_image(mask):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+@metrics.timed("save")
+def save_processed_image(mask, model_version):
+    # Incluir microsegundos para que las máscaras de un mismo lote no se sobrescriban
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     filename = f"{SEGMENTATION_DIR}/mask_{timestamp}.png"
-    Image.fromarray(mask).save(filename)
+    with metrics.timed("save_png"):
+        Image.fromarray(mask).save(filename)
+
+    # Formato compacto y métricas se escriben una sola vez, al guardar la máscara
+    compact_path = save_compact_mask(mask, compact_mask_path(filename)) if COMPACT_MASKS else None
+    get_patient_store().save_mask_metrics(filename, compute_mask_metrics(mask), compact_path, model_version)
+
+    # Generar la miniatura ahora para que la galería del paciente no tenga que hacerlo
+    with metrics.timed("thumbnail"):
+        get_thumbnail_cache().get(filename)
     return filename
 
 def assign_segmentation_to_patient(dni, filename):
-    found = False
-    for patient in st.session_state.patients:
-        if patient['dni'] == dni:
-            if 'segmentations' not in patient:
-                patient['segmentations'] = []
-            patient['segmentations'].append(filename)
-            st.success(f"Segmentación asignada correctamente al paciente con DNI: {dni}")
-            found = True
-            break
-    if not found:
+    if add_segmentation_to_patient(dni, filename):
+        st.success(f"Segmentación asignada correctamente al paciente con DNI: {dni}")
+    else:
         st.error("Paciente no encontrado. Verifica el DNI.")
-    
-    # Guarda los datos actualizados
-    save_patients_data()
 
 # Navegación principal
 def main():
+    start_metrics_server()
     page = st.session_state.page
     if page == 'register':
         register_page()
@@ -683,6 +1271,10 @@ def main():
         iniciar_segmentacion()
     elif page == 'asignar_segmentacion':
         asignar_segmentacion_page()
+    elif page == 'metricas':
+        metricas_page()
+    elif page == 'admin_pacientes':
+        admin_pacientes_page()
     elif page == 'reset_database':  # Nueva página de reinicio de base de datos
         reset_database_page()
     else:
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+
+import artifact_store
+from artifact_store import ArtifactStore
+
+
+def test_spill_and_reload(tmp_path):
+    store = ArtifactStore(str(tmp_path), memory_bytes=1000, disk_bytes=10_000)
+    array = np.arange(100, dtype=np.float32)  # 400 bytes
+    first = store.put(array)
+    second = store.put(b"x" * 400)
+    third = store.put(b"y" * 400)  # Supera memory_bytes: se vuelca el primero
+
+    stats = store.stats()
+    assert stats["memory_entries"] == 2 and stats["disk_entries"] == 1
+    assert os.path.exists(store._disk[first][0])
+
+    reloaded = store.get(first)
+    np.testing.assert_array_equal(reloaded, array)
+    assert store.disk_loads == 1
+    # Al volver a memoria se vuelca ahora el usado hace más tiempo
+    assert store.get(second) == b"x" * 400
+    assert store.get(third) == b"y" * 400
+    assert store.stats()["memory_bytes"] <= 1000
+
+
+def test_disk_eviction_invalidates_handle(tmp_path):
+    store = ArtifactStore(str(tmp_path), memory_bytes=0, disk_bytes=1000)
+    handles = [store.put(bytes([value]) * 400) for value in range(3)]
+
+    assert store.get(handles[0]) is None
+    assert store.get(handles[2]) == bytes([2]) * 400
+    assert store.stats()["disk_bytes"] <= 1000
+
+
+def test_missing_spill_file_invalidates_handle(tmp_path):
+    store = ArtifactStore(str(tmp_path), memory_bytes=0, disk_bytes=10_000)
+    handle = store.put(b"z" * 100)
+    path, size = store._disk[handle]
+    os.remove(path)
+
+    assert store.get(handle) is None
+    assert store.stats()["disk_bytes"] == 0
+
+
+def test_put_file(tmp_path):
+    store = ArtifactStore(str(tmp_path), memory_bytes=0, disk_bytes=10_000)
+    path = store.new_file(".csv")
+    with open(path, 'w') as file:
+        file.write("dni,name\n")
+    handle = store.put_file(path)
+
+    assert store.file_path(handle) == path
+    store.discard(handle)
+    assert store.file_path(handle) is None
+    assert not os.path.exists(path)
+
+
+@pytest.mark.skipif(artifact_store.fcntl is None, reason="requiere flock")
+def test_removes_only_unlocked_spill_dirs(tmp_path):
+    live = ArtifactStore(str(tmp_path))
+    dead = ArtifactStore(str(tmp_path))
+    dead._spill_lock.close()  # Como si su proceso hubiera terminado
+    # Directorios sin archivo de bloqueo: uno recién creado y otro abandonado
+    creating = tmp_path / "spill-creating"
+    abandoned = tmp_path / "spill-abandoned"
+    creating.mkdir()
+    abandoned.mkdir()
+    old = abandoned.stat().st_mtime - artifact_store._UNLOCKED_GRACE_SECONDS - 1
+    os.utime(abandoned, (old, old))
+
+    ArtifactStore(str(tmp_path))
+
+    assert os.path.isdir(live.spill_dir)
+    assert not os.path.exists(dead.spill_dir)
+    assert creating.is_dir()
+    assert not abandoned.exists()
@@ -0,0 +1,97 @@
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import job_queue
+import uploader
+from job_queue import JobQueue, QueueFullError
+
+
+# Modelo de prueba: máscara llena, sin TensorFlow
+class FakeModel:
+    def predict(self, batch, **kwargs):
+        return np.ones((len(batch), 224, 224, 1), dtype=np.float32)
+
+
+def png_bytes():
+    buffer = BytesIO()
+    Image.new("RGB", (300, 200), (120, 40, 40)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Cargador que no devuelve el modelo hasta que se suelta release, para llenar la cola
+def blocking_loader(release):
+    def loader():
+        release.wait(10)
+        return "v1", FakeModel()
+    return loader
+
+
+# Espera a que el hilo tome el trabajo de la cola
+def wait_running(job, timeout=10):
+    deadline = time.monotonic() + timeout
+    while job.status == "queued" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.status == "running"
+
+
+def test_submit_rejects_when_full():
+    release = threading.Event()
+    queue = JobQueue(blocking_loader(release), max_size=2, batch_size=1)
+    try:
+        running = queue.submit(png_bytes())
+        wait_running(running)  # El hilo lo toma y espera al modelo
+        queued = queue.submit_many([png_bytes(), png_bytes()])
+        with pytest.raises(QueueFullError):
+            queue.submit(png_bytes())
+        assert queue.stats()["queued"] == 2
+    finally:
+        release.set()
+    assert all(job.wait(10) and job.status == "done" for job in [running, *queued])
+
+
+def test_api_answers_429_when_full(monkeypatch):
+    release = threading.Event()
+    queue = JobQueue(blocking_loader(release), max_size=1, batch_size=1)
+    monkeypatch.setattr(uploader, "_job_queue", queue)
+    client = uploader.app.test_client()
+
+    def post():
+        return client.post("/api/segmentations", data={"image": (BytesIO(png_bytes()), "wound.png")})
+
+    try:
+        first = post()
+        wait_running(queue.get(first.json["jobs"][0]["id"]))
+        responses = [first, post(), post()]
+    finally:
+        release.set()
+    assert [response.status_code for response in responses] == [202, 202, 429]
+    assert responses[2].headers["Retry-After"] == "1"
+    # Que los trabajos terminen antes de que otra prueba sustituya sus funciones
+    for response in responses[:2]:
+        assert queue.get(response.json["jobs"][0]["id"]).wait(10)
+
+
+def test_worker_survives_failing_job(monkeypatch):
+    queue = JobQueue(lambda: ("v1", FakeModel()))
+    calls = []
+
+    # La primera máscara falla al calcular sus métricas, fuera de la llamada al modelo
+    def compute_mask_metrics(mask):
+        calls.append(mask)
+        if len(calls) == 1:
+            raise RuntimeError("métricas")
+        return {}
+
+    monkeypatch.setattr(job_queue, "compute_mask_metrics", compute_mask_metrics)
+    failed = queue.submit(png_bytes())
+    assert failed.wait(10)
+    assert failed.status == "error" and "métricas" in failed.error
+
+    done = queue.submit(png_bytes())
+    assert done.wait(10)
+    assert done.status == "done" and done.model_version == "v1"
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+import model_registry
+from model_registry import BackendMismatchError, ModelManager, ModelRegistry
+
+
+# Modelo de prueba que recuerda el archivo del que se cargó
+class FakeModel:
+    def __init__(self, path):
+        self.path = path
+
+    def predict(self, batch, **kwargs):
+        return np.zeros((len(batch), 224, 224, 1), dtype=np.float32)
+
+
+# Cargador sin TensorFlow: falla con los archivos cuyo contenido empieza por "broken"
+def fake_loader(backend, path):
+    with open(path, 'rb') as file:
+        if file.read().startswith(b"broken"):
+            raise OSError("archivo de modelo dañado")
+    return FakeModel(path)
+
+
+@pytest.fixture(autouse=True)
+def no_tensorflow(monkeypatch):
+    monkeypatch.setattr(model_registry, "load_segmentation_model", fake_loader)
+
+
+def write_model(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as file:
+        file.write(content)
+    return path
+
+
+def test_register_same_file_twice(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    first = registry.register(write_model(tmp_path, "a.h5", b"weights"))
+    second = registry.register(write_model(tmp_path, "b.h5", b"weights"), name="otro")
+
+    assert first == second
+    assert len(registry.versions()) == 1
+    assert sorted(os.listdir(tmp_path / "models")) == [f"{first}.h5", "registry.json"]
+
+
+def test_activate_broken_version_keeps_current(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    good = write_model(tmp_path, "good.h5", b"good")
+    manager = ModelManager(registry, "keras", default_path=good)
+    version = manager.version
+    broken = registry.register(write_model(tmp_path, "broken.h5", b"broken"))
+
+    manager.activate(broken).join(10)
+
+    assert manager.version == version
+    assert registry.active_version("keras") == version
+    assert manager.loading is None
+    assert manager.last_error["version"] == broken
+    assert "dañado" in manager.last_error["error"]
+
+
+def test_activate_loads_before_switching(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    manager = ModelManager(registry, "keras", default_path=write_model(tmp_path, "v1.h5", b"v1"))
+    new = registry.register(write_model(tmp_path, "v2.h5", b"v2"))
+
+    manager.activate(new).join(10)
+
+    assert manager.version == new
+    assert registry.active_version("keras") == new
+    assert registry.loaded_version("keras") == new
+    assert manager.last_error is None
+
+
+def test_activate_rejects_other_backend(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    manager = ModelManager(registry, "keras", default_path=write_model(tmp_path, "v1.h5", b"v1"))
+    tflite = registry.register(write_model(tmp_path, "v1.tflite", b"tflite"))
+
+    with pytest.raises(BackendMismatchError):
+        manager.activate(tflite)
+    with pytest.raises(KeyError):
+        manager.activate("desconocida")
+    assert manager.loading is None
+
+
+# Si la versión activa del registro no carga al arrancar (por ejemplo, se activó a mano),
+# se vuelve a la última que cargó bien y se deja activa
+def test_startup_falls_back_to_loaded_version(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    good = ModelManager(registry, "keras", default_path=write_model(tmp_path, "v1.h5", b"v1")).version
+    broken = registry.register(write_model(tmp_path, "broken.h5", b"broken"))
+    registry.activate(broken)
+
+    manager = ModelManager(registry, "keras")
+
+    assert manager.version == good
+    assert registry.active_version("keras") == good
+
+
+def test_startup_without_loaded_version_raises(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    with pytest.raises(OSError):
+        ModelManager(registry, "keras", default_path=write_model(tmp_path, "broken.h5", b"broken"))
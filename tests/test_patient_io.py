@@ -0,0 +1,83 @@
+import io
+import sqlite3
+
+import numpy as np
+import pytest
+
+from mask_storage import compute_mask_metrics
+from patient_io import export_patients, import_patients, iter_patient_records
+from patients_db import PatientStore
+
+
+# Paciente con una máscara con herida y otra sin herida (caja envolvente vacía)
+def make_patient():
+    wound = np.zeros((224, 224), dtype=np.uint8)
+    wound[50:100, 60:120] = 255
+    empty = np.zeros((224, 224), dtype=np.uint8)
+    return {
+        "dni": "12345678",
+        "name": "Ana Paredes",
+        "age": 54,
+        "sex": "Femenino",
+        "segmentations": ["segmentations/wound.png", "segmentations/empty.png"],
+        "metrics": {
+            "segmentations/wound.png": dict(compute_mask_metrics(wound), compact_path=None, model_version="v1"),
+            "segmentations/empty.png": dict(compute_mask_metrics(empty), compact_path=None, model_version="v1"),
+        },
+    }
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_export_import_round_trip(tmp_path, fmt):
+    source = PatientStore(str(tmp_path / "source.db"))
+    source.add_patients([make_patient()])
+    exported = io.StringIO()
+    assert export_patients(source.iter_patients(), exported, fmt) == 1
+    expected = source.get_patient("12345678")
+    source.close()
+
+    target = PatientStore(str(tmp_path / "target.db"))
+    rejects = []
+    exported.seek(0)
+    summary = import_patients(target, iter_patient_records(exported, fmt),
+                              reject=lambda *row: rejects.append(row))
+    assert rejects == []
+    assert summary == {"read": 1, "imported": 1, "rejected": 0}
+
+    imported = target.get_patient("12345678")
+    target.close()
+    assert imported == expected
+    assert imported["metrics"]["segmentations/empty.png"]["bbox_x"] is None
+
+
+def make_records(count):
+    return [(line, {"dni": str(10000000 + line), "name": "Paciente", "age": 30, "sex": "Otro"})
+            for line in range(1, count + 1)]
+
+
+# Lotes por encima del límite de 999 parámetros de SQLite anteriores a 3.32
+def test_import_large_batch(tmp_path):
+    store = PatientStore(str(tmp_path / "patients.db"))
+    assert import_patients(store, make_records(1500), batch_size=1500)["imported"] == 1500
+    summary = import_patients(store, make_records(1500), batch_size=1500)
+    store.close()
+    assert summary == {"read": 1500, "imported": 0, "rejected": 1500}
+
+
+# Si otro proceso inserta los mismos DNI en cada reintento, el lote se inserta de uno en uno
+def test_import_falls_back_to_single_rows_on_repeated_conflicts(tmp_path):
+    store = PatientStore(str(tmp_path / "patients.db"))
+    store.add_patients([make_records(1)[0][1]])
+
+    class RacingStore:
+        def add_patients(self, patients):
+            if len(patients) > 1:
+                raise sqlite3.IntegrityError("UNIQUE constraint failed: patients.dni")
+            return store.add_patients(patients)
+
+    rejects = []
+    summary = import_patients(RacingStore(), make_records(3), reject=lambda *row: rejects.append(row))
+    assert summary == {"read": 3, "imported": 2, "rejected": 1}
+    assert rejects == [(1, "10000001", "DNI ya registrado")]
+    assert store.get_patient("10000003") is not None
+    store.close()
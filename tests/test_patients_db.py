@@ -0,0 +1,59 @@
+import sqlite3
+import time
+
+import patients_db
+from patients_db import PatientStore
+
+
+def add_many(store, count, start=0):
+    store.add_patients([{"dni": str(20000000 + n), "name": "Paciente " * 20, "age": 40, "sex": "Otro"}
+                        for n in range(start, start + count)])
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+# Sin el autocheckpoint de SQLite el WAL solo crece hasta que checkpoint lo trunca
+def test_checkpoint_truncates_wal(tmp_path):
+    store = PatientStore(str(tmp_path / "patients.db"), checkpoint_bytes=10 ** 9)
+    add_many(store, 2000)
+    assert store.wal_size() > 0
+
+    assert store.checkpoint()
+    assert store.wal_size() == 0
+    assert store.count_patients() == 2000
+    store.close()
+
+
+# Un lector de otra conexión impide truncar el WAL; se consigue al terminar la lectura
+def test_checkpoint_busy_while_reading(tmp_path):
+    path = str(tmp_path / "patients.db")
+    store = PatientStore(path, checkpoint_bytes=10 ** 9)
+    add_many(store, 100)
+    reader = sqlite3.connect(path)
+    reader.execute("BEGIN")
+    reader.execute("SELECT COUNT(*) FROM patients").fetchone()
+    add_many(store, 100, start=100)
+
+    assert not store.checkpoint()
+    reader.rollback()
+    assert store.checkpoint()
+    assert store.wal_size() == 0
+    reader.close()
+    store.close()
+
+
+def test_checkpoint_thread_truncates_over_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(patients_db, "WAL_CHECK_INTERVAL", 0.01)
+    store = PatientStore(str(tmp_path / "patients.db"), checkpoint_bytes=64 * 1024)
+    add_many(store, 2000)
+
+    assert wait_for(lambda: store.wal_size() == 0)
+    store.close()
+    reopened = PatientStore(str(tmp_path / "patients.db"), checkpoint_bytes=0)
+    assert reopened.count_patients() == 2000
+    reopened.close()
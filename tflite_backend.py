@@ -0,0 +1,174 @@
+import argparse
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from mask_storage import MASK_THRESHOLD
+from segmentation import DEFAULT_BATCH_SIZE, IMAGE_SIZE, load_image, predict_masks, prepare_image, stack_images
+
+KERAS_MODEL_PATH = "SegNet_trained.h5"
+TFLITE_MODEL_PATH = os.environ.get("SEGAPP_TFLITE_PATH", "SegNet_trained.tflite")
+
+# Hilos del intérprete de TFLite (por defecto, todos los núcleos disponibles)
+TFLITE_NUM_THREADS = int(os.environ.get("SEGAPP_TFLITE_THREADS", os.cpu_count() or 1))
+
+QUANTIZATION_MODES = ("float16", "int8")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+# Lista las imágenes de un directorio, ordenadas, hasta un máximo de limit
+def list_images(directory, limit=None):
+    paths = sorted(
+        path for path in glob.glob(os.path.join(directory, "*"))
+        if path.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    return paths[:limit] if limit else paths
+
+
+# Convierte el modelo de Keras a TFLite con cuantización float16 o int8
+def convert_model(keras_path, output_path, quantization="float16", calibration_paths=None):
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Cuantización no soportada: {quantization}")
+
+    model = tf.keras.models.load_model(keras_path, compile=False)
+
+    # Clonar el modelo con una entrada de forma fija (1, 224, 224, 3): con dimensiones
+    # dinámicas las capas UpSampling2D impiden convertir las convoluciones a TFLite
+    static_input = tf.keras.Input(batch_shape=(1, IMAGE_SIZE[1], IMAGE_SIZE[0], 3))
+    static_model = tf.keras.models.clone_model(model, input_tensors=[static_input])
+    static_model.set_weights(model.get_weights())
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(static_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        # La cuantización int8 necesita imágenes reales para calibrar los rangos de activación
+        if not calibration_paths:
+            raise ValueError("La cuantización int8 requiere imágenes de calibración")
+
+        def representative_dataset():
+            for path in calibration_paths:
+                with Image.open(path) as image:
+                    yield [prepare_image(image)[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    tflite_model = converter.convert()
+    with open(output_path, "wb") as file:
+        file.write(tflite_model)
+    return output_path
+
+
+# Modelo TFLite con la misma interfaz predict que un modelo de Keras
+class TFLiteModel:
+    def __init__(self, model_path=TFLITE_MODEL_PATH, num_threads=TFLITE_NUM_THREADS):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        # El intérprete no admite llamadas concurrentes desde varias sesiones
+        self._lock = threading.Lock()
+
+    # El modelo convertido tiene lote fijo de una imagen: se invoca una vez por imagen
+    def predict(self, batch, **kwargs):
+        batch = np.asarray(batch, dtype=np.float32)
+        predictions = np.empty((len(batch), IMAGE_SIZE[1], IMAGE_SIZE[0], 1), dtype=np.float32)
+        with self._lock:
+            for idx in range(len(batch)):
+                self.interpreter.set_tensor(self.input_index, batch[idx:idx + 1])
+                self.interpreter.invoke()
+                predictions[idx] = self.interpreter.get_tensor(self.output_index)[0]
+        return predictions
+
+
+# Intersección sobre unión entre dos máscaras binarizadas en el umbral threshold (el
+# mismo con el que la aplicación calcula el área y las métricas)
+def mask_iou(mask_a, mask_b, threshold=MASK_THRESHOLD):
+    a = mask_a > threshold
+    b = mask_b > threshold
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return np.logical_and(a, b).sum() / union
+
+
+# Compara las máscaras de Keras y TFLite sobre las mismas imágenes (IoU medio y latencia).
+# Las imágenes que no se pueden decodificar se omiten y se cuentan en skipped
+def evaluate_backends(keras_model, tflite_model, image_paths, batch_size=DEFAULT_BATCH_SIZE):
+    images = []
+    skipped = 0
+    for path in image_paths:
+        try:
+            images.append(load_image(path))
+        except (OSError, ValueError):
+            skipped += 1
+    if not images:
+        raise ValueError("Ninguna de las imágenes se pudo decodificar")
+    batch = stack_images(images)
+
+    results = {}
+    masks = {}
+    for name, model in (("keras", keras_model), ("tflite", tflite_model)):
+        # Una predicción previa para no medir la inicialización del backend
+        model.predict(batch[:1], verbose=0)
+        start = time.perf_counter()
+        masks[name] = predict_masks(model, batch, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        results[f"{name}_ms_per_image"] = elapsed * 1000.0 / len(batch)
+
+    ious = [mask_iou(a, b) for a, b in zip(masks["keras"], masks["tflite"])]
+    results["mean_iou"] = float(np.mean(ious))
+    results["min_iou"] = float(np.min(ious))
+    results["images"] = len(ious)
+    results["skipped"] = skipped
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend TFLite cuantizado para SegNet")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="Convertir el modelo .h5 a TFLite")
+    convert_parser.add_argument("--model", default=KERAS_MODEL_PATH)
+    convert_parser.add_argument("--output", default=TFLITE_MODEL_PATH)
+    convert_parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="float16")
+    convert_parser.add_argument("--calibration-dir", help="Directorio con imágenes de entrada para calibrar int8")
+    convert_parser.add_argument("--calibration-samples", type=int, default=100)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="Comparar TFLite con Keras (IoU medio)")
+    evaluate_parser.add_argument("images_dir", help="Directorio con imágenes de entrada")
+    evaluate_parser.add_argument("--model", default=KERAS_MODEL_PATH)
+    evaluate_parser.add_argument("--tflite", default=TFLITE_MODEL_PATH)
+    evaluate_parser.add_argument("--threads", type=int, default=TFLITE_NUM_THREADS)
+    evaluate_parser.add_argument("--limit", type=int, default=200)
+
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        calibration_paths = None
+        if args.calibration_dir:
+            calibration_paths = list_images(args.calibration_dir, args.calibration_samples)
+        convert_model(args.model, args.output, args.quantization, calibration_paths)
+        print(f"Modelo {args.quantization} guardado en {args.output} ({os.path.getsize(args.output) / 1024:.0f} KB)")
+    else:
+        image_paths = list_images(args.images_dir, args.limit)
+        if not image_paths:
+            parser.error(f"No se encontraron imágenes en {args.images_dir}")
+        keras_model = tf.keras.models.load_model(args.model)
+        tflite_model = TFLiteModel(args.tflite, num_threads=args.threads)
+        results = evaluate_backends(keras_model, tflite_model, image_paths)
+        print(f"Imágenes evaluadas: {results['images']} (omitidas por no poder leerse: {results['skipped']})")
+        print(f"IoU medio: {results['mean_iou']:.4f} (mínimo {results['min_iou']:.4f})")
+        print(f"Keras: {results['keras_ms_per_image']:.1f} ms/imagen, TFLite: {results['tflite_ms_per_image']:.1f} ms/imagen")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import threading
+
+from PIL import Image
+
+THUMBNAIL_DIR = "thumbnails"
+
+# Lado máximo de las miniaturas (la galería las muestra con un ancho de 250 px)
+THUMBNAIL_SIZE = (250, 250)
+
+# Espacio máximo en disco de las miniaturas
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("SEGAPP_THUMBNAIL_CACHE_MB", 128)) * 1024 * 1024
+
+
+# Caché en disco de miniaturas de segmentaciones, con clave ruta + fecha de modificación
+# y expulsión de las miniaturas usadas hace más tiempo cuando se supera el límite
+class ThumbnailCache:
+    def __init__(self, thumbnail_dir=THUMBNAIL_DIR, max_bytes=THUMBNAIL_CACHE_BYTES, size=THUMBNAIL_SIZE):
+        self.thumbnail_dir = thumbnail_dir
+        self.max_bytes = max_bytes
+        self.size = size
+        self._lock = threading.Lock()
+
+        os.makedirs(thumbnail_dir, exist_ok=True)
+        self._disk_size = sum(entry.stat().st_size for entry in os.scandir(thumbnail_dir) if entry.is_file())
+
+    def _thumbnail_path(self, image_path):
+        # Si la imagen cambia, cambia su fecha de modificación y con ella la clave
+        mtime = os.stat(image_path).st_mtime_ns
+        key = hashlib.blake2b(
+            f"{os.path.abspath(image_path)}:{mtime}:{self.size}".encode(), digest_size=16
+        ).hexdigest()
+        return os.path.join(self.thumbnail_dir, f"{key}.png")
+
+    # Devuelve la ruta de la miniatura, generándola en el primer acceso
+    def get(self, image_path):
+        thumbnail_path = self._thumbnail_path(image_path)
+        if os.path.exists(thumbnail_path):
+            os.utime(thumbnail_path)  # Orden LRU por fecha de acceso
+            return thumbnail_path
+
+        with Image.open(image_path) as image:
+            image.thumbnail(self.size)
+            # Escribir en un archivo temporal y renombrar, por si otra sesión lee a la vez
+            tmp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, format="PNG", optimize=True)
+
+        with self._lock:
+            # Si otra sesión generó la misma miniatura a la vez, su tamaño ya se contó
+            created = not os.path.exists(thumbnail_path)
+            os.replace(tmp_path, thumbnail_path)
+            if created:
+                self._disk_size += os.path.getsize(thumbnail_path)
+            if self._disk_size > self.max_bytes:
+                self._evict()
+        return thumbnail_path
+
+    # Borra todas las miniaturas (al reiniciar la base de datos)
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.thumbnail_dir):
+                if entry.is_file():
+                    os.remove(entry.path)
+            self._disk_size = 0
+
+    # Borra las miniaturas usadas hace más tiempo hasta respetar el límite. El total se
+    # recalcula con el directorio, por si otro proceso también escribe en él
+    def _evict(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.thumbnail_dir) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        self._disk_size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._disk_size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._disk_size -= size
@@ -1,13 +1,34 @@
 import os
-from flask import Flask, request, redirect, url_for, render_template
+import threading
+from io import BytesIO
+from flask import Flask, request, redirect, url_for, render_template, Response
+from werkzeug.serving import make_server
 from werkzeug.utils import secure_filename
+from PIL import Image
+
+from artifact_store import init_artifact_store
+import metrics
+from job_queue import JobQueue, QueueFullError
+from model_registry import BACKEND_EXTENSIONS, BackendMismatchError, ModelManager, ModelRegistry
+from segmentation import load_segmentation_model
 
 UPLOAD_FOLDER = './'
-ALLOWED_EXTENSIONS = {'h5', 'png'}
+ALLOWED_EXTENSIONS = {'h5', 'tflite', 'png'}
+
+# Modelo de la cola de trabajos: las mismas variables de entorno que la aplicación
+MODEL_BACKEND = os.environ.get("SEGAPP_BACKEND", "keras")
+MODEL_PATH = os.environ.get("SEGAPP_MODEL_PATH")
+INFERENCE_SERVER_URL = os.environ.get("SEGAPP_INFERENCE_URL", "")
+
+# Espera máxima (segundos) de una consulta con ?wait=
+LONG_POLL_MAX_S = 60
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Los modelos subidos se guardan en el registro, no en la raíz de la aplicación
+model_registry = ModelRegistry()
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -25,6 +46,12 @@ def upload_file():
             return 'No selected file'
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
+            if os.path.splitext(filename)[1].lower() in BACKEND_EXTENSIONS.values():
+                try:
+                    version = register_model(file, filename, activate=bool(request.form.get('activate')))
+                except BackendMismatchError as e:
+                    return f'Model {filename} registered but not activated: {e}', 409
+                return f'Model {filename} registered as version {version}'
             file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
             return f'File {filename} uploaded successfully'
     return '''
@@ -33,9 +60,135 @@ def upload_file():
     <h1>Upload new File</h1>
     <form method=post enctype=multipart/form-data>
       <input type=file name=file>
+      <label><input type=checkbox name=activate value=1> Activate model</label>
       <input type=submit value=Upload>
     </form>
     '''
 
+# Guarda un modelo subido en el registro (un archivo ya registrado no se duplica) y,
+# si se pide, lo activa; el modelo en uso se sustituye en caliente
+def register_model(file, filename, activate=False):
+    tmp_path = os.path.join(model_registry.models_dir, f"upload_{threading.get_ident()}_{filename}")
+    file.save(tmp_path)
+    try:
+        version = model_registry.register(tmp_path, name=filename)
+    finally:
+        os.remove(tmp_path)
+    if activate:
+        activate_model(version)
+    return version
+
+# La versión solo pasa a ser la activa del registro cuando ya se cargó y calentó
+def activate_model(version):
+    init_model_manager().activate(version)
+
+_model_manager = None
+_job_queue = None
+_init_lock = threading.Lock()
+
+# Modelo activo del registro con recarga en caliente, compartido con Streamlit
+def init_model_manager():
+    global _model_manager
+    with _init_lock:
+        if _model_manager is None:
+            _model_manager = ModelManager(model_registry, MODEL_BACKEND, MODEL_PATH)
+        return _model_manager
+
+# (versión, modelo) actuales, leídos juntos; se consulta en cada lote, así que debe ser barato
+def current_model():
+    if INFERENCE_SERVER_URL:
+        return f"remote:{INFERENCE_SERVER_URL}", load_segmentation_model("remote", url=INFERENCE_SERVER_URL)
+    return init_model_manager().current()
+
+# Cola de trabajos de segmentación del proceso. Streamlit la crea con su propio
+# cargador de modelo, de modo que la interfaz y la API comparten cola y modelo
+def init_job_queue(model_loader=current_model):
+    global _job_queue
+    with _init_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(model_loader, artifacts=init_artifact_store())
+        return _job_queue
+
+# Encola una o varias imágenes (campo 'image' del formulario) para segmentarlas; con
+# ?tiled=1, a resolución completa
+@app.route('/api/segmentations', methods=['POST'])
+def submit_segmentations():
+    files = request.files.getlist('image')
+    if not files or any(file.filename == '' for file in files):
+        return {'error': 'No image part'}, 400
+    try:
+        jobs = init_job_queue().submit_many(
+            [file.read() for file in files],
+            [secure_filename(file.filename) for file in files],
+            tiled=request.args.get('tiled') == '1',
+        )
+    except QueueFullError as e:
+        return {'error': str(e)}, 429, {'Retry-After': '1'}
+    return {'jobs': [job.to_dict() for job in jobs]}, 202
+
+@app.route('/api/segmentations', methods=['GET'])
+def segmentation_queue_stats():
+    return init_job_queue().stats()
+
+# Estado del trabajo; con ?wait=N espera hasta N segundos a que termine
+@app.route('/api/segmentations/<job_id>')
+def segmentation_status(job_id):
+    job = init_job_queue().get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    wait = request.args.get('wait', type=float)
+    if wait:
+        job.wait(timeout=min(wait, LONG_POLL_MAX_S))
+    return job.to_dict()
+
+# Máscara del trabajo terminado en PNG
+@app.route('/api/segmentations/<job_id>/mask')
+def segmentation_mask(job_id):
+    job = init_job_queue().get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    if job.status != 'done':
+        return {'error': f'Job is {job.status}'}, 409
+    mask = job.mask
+    if mask is None:
+        return {'error': 'Mask no longer available'}, 410
+    buffer = BytesIO()
+    Image.fromarray(mask).save(buffer, format='PNG')
+    return Response(buffer.getvalue(), mimetype='image/png')
+
+# Versiones registradas del modelo y versión en uso
+@app.route('/api/models')
+def list_models():
+    return {
+        'versions': model_registry.versions(),
+        'loaded': _model_manager.version if _model_manager is not None else None,
+        'loading': _model_manager.loading if _model_manager is not None else None,
+        'last_error': _model_manager.last_error if _model_manager is not None else None,
+    }
+
+# Activa una versión registrada: se carga en segundo plano y sustituye a la actual. Si
+# no carga, GET /api/models lo indica en last_error
+@app.route('/api/models/<version>/activate', methods=['POST'])
+def activate_model_endpoint(version):
+    try:
+        activate_model(version)
+    except KeyError:
+        return {'error': 'Unknown model version'}, 404
+    except BackendMismatchError as e:
+        return {'error': str(e)}, 409
+    return {'loading': version}, 202
+
+# Métricas del proceso en formato de texto de Prometheus
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# Sirve esta aplicación en un hilo de fondo, para exponer /metrics desde el proceso
+# de Streamlit (las métricas viven en la memoria del proceso que las registra)
+def serve_in_background(host, port):
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
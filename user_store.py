@@ -0,0 +1,107 @@
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se serializan las escrituras de este proceso
+    fcntl = None
+
+USERS_DB_PATH = "users_db.json"
+
+# Permisos de un archivo nuevo según la umask del proceso (mkstemp los crea con 0600)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_DEFAULT_FILE_MODE = 0o666 & ~_UMASK
+
+
+# Usuarios de la aplicación en un archivo JSON, compartidos por todas las sesiones del
+# proceso. La copia en memoria se recarga si otro proceso reemplazó el archivo, y cada
+# alta relee, modifica y reescribe el archivo con un renombrado atómico, bajo un lock
+# del proceso y otro de archivo entre procesos, de modo que dos altas no se pisan
+class UserStore:
+    def __init__(self, path=USERS_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._users = {}
+        self._version = None
+
+    # Identifica la versión del archivo: cada escritura lo reemplaza por uno nuevo (otro
+    # inodo), aunque la fecha de modificación coincida
+    def _file_version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    # Recarga los usuarios si el archivo cambió desde la última lectura (con el lock tomado)
+    def _refresh(self):
+        version = self._file_version()
+        if version == self._version:
+            return
+        if version is None:
+            self._users = {}
+        else:
+            with open(self.path) as file:
+                self._users = json.load(file)
+        self._version = version
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Escribe el archivo nuevo con los permisos del anterior y lo lleva a disco antes de
+    # renombrarlo (y el directorio después), para que un corte nunca deje el archivo vacío
+    def _write(self, users):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            mode = os.stat(self.path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = _DEFAULT_FILE_MODE
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w') as file:
+            json.dump(users, file, indent=4)
+            file.flush()
+            if hasattr(os, "fchmod"):
+                os.fchmod(file.fileno(), mode)
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        _fsync_directory(directory)
+        self._users = users
+        self._version = self._file_version()
+
+    def check_password(self, username, password):
+        with self._lock:
+            self._refresh()
+            return username in self._users and self._users[username] == password
+
+    # Da de alta un usuario; devuelve False si ya existe
+    def add(self, username, password):
+        with self._lock, self._file_lock():
+            self._refresh()
+            if username in self._users:
+                return False
+            self._write(dict(self._users, **{username: password}))
+            return True
+
+
+# Lleva a disco la entrada de directorio de un renombrado (no se puede en Windows)
+def _fsync_directory(directory):
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
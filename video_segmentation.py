@@ -0,0 +1,208 @@
+import math
+import os
+import queue
+import threading
+
+import numpy as np
+
+from segmentation import (
+    DEFAULT_BATCH_SIZE,
+    IMAGE_SIZE,
+    ImageBatchBuffer,
+    calculate_non_black_pixel_percentage,
+    predict_masks,
+)
+
+VIDEO_EXTENSIONS = ("mp4", "mov", "avi", "m4v", "mkv", "webm")
+
+# Fotogramas como máximo que se segmentan por video
+VIDEO_MAX_FRAMES = int(os.environ.get("SEGAPP_VIDEO_MAX_FRAMES", 32))
+
+# Fotogramas candidatos (decodificados y evaluados) por cada fotograma segmentado: el
+# paso entre candidatos se elige para que todo el video quepa en max_frames * este valor
+VIDEO_CANDIDATES_PER_FRAME = 4
+
+# Nitidez mínima (varianza del laplaciano a 224x224) para segmentar un fotograma; los
+# movidos o desenfocados se descartan
+VIDEO_MIN_SHARPNESS = float(os.environ.get("SEGAPP_VIDEO_MIN_SHARPNESS", 20.0))
+
+# Cambio mínimo respecto al último fotograma segmentado (diferencia media en niveles
+# de gris, 0-255) para segmentar otro: los fotogramas casi idénticos no aportan nada
+VIDEO_MIN_MOTION = float(os.environ.get("SEGAPP_VIDEO_MIN_MOTION", 2.0))
+
+# Lado mayor de la copia del mejor fotograma que se conserva para mostrarla
+VIDEO_PREVIEW_SIZE = 640
+
+_END = object()
+
+
+# Nitidez de un fotograma en gris: varianza del laplaciano (baja si está movido)
+def frame_sharpness(gray):
+    import cv2
+
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+# Copia reducida (lado mayor <= size) de un fotograma RGB para mostrarla
+def _preview(rgb, size=VIDEO_PREVIEW_SIZE):
+    import cv2
+
+    height, width = rgb.shape[:2]
+    scale = size / max(height, width)
+    if scale >= 1:
+        return rgb.copy()
+    return cv2.resize(rgb, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+# Productor: recorre el video con paso stride (los fotogramas intermedios se saltan con
+# grab(), sin convertirlos) y pasa a out los candidatos que superan los umbrales de
+# nitidez y movimiento, ya reducidos a la entrada del modelo. Se detiene al llegar a
+# max_frames fotogramas o max_candidates candidatos. Si ninguno supera los umbrales, pasa
+# el más nítido
+def _produce_frames(capture, out, stop, stride, max_frames, max_candidates, min_sharpness, min_motion):
+    import cv2
+
+    fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+    kept = candidates = index = 0
+    last_gray = None
+    sharpest = None
+
+    while kept < max_frames and candidates < max_candidates and not stop.is_set():
+        ok, frame = capture.read()
+        if not ok:
+            break
+        candidates += 1
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        small = cv2.resize(rgb, IMAGE_SIZE, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+        item = {
+            "index": index,
+            "time": index / fps if fps else None,
+            "sharpness": frame_sharpness(gray),
+            "motion": None if last_gray is None else float(cv2.absdiff(gray, last_gray).mean()),
+        }
+
+        accepted = item["sharpness"] >= min_sharpness and (last_gray is None or item["motion"] >= min_motion)
+        if accepted:
+            if not _put(out, stop, (item, small, _preview(rgb))):
+                return
+            kept += 1
+            last_gray = gray
+        elif kept == 0 and (sharpest is None or item["sharpness"] > sharpest[0]["sharpness"]):
+            sharpest = (item, small, _preview(rgb))
+
+        # Saltar los fotogramas intermedios sin convertirlos
+        for _ in range(stride - 1):
+            if not capture.grab():
+                break
+        index += stride
+
+    if kept == 0 and sharpest is not None:
+        _put(out, stop, sharpest)
+
+
+# Encola sin bloquear indefinidamente: si el consumidor se detuvo, descarta el elemento
+def _put(out, stop, item):
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _run_producer(capture, out, stop, *args):
+    try:
+        _produce_frames(capture, out, stop, *args)
+    except Exception as e:
+        _put(out, stop, e)
+    finally:
+        capture.release()
+        _put(out, stop, _END)
+
+
+# Segmenta un video (ruta a un archivo que cv2 sepa leer). Un hilo decodifica y elige los
+# fotogramas (cada stride fotogramas, o un paso que reparte max_frames * 4 candidatos por
+# todo el video, descartando los borrosos y los casi repetidos) mientras este hilo los
+# segmenta por lotes de batch_size. Devuelve la máscara y una copia del fotograma más
+# nítido, y el área de la herida en cada fotograma segmentado. Si se indica progress, se
+# llama con (fotogramas segmentados, max_frames) tras cada lote
+def segment_video(model, path, max_frames=VIDEO_MAX_FRAMES, stride=None, min_sharpness=VIDEO_MIN_SHARPNESS,
+                  min_motion=VIDEO_MIN_MOTION, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    import cv2
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("No se pudo abrir el video")
+    total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    fps = capture.get(cv2.CAP_PROP_FPS) or None
+    max_candidates = max_frames * VIDEO_CANDIDATES_PER_FRAME
+    if stride is None:
+        stride = max(1, math.ceil(total_frames / max_candidates)) if total_frames > 0 else 1
+
+    frames = queue.Queue(maxsize=2 * batch_size)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=_run_producer,
+        args=(capture, frames, stop, stride, max_frames, max_candidates, min_sharpness, min_motion),
+        daemon=True,
+    )
+    producer.start()
+
+    buffer = ImageBatchBuffer(batch_size)
+    results = []
+    best = None
+    try:
+        finished = False
+        while not finished:
+            # Esperar el primer fotograma del lote y añadir los que ya estén decodificados
+            batch = []
+            while len(batch) < batch_size:
+                item = frames.get() if not batch else _get_nowait(frames)
+                if item is None:
+                    break
+                if item is _END:
+                    finished = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch.append(item)
+            if not batch:
+                continue
+
+            masks = predict_masks(model, buffer.stack(small for _, small, _ in batch), batch_size=batch_size)
+            for (item, _, preview), mask in zip(batch, masks):
+                item["area"] = calculate_non_black_pixel_percentage(mask)
+                results.append(item)
+                if best is None or item["sharpness"] > best[0]["sharpness"]:
+                    best = (item, mask, preview)
+            if progress is not None:
+                progress(len(results), max_frames)
+    finally:
+        stop.set()
+        producer.join()
+
+    if best is None:
+        raise ValueError("El video no tiene fotogramas legibles")
+    areas = np.array([item["area"] for item in results])
+    return {
+        "mask": best[1],
+        "frame": best[2],
+        "best_index": best[0]["index"],
+        "frames": results,
+        "stride": stride,
+        "fps": fps,
+        "total_frames": total_frames,
+        "area_mean": float(areas.mean()),
+        "area_std": float(areas.std()),
+        "area_min": float(areas.min()),
+        "area_max": float(areas.max()),
+    }
+
+
+def _get_nowait(frames):
+    try:
+        return frames.get_nowait()
+    except queue.Empty:
+        return None